@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Dispatcher分发模式对比
+
+对比 poll / event 两种模式下:
+    1. 空闲时的CPU占用
+    2. 消息入队至handler被调用的延迟(p50/p99)
+
+--interval 0 --prioritized 可观察行情积压时柜台回报的延迟
+
+python benchmarks/bench_dispatcher.py
+"""
+
+import time
+import argparse
+
+from fast_trader.dtp_trade import Dispatcher
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+def measure_idle_cpu(mode, secs):
+    dispatcher = Dispatcher(mode=mode)
+    time.sleep(0.1)
+
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    time.sleep(secs)
+    cpu1, wall1 = time.process_time(), time.perf_counter()
+
+    dispatcher.stop()
+    dispatcher.join()
+    return (cpu1 - cpu0) / (wall1 - wall0)
+
+
+def measure_latency(mode, count, interval, **kw):
+    dispatcher = Dispatcher(mode=mode, track_latency=True, **kw)
+    latencies = {'market': [], 'rsp': []}
+
+    def on_market(mail):
+        latencies['market'].append(time.perf_counter() - mail['ts'])
+
+    def on_rsp(mail):
+        latencies['rsp'].append(time.perf_counter() - mail['ts'])
+
+    dispatcher.bind('quote_feed', on_market)
+    dispatcher.bind('0_bench_rsp', on_rsp)
+
+    for i in range(count):
+        if i % 10 == 0:
+            dispatcher.put({'handler_id': '0_bench_rsp',
+                            'ts': time.perf_counter()})
+        dispatcher.put({'handler_id': 'quote_feed',
+                        'ts': time.perf_counter()})
+        if interval:
+            time.sleep(interval)
+
+    time.sleep(0.5)
+    stats = dispatcher.get_stats()
+    dispatcher.stop()
+    dispatcher.join()
+    return latencies, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--idle-secs', type=float, default=3.)
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--interval', type=float, default=0.0002,
+                        help='seconds between messages, 0 for burst')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='market mails drained per wake-up')
+    parser.add_argument('--prioritized', action='store_true',
+                        help='check counter reports between market batches')
+    parser.add_argument('--max-market-batch', type=int, default=None)
+    parser.add_argument('--market-queue', choices=['queue', 'ring'],
+                        default=None)
+    args = parser.parse_args()
+
+    for mode in Dispatcher.MODES:
+        cpu = measure_idle_cpu(mode, args.idle_secs)
+        latencies, stats = measure_latency(
+            mode, args.count, args.interval,
+            market_batch_size=args.batch_size,
+            prioritized=args.prioritized,
+            max_market_batch=args.max_market_batch,
+            market_queue=args.market_queue)
+
+        print(f'[{mode}] idle cpu: {cpu * 100:.1f}%')
+        for lane, values in latencies.items():
+            p50 = percentile(values, 50) * 1e6
+            p99 = percentile(values, 99) * 1e6
+            print(f'[{mode}] {lane:<6} n={len(values):<6} '
+                  f'p50={p50:.1f}us p99={p99:.1f}us')
+        print(f'[{mode}] batches={stats["market_batches"]} '
+              f'max_batch={stats["max_market_batch"]}')
+        for lane, hist in stats['latency'].items():
+            print(f'[{mode}] {lane:<6} histogram {hist}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+行情队列单跳开销
+
+single: 同一线程内put后立即取出, 即每条消息的入队+出队开销
+threaded: 生产者线程持续put, 消费者线程批量取出, 统计吞吐量
+
+python benchmarks/bench_market_queue.py
+"""
+
+import time
+import queue
+import argparse
+import functools
+import threading
+
+from fast_trader.mail_queue import ConflatingQueue, RingQueue, get_many
+
+
+def make_mails(count):
+    return [{'handler_id': 'quote_feed', 'api_id': 'trade_feed',
+             'content': {'szCode': str(600000 + i % 100)}}
+            for i in range(count)]
+
+
+def make_queues(capacity):
+    ret = []
+    for name, q in [('Queue', queue.Queue()),
+                    ('ConflatingQueue', ConflatingQueue())]:
+        ret.append((name, q, functools.partial(get_many, q)))
+    for policy in RingQueue.POLICIES:
+        q = RingQueue(capacity, policy=policy)
+        ret.append((f'RingQueue({policy})', q, q.get_many))
+    return ret
+
+
+def run_single(q, get_batch, mails, batch):
+    t0 = time.perf_counter()
+    for i in range(0, len(mails), batch):
+        for mail in mails[i:i + batch]:
+            q.put(mail)
+        get_batch(batch)
+    return (time.perf_counter() - t0) / len(mails)
+
+
+def run_threaded(q, get_batch, mails, batch):
+    n = len(mails)
+
+    def produce():
+        put = q.put
+        for mail in mails:
+            put(mail)
+
+    producer = threading.Thread(target=produce)
+    t0 = time.perf_counter()
+    producer.start()
+    received = 0
+    while received < n:
+        got = len(get_batch(batch))
+        if not got:
+            time.sleep(0)
+        received += got
+    producer.join()
+    return n / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=200000)
+    parser.add_argument('--capacity', type=int, default=65536)
+    args = parser.parse_args()
+
+    mails = make_mails(args.count)
+    for batch in (1, 256):
+        for name, q, get_batch in make_queues(args.capacity):
+            cost = run_single(q, get_batch, mails, batch)
+            print(f'single   batch={batch:<4} {name:<24} '
+                  f'{cost * 1e6:6.2f}us/msg')
+        print()
+
+    for name, q, get_batch in make_queues(args.capacity):
+        rate = run_threaded(q, get_batch, mails, 256)
+        print(f'threaded batch=256  {name:<24} {rate:>12,.0f} msgs/s')
+
+
+if __name__ == '__main__':
+    main()
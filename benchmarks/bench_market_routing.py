@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+行情分发至多策略的开销
+
+对比逐策略调用`has_subscribed`的线性扫描与`Market`路由表
+
+python benchmarks/bench_market_routing.py --strategies 50 --codes 3000
+"""
+
+import time
+import random
+import argparse
+
+from fast_trader.dtp_quote import TickFeed, FEED_TYPE_NAME_MAPPING
+from fast_trader.dtp_trade import Dispatcher
+from fast_trader.strategy import (Market, StrategyMdSubMixin,
+                                  StrategyMailboxMixin)
+
+
+class _NullQuoteFeed:
+
+    def subscribe(self, feed_name, codes):
+        pass
+
+    def subscribe_all(self, feed_name):
+        pass
+
+
+class BenchStrategy(StrategyMdSubMixin, StrategyMailboxMixin):
+
+    started = True
+    strategy_name = 'bench'
+
+    def __init__(self, market, strategy_id):
+        StrategyMdSubMixin.__init__(self)
+        self.market = market
+        self.strategy_id = strategy_id
+        self.received = 0
+
+    @classmethod
+    def get_strategy_name(cls):
+        return cls.strategy_name
+
+    def on_quote_message(self, message):
+        self.received += 1
+
+
+def linear_on_quote_message(market, message):
+    code = message['content']['szCode']
+    feed_type = FEED_TYPE_NAME_MAPPING[message['api_id']]
+    for ea in market._strategies:
+        if ea.started and ea.has_subscribed(feed_type, code):
+            ea.on_quote_message(message)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--strategies', type=int, default=50)
+    parser.add_argument('--codes', type=int, default=3000)
+    parser.add_argument('--codes-per-strategy', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--mailbox', action='store_true',
+                        help='deliver through per-strategy mailboxes')
+    args = parser.parse_args()
+
+    dispatcher = Dispatcher()
+    market = Market(dispatcher)
+    market.quote_feed = _NullQuoteFeed()
+
+    codes = [f'{600000 + i}' for i in range(args.codes)]
+    for i in range(args.strategies):
+        strategy = BenchStrategy(market, i)
+        market.add_strategy(strategy)
+        if args.mailbox:
+            strategy.enable_mailbox()
+            strategy._mailbox.start()
+        strategy.subscribe(
+            TickFeed, random.sample(codes, args.codes_per_strategy))
+
+    messages = [{'api_id': 'tick_feed',
+                 'content': {'szCode': random.choice(codes)}}
+                for _ in range(args.messages)]
+
+    for name, handler in [('linear', linear_on_quote_message),
+                          ('routed', Market.on_quote_message)]:
+        t0 = time.perf_counter()
+        for message in messages:
+            handler(market, message)
+        elapsed = time.perf_counter() - t0
+        for s in market._strategies:
+            while s._mailbox is not None and s._mailbox.qsize():
+                time.sleep(0.001)
+        delivered = sum(s.received for s in market._strategies)
+        for s in market._strategies:
+            s.received = 0
+        print(f'{name:<7} {args.messages / elapsed:>12,.0f} msgs/s '
+              f'{elapsed / args.messages * 1e6:8.2f}us/msg '
+              f'delivered={delivered}')
+
+    dispatcher.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+报单发送路径中order_original_id/request_id生成的开销
+
+legacy: 按'_order_id_{n}'拼接属性名并getattr/setattr递增, request_id使用uuid1
+cursor: IDCursor整数递增(按段预留并持久化), request_id为前缀+递增序号
+
+每组--basket笔委托, 依次生成order_id与request_id后经Trader.place_order
+(柜台接口为空操作)发出, 输出每笔平均耗时
+
+python benchmarks/bench_order_send.py --basket 500
+"""
+
+import os
+import time
+import uuid
+import logging
+import argparse
+import tempfile
+
+from fast_trader.dtp_trade import Trader, dtp_type
+from fast_trader.id_pool import _id_pool, IDCursor, IDCursorStore
+
+
+class _NullTradeApi:
+
+    def place_order(self, order_req):
+        pass
+
+    def place_batch_order(self, batch_order_req, account_no):
+        pass
+
+
+class LegacyTrader(Trader):
+    """
+    改动前的编号生成方式
+    """
+
+    def set_initial_id(self, strategy_id, initial_id):
+        setattr(self, '_order_id_{}'.format(strategy_id), initial_id)
+
+    def generate_request_id(self, number=1):
+        request_id = str(uuid.uuid1())
+        return request_id
+
+    def generate_order_id(self, number):
+        name = '{}_{}'.format('_order_id', number)
+
+        order_id = getattr(self, name)
+        setattr(self, name, order_id + 1)
+        return str(order_id)
+
+
+def make_traders(strategy_id, db_path):
+    id_range = _id_pool.get_strategy_range_per_trader(strategy_id, 0)
+
+    legacy = LegacyTrader(trade_api=_NullTradeApi())
+    legacy.set_initial_id(strategy_id, id_range[0])
+
+    trader = Trader(trade_api=_NullTradeApi())
+    trader._order_id_cursors[strategy_id] = IDCursor(
+        id_range, IDCursorStore(db_path), (strategy_id, 0, 'bench'))
+    return [('legacy', legacy), ('cursor', trader)]
+
+
+def run_ids(trader, strategy_id, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        trader.generate_order_id(strategy_id)
+        trader.generate_request_id()
+    return (time.perf_counter() - t0) / n
+
+
+def run_send(trader, strategy_id, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        trader.generate_request_id()
+        trader.place_order(
+            code='600000', price='10.5', quantity=100,
+            order_side=dtp_type.ORDER_SIDE_BUY,
+            order_original_id=trader.generate_order_id(strategy_id),
+            exchange=dtp_type.EXCHANGE_SH_A,
+            order_type=dtp_type.ORDER_TYPE_LIMIT)
+    return (time.perf_counter() - t0) / n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--basket', type=int, default=500)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    # 与生产一致时报单日志会写文件, 此处只比较编号生成本身
+    logging.getLogger('trader').setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        traders = make_traders(1, os.path.join(tmp, 'id_cursor.db'))
+        for label, run in [('ids only', run_ids), ('place_order', run_send)]:
+            for name, trader in traders:
+                costs = [run(trader, 1, args.basket)
+                         for _ in range(args.rounds)]
+                print(f'{label:<12} {name:<7} '
+                      f'{min(costs) * 1e6:6.2f}us/order')
+
+
+if __name__ == '__main__':
+    main()
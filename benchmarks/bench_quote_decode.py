@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+行情解码吞吐量(单核 msgs/s)
+
+legacy: json + attrdict + standardize
+decoder: QuoteDecoder(orjson如已安装) + QuoteRecord
+
+批量转换(回放/录制场景):
+standardize: 逐条调用standardize
+standardize_many: 按字段批量转换
+to_columns: 转换为numpy列式数据
+
+python benchmarks/bench_quote_decode.py
+"""
+
+import json
+import time
+import argparse
+
+from fast_trader.dtp_quote import (FEED_TYPE_NAME_MAPPING, QuoteDecoder,
+                                   orjson)
+from fast_trader.utils import attrdict
+
+
+# 各类行情中除int64字段外的其他字段
+EXTRA_FIELDS = {
+    'tick_feed': ['szWindCode', 'szCode', 'nActionDay', 'nTradingDay',
+                  'nTime', 'nStatus', 'nNumTrades', 'nSyl1', 'nSyl2',
+                  'nSD2', 'szPrefix', 'nIOPV', 'nYieldToMaturity'],
+    'trade_feed': ['szWindCode', 'szCode', 'nActionDay', 'nTime',
+                   'nIndex', 'nVolume', 'nBSFlag', 'chOrderKind',
+                   'chFunctionCode', 'nAskOrder', 'nBidOrder'],
+    'order_feed': ['szWindCode', 'szCode', 'nActionDay', 'nTime',
+                   'nOrder', 'nVolume', 'chOrderKind', 'chFunctionCode'],
+    'index_feed': ['szWindCode', 'szCode', 'nActionDay', 'nTradingDay',
+                   'nTime'],
+}
+
+
+def make_message(api_id):
+    feed_type = FEED_TYPE_NAME_MAPPING[api_id]
+    content = {}
+    for field in EXTRA_FIELDS[api_id]:
+        content[field] = '600000.SH' if field.startswith('sz') else 93000000
+    for i, field in enumerate(feed_type.int64_fields):
+        content[field] = str(100000 + i)
+    msg = {'api_id': api_id, 'api_type': 'rsp',
+           'handler_id': 'quote_feed', 'content': content}
+    return json.dumps(msg).encode()
+
+
+def legacy_decode(raw):
+    mail = attrdict(json.loads(raw))
+    feed_type = FEED_TYPE_NAME_MAPPING[mail['api_id']]
+    mail['content'] = feed_type.standardize(mail['content'])
+    return mail
+
+
+def run(func, raw, count):
+    t0 = time.perf_counter()
+    for _ in range(count):
+        func(raw)
+    return count / (time.perf_counter() - t0)
+
+
+def run_batch(func, items, repeat):
+    # standardize会原地修改数据, 预先拷贝
+    batches = [[dict(d) for d in items] for _ in range(repeat)]
+    t0 = time.perf_counter()
+    for batch in batches:
+        func(batch)
+    return len(items) * repeat / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=50000)
+    parser.add_argument('--batch', type=int, default=5000)
+    args = parser.parse_args()
+
+    print(f'orjson: {"yes" if orjson is not None else "no"}')
+    decoder = QuoteDecoder()
+    for api_id in EXTRA_FIELDS:
+        raw = make_message(api_id)
+        legacy = run(legacy_decode, raw, args.count)
+        fast = run(decoder.decode, raw, args.count)
+        print(f'{api_id:<11} legacy {legacy:>10,.0f}/s  '
+              f'decoder {fast:>10,.0f}/s  x{fast / legacy:.2f}')
+
+    print()
+    for api_id in EXTRA_FIELDS:
+        feed_type = FEED_TYPE_NAME_MAPPING[api_id]
+        items = [json.loads(make_message(api_id))['content']] * args.batch
+        repeat = max(1, args.count // args.batch)
+
+        def one_by_one(batch):
+            return [feed_type.standardize(d) for d in batch]
+
+        single = run_batch(one_by_one, items, repeat)
+        many = run_batch(feed_type.standardize_many, items, repeat)
+        columns = run_batch(feed_type.to_columns, items, repeat)
+        print(f'{api_id:<11} standardize {single:>10,.0f}/s  '
+              f'standardize_many {many:>10,.0f}/s  '
+              f'to_columns {columns:>10,.0f}/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+多进程部署下策略处理吞吐量
+
+行情进程运行QuoteHub, 转发本地模拟的快照行情; 共--strategies个策略,
+每个策略处理每条行情耗时约--work-us微秒, 平均分配到--procs个策略进程中。
+输出所有策略合计每秒处理的行情条数, 及QuoteHub转发速率
+
+python benchmarks/bench_quote_hub.py --strategies 8 --procs 1 2 4 8
+"""
+
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+
+import zmq
+
+from fast_trader.dtp_quote import TickFeed
+from fast_trader.quote_hub import QuoteHub, RemoteQuoteFeed
+from fast_trader import zmq_context
+
+
+class _LocalQuoteFeed:
+
+    def __init__(self, port):
+        self.port = port
+
+    def _get_bound_port(self):
+        return self.port
+
+    def start(self, recv=True):
+        pass
+
+    def subscribe(self, feed_name, codes):
+        pass
+
+    def subscribe_all(self, feed_name):
+        pass
+
+    def unsubscribe(self, feed_name, codes):
+        pass
+
+
+def make_messages(count):
+    messages = []
+    for i in range(count):
+        content = {'szCode': str(600000 + i % 500), 'nTime': 93000000}
+        for field in TickFeed.int64_fields:
+            content[field] = str(100000 + i % 97)
+        messages.append(json.dumps({
+            'api_id': 'tick_feed', 'api_type': 'rsp',
+            'handler_id': 'quote_feed', 'content': content}).encode())
+    return messages
+
+
+def worker(address, n_strategies, work_us, duration, results):
+    counter = [0]
+    work = work_us / 1e6
+
+    def on_quote(mail):
+        for _ in range(n_strategies):
+            mail.content.get('nMatch')
+            deadline = time.perf_counter() + work
+            while time.perf_counter() < deadline:
+                pass
+        counter[0] += 1
+
+    feed = RemoteQuoteFeed(address)
+    feed.add_callback(on_quote)
+    feed.subscribe_all('tick_feed')
+    feed.start()
+
+    time.sleep(1)
+    start = counter[0]
+    time.sleep(duration)
+    results.put((counter[0] - start) * n_strategies / duration)
+
+
+def run(address, procs, n_strategies, work_us, duration):
+    # 与实际部署一致, 策略进程不继承行情进程的zmq context与线程
+    mp = multiprocessing.get_context('spawn')
+    results = mp.Queue()
+    workers = [
+        mp.Process(
+            target=worker,
+            args=(address, n_strategies // procs, work_us, duration, results),
+            daemon=True)
+        for _ in range(procs)]
+    for p in workers:
+        p.start()
+    rate = sum(results.get() for _ in workers)
+    for p in workers:
+        p.terminate()
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--strategies', type=int, default=8)
+    parser.add_argument('--procs', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--work-us', type=float, default=50)
+    parser.add_argument('--duration', type=float, default=3)
+    parser.add_argument('--address', default='tcp://127.0.0.1:5599')
+    args = parser.parse_args()
+
+    ctx = zmq_context.manager.context
+    upstream = ctx.socket(zmq.PUB)
+    port = upstream.bind_to_random_port('tcp://127.0.0.1')
+
+    hub = QuoteHub(_LocalQuoteFeed(port), address=args.address)
+    hub.start()
+
+    messages = make_messages(5000)
+
+    for procs in args.procs:
+        if args.strategies % procs:
+            continue
+        result = []
+        runner = threading.Thread(target=lambda: result.append(run(
+            args.address, procs, args.strategies,
+            args.work_us, args.duration)))
+        runner.start()
+
+        published = hub.published
+        t0 = time.perf_counter()
+        i = 0
+        while runner.is_alive():
+            upstream.send(messages[i % len(messages)])
+            i += 1
+            if i % 1000 == 0:
+                # 避免超过QuoteHub的处理能力
+                time.sleep(0.01)
+        elapsed = time.perf_counter() - t0
+
+        print(f'procs={procs:<3} strategies={args.strategies} '
+              f'strategy msgs/s {result[0]:>10,.0f}  '
+              f'hub {(hub.published - published) / elapsed:>8,.0f}/s')
+
+    hub.stop()
+    hub.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,536 @@
+# -*- coding: utf-8 -*-
+"""
+基于asyncio的运行时
+
+行情与柜台回报的zmq SUB socket由`zmq.asyncio`在同一个事件循环中读取,
+消息分发、定时任务(`loop.call_at`)与策略回调均在该循环中执行,
+不再需要分发线程、接收线程与心跳线程。
+
+`AsyncStrategy`的回调可定义为`async def`, 每个策略的消息仍按顺序处理,
+某个策略在`await`期间不影响其他策略; 资金、委托等查询另有通过线程池执行
+的协程版本, 以`await self.aget_capital()`的方式调用。
+原有的同步`Strategy`可直接运行在`AsyncStrategyFactory`之上。
+
+    factory = AsyncStrategyFactory()
+    strategy = factory.generate_strategy(MyStrategy, 1, account_no)
+    strategy.start()
+    factory.run_forever()
+"""
+
+import json
+import time
+import asyncio
+import datetime
+import inspect
+import logging
+import functools
+import collections
+import concurrent.futures
+
+import zmq
+import zmq.asyncio
+
+from fast_trader.dtp_trade import DTP, TimerTask
+from fast_trader.metrics import LatencyHistogram
+from fast_trader.settings import settings
+from fast_trader.strategy import (Strategy, StrategyFactory, QuoteFeed,
+                                  Market)
+from fast_trader.utils import attrdict
+
+
+def _running_loop():
+    """
+    当前线程中正在运行的事件循环, 无则返回None
+    """
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def _call_soon(loop, callback, *args):
+    """
+    在事件循环中执行callback; 已在该循环中时不经过线程间唤醒
+    """
+    if _running_loop() is loop:
+        loop.call_soon(callback, *args)
+    else:
+        loop.call_soon_threadsafe(callback, *args)
+
+
+class AsyncTimer:
+    """
+    定时任务, 接口与`Timer`一致
+
+    TimerTask的到期时间以`time.monotonic()`计, 与事件循环的`loop.time()`
+    相同, 直接用于`loop.call_at`
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.logger = logging.getLogger('dispatcher')
+        # task -> asyncio.TimerHandle
+        self._handles = {}
+
+    @property
+    def tasks(self):
+        return list(self._handles)
+
+    def add_task(self, task):
+        _call_soon(self.loop, self._schedule, task)
+
+    def remove_task(self, task):
+        task.cancel()
+        _call_soon(self.loop, self._unschedule, task)
+
+    def _schedule(self, task):
+        if task.is_finished():
+            return
+        self._handles[task] = self.loop.call_at(
+            task.deadline, self._run, task)
+
+    def _unschedule(self, task):
+        handle = self._handles.pop(task, None)
+        if handle is not None:
+            handle.cancel()
+
+    def _run(self, task):
+        self._handles.pop(task, None)
+        if task.is_finished():
+            return
+        try:
+            task.execute(now=self.loop.time())
+        except Exception as e:
+            self.logger.error(str(e), exc_info=True)
+        if not task.is_finished():
+            self._schedule(task)
+
+
+class AsyncDispatcher:
+    """
+    消息分发, 接口与`Dispatcher`一致
+
+    所有消息在事件循环中按到达顺序分发, 其他线程调用`put`时经
+    `call_soon_threadsafe`转入事件循环
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.new_event_loop()
+        self.timer = AsyncTimer(self.loop)
+        self.logger = logging.getLogger('dispatcher')
+
+        self._handlers = {}
+        self._tasks = set()
+        self._service_suspended = False
+
+        self.dispatched = 0
+
+    def start(self):
+        pass
+
+    def join(self):
+        pass
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def spawn(self, coro):
+        """
+        在事件循环中运行协程, 可在任意线程中调用
+        """
+        def _create():
+            task = self.loop.create_task(coro)
+            self._tasks.add(task)
+            task.add_done_callback(self._on_task_done)
+
+        _call_soon(self.loop, _create)
+
+    def _on_task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.error(
+                str(task.exception()), exc_info=task.exception())
+
+    def bind(self, handler_id, handler, override=False):
+        if not override and handler_id in self._handlers:
+            if handler == self._handlers[handler_id]:
+                return
+            raise KeyError(
+                'handler {} already exists!'.format(handler_id))
+        self._handlers[handler_id] = handler
+
+    def suspend(self):
+        self._service_suspended = True
+        self.logger.warning('Mail service is currently suspended.')
+
+    def resume(self):
+        self._service_suspended = False
+
+    def put(self, mail):
+        if self._service_suspended:
+            return
+
+        if mail.get('sync'):
+            return self.dispatch(mail)
+
+        _call_soon(self.loop, self._dispatch_safely, mail)
+
+    def _dispatch_safely(self, mail):
+        try:
+            self.dispatch(mail)
+        except Exception as e:
+            self.logger.error(str(e), exc_info=True)
+
+    def dispatch(self, mail):
+        self.dispatched += 1
+        handler_id = mail['handler_id']
+        if handler_id in self._handlers:
+            return self._handlers[handler_id](mail)
+
+    def get_stats(self):
+        return {
+            'dispatched': self.dispatched,
+            'tasks': len(self._tasks),
+            'timer_tasks': len(self.timer.tasks),
+        }
+
+
+async def _iter_socket(sock, batch_size=256):
+    """
+    逐条读取SUB socket, 每处理batch_size条主动让出一次事件循环,
+    避免行情密集时其他socket与回调得不到执行
+    """
+    n = 0
+    while True:
+        yield await sock.recv()
+        n += 1
+        if n >= batch_size:
+            n = 0
+            await asyncio.sleep(0)
+
+
+class AsyncQuoteFeed(QuoteFeed):
+    """
+    在事件循环中接收行情的`QuoteFeed`
+    """
+
+    def __init__(self, dispatcher):
+        super().__init__()
+        self.dispatcher = dispatcher
+
+    def start(self, recv=True):
+        super().start(recv=False)
+        if recv:
+            self.dispatcher.spawn(self._recv_async())
+
+    async def _recv_async(self):
+        ctx = zmq.asyncio.Context.instance()
+        sock = ctx.socket(zmq.SUB)
+        port = self._get_bound_port()
+        sock.connect(f'tcp://127.0.0.1:{port}')
+        sock.subscribe('')
+
+        callbacks = self._callbacks
+        make_mail = self._get_mail_maker()
+        try:
+            async for raw in _iter_socket(sock):
+                mail = make_mail(raw)
+                if mail is None:
+                    continue
+                for cb in callbacks.values():
+                    cb(mail)
+        finally:
+            sock.close(linger=0)
+
+
+class AsyncDTP(DTP):
+    """
+    在事件循环中接收柜台回报的`DTP`
+
+    报单、撤单请求交由单个后台线程依次发送, 不阻塞事件循环,
+    且保持请求顺序
+    """
+
+    def __init__(self, dispatcher):
+        super().__init__(dispatcher)
+        self._req_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='dtp_req')
+
+    def start_counter_report(self):
+        self.start()
+        self.dispatcher.spawn(self._recv_async())
+
+    async def _recv_async(self):
+        ctx = zmq.asyncio.Context.instance()
+        sock = ctx.socket(zmq.SUB)
+        port = self._get_bound_port()
+        sock.connect(f'tcp://127.0.0.1:{port}')
+        sock.subscribe('')
+
+        try:
+            async for raw in _iter_socket(sock):
+                self.dispatcher.put(attrdict(json.loads(raw)))
+        finally:
+            sock.close(linger=0)
+
+    def _submit(self, func, *args):
+        future = self._req_executor.submit(func, *args)
+        future.add_done_callback(self._on_req_done)
+        return future
+
+    def _on_req_done(self, future):
+        if future.exception() is not None:
+            self.logger.error(
+                str(future.exception()), exc_info=future.exception())
+
+    def place_order(self, order_req):
+        self._submit(super().place_order, order_req)
+
+    def place_batch_order(self, batch_order_req, account_no):
+        self._submit(super().place_batch_order, batch_order_req, account_no)
+
+    def cancel_order(self, order_cancelation_req):
+        self._submit(super().cancel_order, order_cancelation_req)
+
+
+class AsyncMailbox:
+    """
+    `AsyncStrategy`的消息队列, 由事件循环中的单个协程依次处理,
+    接口与`StrategyMailbox`一致
+
+    回调返回协程或产生了待执行的`async def`回调时, 等待其完成后再
+    处理下一条消息
+    """
+
+    _STOP = object()
+
+    def __init__(self, strategy, name=''):
+        self.strategy = strategy
+        self.name = name
+        self._queue = asyncio.Queue()
+        self._running = False
+        # 正在处理消息, 期间产生的协程回调由本mailbox依次await
+        self.pumping = False
+        self.logger = logging.getLogger('dispatcher')
+
+        self.handler_time = LatencyHistogram(f'{name}.handler')
+        self.processed = 0
+        self.errors = 0
+        self.max_depth = 0
+
+    @property
+    def dispatcher(self):
+        return self.strategy.trader.dispatcher
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self.dispatcher.spawn(self._run())
+
+    def stop(self, wait=False):
+        if self._running:
+            self.put(self._STOP)
+            self._running = False
+
+    def put(self, func, *args):
+        loop = self.dispatcher.loop
+        if _running_loop() is loop:
+            self._put(func, args)
+        else:
+            loop.call_soon_threadsafe(self._put, func, args)
+
+    def _put(self, func, args):
+        q = self._queue
+        q.put_nowait((func, args))
+        depth = q.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    async def _run(self):
+        q = self._queue
+        pending = self.strategy._pending
+        hist = self.handler_time
+        perf_counter = time.perf_counter
+
+        while True:
+            func, args = await q.get()
+            if func is self._STOP:
+                break
+            t0 = perf_counter()
+            self.pumping = True
+            try:
+                ret = func(*args)
+                if inspect.isawaitable(ret):
+                    await ret
+                while pending:
+                    await pending.popleft()
+            except Exception as e:
+                self.errors += 1
+                self.logger.error(str(e), exc_info=True)
+                while pending:
+                    pending.popleft().close()
+            finally:
+                self.pumping = False
+            hist.record(perf_counter() - t0)
+            self.processed += 1
+
+    def get_stats(self):
+        return {
+            'depth': self.qsize(),
+            'max_depth': self.max_depth,
+            'processed': self.processed,
+            'errors': self.errors,
+            'handler_time': self.handler_time.to_dict(),
+        }
+
+
+class AsyncStrategy(Strategy):
+    """
+    支持`async def`回调的策略
+
+    `on_`开头的回调(on_market_snapshot, on_trade, on_order...)可定义为
+    协程, 在策略自身的`AsyncMailbox`中按消息顺序依次执行; 在mailbox
+    处理消息之外调用时(如停止策略时)直接在事件循环中执行。
+    get_capital, get_orders, get_open_orders, get_trades, cancel_all
+    与`Strategy`一致为同步调用, 会阻塞事件循环; 协程回调中应使用
+    aget_capital, aget_orders, aget_open_orders, aget_trades, acancel_all,
+    其中的柜台查询在线程池中执行。报单、撤单接口保持同步调用,
+    请求由后台线程发送。
+    """
+
+    def __init__(self, strategy_id, account_no, persistent=True):
+        super().__init__(strategy_id, account_no, persistent=persistent)
+
+        # 当前消息产生的待执行协程, 由AsyncMailbox依次await
+        self._pending = collections.deque()
+        for name in dir(type(self)):
+            if name.startswith('on_'):
+                hook = getattr(self, name)
+                if inspect.iscoroutinefunction(hook):
+                    setattr(self, name, self._defer(hook))
+
+        self.enable_mailbox()
+
+    def _defer(self, hook):
+        pending = self._pending
+
+        @functools.wraps(hook)
+        def wrapper(*args, **kw):
+            coro = hook(*args, **kw)
+            mailbox = self._mailbox
+            loop = self.trader.dispatcher.loop
+            if mailbox is not None and mailbox.pumping and \
+                    _running_loop() is loop:
+                pending.append(coro)
+            else:
+                # 不在mailbox处理消息期间调用, 如停止策略时的on_stop
+                self._run_detached(coro)
+
+        return wrapper
+
+    def _run_detached(self, coro):
+        """
+        在事件循环中执行协程; 事件循环已停止时在当前线程中执行完毕
+        """
+        dispatcher = self.trader.dispatcher
+        loop = dispatcher.loop
+        if loop.is_running():
+            dispatcher.spawn(coro)
+        elif not loop.is_closed() and _running_loop() is None:
+            try:
+                loop.run_until_complete(coro)
+            except Exception as e:
+                self.logger.error(str(e), exc_info=True)
+        else:
+            coro.close()
+            self.logger.warning(
+                f'事件循环已关闭, 未执行回调 {coro.__qualname__}')
+
+    def enable_mailbox(self):
+        if self._mailbox is None:
+            self._mailbox = AsyncMailbox(
+                self, name=f'{self.get_strategy_name()}_{self.strategy_id}')
+
+    def _start_heartbeat(self):
+        # 心跳写入数据库, 在线程池中执行
+        dispatcher = self.trader.dispatcher
+
+        future = None
+
+        def _beat():
+            nonlocal future
+            if not self._started:
+                self._heartbeat_task.cancel()
+            elif future is None or future.done():
+                # 上一次心跳尚未完成时跳过, session不在线程间并发使用
+                future = dispatcher.loop.run_in_executor(
+                    None, self._heartbeat_once)
+
+        self._heartbeat_task = TimerTask(
+            datetime.timedelta(seconds=0.5), _beat)
+        dispatcher.timer.add_task(self._heartbeat_task)
+
+    async def _run_in_executor(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(func, self, *args))
+
+    async def aget_capital(self):
+        """
+        查询资金
+        """
+        return await self._run_in_executor(Strategy.get_capital)
+
+    async def aget_orders(self):
+        return await self._run_in_executor(Strategy.get_orders)
+
+    async def aget_open_orders(self):
+        return await self._run_in_executor(Strategy.get_open_orders)
+
+    async def aget_trades(self):
+        return await self._run_in_executor(Strategy.get_trades)
+
+    async def acancel_all(self, **kw):
+        orders = await self.aget_open_orders()
+        for order in orders:
+            self.cancel_order(**order)
+
+
+class AsyncStrategyFactory(StrategyFactory):
+    """
+    在单个事件循环中运行所有策略
+    """
+
+    def __init__(self, trader_id=0, factory_settings=None, loop=None):
+
+        if factory_settings is not None:
+            settings.set(factory_settings)
+
+        self.trader_id = trader_id
+
+        self.loop = loop or asyncio.new_event_loop()
+        self.dispatcher = AsyncDispatcher(self.loop)
+
+        # dtp通道
+        self.dtp = AsyncDTP(self.dispatcher)
+
+        # 行情通道
+        self.market = Market(
+            self.dispatcher, quote_feed=AsyncQuoteFeed(self.dispatcher))
+
+        self.traders = {}
+
+    def run_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self):
+        self.dispatcher.stop()
@@ -1,141 +1,429 @@
 # -*- coding: utf-8 -*-
 
+import json
+import operator
+import itertools
+from array import array
 
-class MarketFeed:
-    pass
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+from fast_trader.utils import attrdict
 
-class TradeFeed(MarketFeed):
+
+if orjson is not None:
+    loads = orjson.loads
+else:
+    loads = json.loads
+
+
+class QuoteRecord:
     """
-    逐笔成交
+    标准化后的行情数据
+
+    按消息字段动态生成带`__slots__`的子类, 字段名与原始推送一致
+    (`szCode`, `nMatch`, `nAskPrice_0`...), 支持属性与下标两种访问方式
     """
-    name = 'trade_feed'
+
+    __slots__ = ()
+
+    _fields = ()
+    _field_set = frozenset()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self._field_set
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self._fields
+
+    def values(self):
+        return [getattr(self, k) for k in self._fields]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self._fields]
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self._fields}
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()})'
+
+
+class OrderBook:
+    """
+    盘口快照
+
+    由快照行情的十档买卖盘生成, 价格与数量分别存放于定长数组中,
+    `mid`, `spread`, `microprice`及累计挂单量在构造时一次算好。
+    无挂单的档位价格与数量均为0, 单边无挂单时`mid`等为None
+    """
+
+    __slots__ = ('ask_prices', 'ask_vols', 'bid_prices', 'bid_vols',
+                 'ask_depth', 'bid_depth', 'mid', 'spread', 'microprice')
+
+    LEVELS = 10
+
+    ASK_PRICE_FIELDS = tuple(f'nAskPrice_{i}' for i in range(LEVELS))
+    ASK_VOL_FIELDS = tuple(f'nAskVol_{i}' for i in range(LEVELS))
+    BID_PRICE_FIELDS = tuple(f'nBidPrice_{i}' for i in range(LEVELS))
+    BID_VOL_FIELDS = tuple(f'nBidVol_{i}' for i in range(LEVELS))
+
+    _FIELDS = ASK_PRICE_FIELDS + ASK_VOL_FIELDS + \
+        BID_PRICE_FIELDS + BID_VOL_FIELDS
+    _get_items = operator.itemgetter(*_FIELDS)
+    _get_attrs = operator.attrgetter(*_FIELDS)
+
+    def __init__(self, ask_prices, ask_vols, bid_prices, bid_vols):
+        self.ask_prices = array('d', ask_prices)
+        self.ask_vols = array('q', ask_vols)
+        self.bid_prices = array('d', bid_prices)
+        self.bid_vols = array('q', bid_vols)
+
+        self.ask_depth = array('q', itertools.accumulate(self.ask_vols))
+        self.bid_depth = array('q', itertools.accumulate(self.bid_vols))
+
+        ask, bid = self.ask_prices[0], self.bid_prices[0]
+        ask_vol, bid_vol = self.ask_vols[0], self.bid_vols[0]
+        if ask > 0 and bid > 0:
+            self.mid = (ask + bid) / 2
+            self.spread = ask - bid
+            if ask_vol + bid_vol > 0:
+                # 以对手方挂单量加权, 买盘越厚越接近卖一价
+                self.microprice = \
+                    (bid * ask_vol + ask * bid_vol) / (ask_vol + bid_vol)
+            else:
+                self.microprice = self.mid
+        else:
+            self.mid = self.spread = self.microprice = None
 
     @classmethod
-    def get_int64_fields(cls):
-        return ['nPrice', 'nTurnover']
-                
-    @classmethod
-    def standardize(cls, data):
-        price_fields = ['nPrice']
+    def from_snapshot(cls, data):
+        """
+        由标准化后的快照行情(dict或QuoteRecord)生成
+        """
+        if isinstance(data, dict):
+            values = cls._get_items(data)
+        else:
+            values = cls._get_attrs(data)
+        n = cls.LEVELS
+        return cls(values[:n], values[n:2 * n],
+                   values[2 * n:3 * n], values[3 * n:])
+
+    @property
+    def best_ask(self):
+        return self.ask_prices[0]
+
+    @property
+    def best_bid(self):
+        return self.bid_prices[0]
+
+    @property
+    def total_ask_vol(self):
+        return self.ask_depth[-1]
+
+    @property
+    def total_bid_vol(self):
+        return self.bid_depth[-1]
+
+    def imbalance(self, levels=1):
+        """
+        前levels档买卖挂单量不平衡度, (bid - ask) / (bid + ask)
+        """
+        bid = self.bid_depth[levels - 1]
+        ask = self.ask_depth[levels - 1]
+        if bid + ask == 0:
+            return 0.
+        return (bid - ask) / (bid + ask)
+
+    def __repr__(self):
+        return (f'<OrderBook bid={self.best_bid} ask={self.best_ask} '
+                f'mid={self.mid} spread={self.spread}>')
+
+
+class TickRecord(QuoteRecord):
+    """
+    快照行情数据, 额外提供`book`盘口视图
 
-        for field in cls.get_int64_fields():
-            data[field] = int(data[field])
-        for field in price_fields:
-            data[field] = data[field] / 10000
-        return data
-        
+    `book`首次访问时生成并缓存, 不使用的策略没有额外开销;
+    生成后修改盘口字段不会反映到已缓存的`book`上
+    """
 
+    __slots__ = ('_book',)
 
-class IndexFeed(MarketFeed):
+    @property
+    def book(self):
+        try:
+            return self._book
+        except AttributeError:
+            book = self._book = OrderBook.from_snapshot(self)
+            return book
+
+
+class TickDict(attrdict):
     """
-    指数行情
+    attrdict格式的快照行情, 与`TickRecord`一样提供缓存的`book`
     """
-    name = 'index_feed'
+
+    __slots__ = ('_book',)
+
+    @property
+    def book(self):
+        try:
+            return self._book
+        except AttributeError:
+            book = OrderBook.from_snapshot(self)
+            object.__setattr__(self, '_book', book)
+            return book
+
+    def copy(self):
+        return TickDict(self)
+
+    def __reduce__(self):
+        return TickDict, (dict(self),)
+
+
+class MarketFeed:
+    name = ''
+    # 快照类行情只需保留每个代码的最新一条, 积压时可合并
+    conflatable = False
+    # 以字符串推送的int64字段
+    int64_fields = ()
+    # 价格字段, 推送值为实际价格 * PRICE_SCALE
+    price_fields = ()
+    PRICE_SCALE = 10000
+    # 解码后的行情数据类型
+    record_base = QuoteRecord
+    # 未启用快速解码时的行情数据类型
+    dict_base = attrdict
 
     @classmethod
     def get_int64_fields(cls):
-        return [
-            'nOpenIndex', 'nHighIndex', 'nLowIndex',
-            'nLastIndex', 'iTotalVolume', 'iTurnover',
-            'nPreCloseIndex']
+        return list(cls.int64_fields)
+
+    @classmethod
+    def get_plan(cls):
+        """
+        字段转换计划, 每个类只生成一次
+
+        ((field, scale), ...), scale为None的字段只做int转换
+        """
+        plan = cls.__dict__.get('_plan')
+        if plan is None:
+            prices = set(cls.price_fields)
+            plan = tuple(
+                (field, cls.PRICE_SCALE if field in prices else None)
+                for field in cls.int64_fields)
+            cls._plan = plan
+        return plan
 
     @classmethod
     def standardize(cls, data):
-        price_fields = [
-            'nOpenIndex', 'nHighIndex', 'nLowIndex',
-            'nLastIndex', 'nPreCloseIndex']
-
-        for field in cls.get_int64_fields():
-            data[field] = int(data[field])
-        for field in price_fields:
-            data[field] = data[field] / 10000
+        for field, scale in cls.get_plan():
+            if scale is None:
+                data[field] = int(data[field])
+            else:
+                data[field] = int(data[field]) / scale
         return data
 
+    @classmethod
+    def standardize_many(cls, items):
+        """
+        批量转换, 逐字段处理整批数据(原地修改)
+        """
+        for field, scale in cls.get_plan():
+            if scale is None:
+                for data in items:
+                    data[field] = int(data[field])
+            else:
+                for data in items:
+                    data[field] = int(data[field]) / scale
+        return items
+
+    @classmethod
+    def to_columns(cls, items, fields=None, standardized=False):
+        """
+        批量转换为列式数据
+
+        Parameters
+        ----------
+        items: list
+            原始推送数据(dict), 或已转换的数据(standardized=True)
+        fields: list
+            输出字段, 默认为第一条数据的全部字段
+
+        Returns
+        ----------
+        ret: dict
+            field -> numpy.ndarray, int64字段为int64, 价格字段为float64
+        """
+        import numpy as np
+
+        if fields is None:
+            fields = list(items[0].keys()) if len(items) else []
+        conv = dict(cls.get_plan())
+
+        columns = {}
+        for field in fields:
+            values = [data[field] for data in items]
+            if field not in conv:
+                columns[field] = np.array(values)
+            elif standardized:
+                dtype = np.int64 if conv[field] is None else np.float64
+                columns[field] = np.array(values, dtype=dtype)
+            else:
+                col = np.array(values, dtype=np.int64)
+                if conv[field] is not None:
+                    col = col / conv[field]
+                columns[field] = col
+        return columns
+
+    @classmethod
+    def to_structured_array(cls, items, fields=None, standardized=False):
+        """
+        批量转换为numpy结构化数组, 参数同`to_columns`
+        """
+        import numpy as np
+
+        columns = cls.to_columns(items, fields, standardized=standardized)
+        dtype = [(field, col.dtype) for field, col in columns.items()]
+        arr = np.empty(len(items), dtype=dtype)
+        for field, col in columns.items():
+            arr[field] = col
+        return arr
+
+
+class TradeFeed(MarketFeed):
+    """
+    逐笔成交
+    """
+    name = 'trade_feed'
+
+    int64_fields = ('nPrice', 'nTurnover')
+    price_fields = ('nPrice',)
+
+
+class IndexFeed(MarketFeed):
+    """
+    指数行情
+    """
+    name = 'index_feed'
+    conflatable = True
+
+    int64_fields = (
+        'nOpenIndex', 'nHighIndex', 'nLowIndex',
+        'nLastIndex', 'iTotalVolume', 'iTurnover',
+        'nPreCloseIndex')
+    price_fields = (
+        'nOpenIndex', 'nHighIndex', 'nLowIndex',
+        'nLastIndex', 'nPreCloseIndex')
+
 
 class TickFeed(MarketFeed):
     """
     快照行情
     """
     name = 'tick_feed'
-    
-    @classmethod
-    def get_int64_fields(cls):
-        return [
-            'nPreClose',
-            'nOpen',
-            'nHigh',
-            'nLow',
-            'nMatch',
-            'nAskPrice_0',
-            'nAskPrice_1',
-            'nAskPrice_2',
-            'nAskPrice_3',
-            'nAskPrice_4',
-            'nAskPrice_5',
-            'nAskPrice_6',
-            'nAskPrice_7',
-            'nAskPrice_8',
-            'nAskPrice_9',
-            'nAskVol_0',
-            'nAskVol_1',
-            'nAskVol_2',
-            'nAskVol_3',
-            'nAskVol_4',
-            'nAskVol_5',
-            'nAskVol_6',
-            'nAskVol_7',
-            'nAskVol_8',
-            'nAskVol_9',
-            'nBidPrice_0',
-            'nBidPrice_1',
-            'nBidPrice_2',
-            'nBidPrice_3',
-            'nBidPrice_4',
-            'nBidPrice_5',
-            'nBidPrice_6',
-            'nBidPrice_7',
-            'nBidPrice_8',
-            'nBidPrice_9',
-            'nBidVol_0',
-            'nBidVol_1',
-            'nBidVol_2',
-            'nBidVol_3',
-            'nBidVol_4',
-            'nBidVol_5',
-            'nBidVol_6',
-            'nBidVol_7',
-            'nBidVol_8',
-            'nBidVol_9',
-            'iVolume',
-            'iTurnover',
-            'nTotalBidVol',
-            'nTotalAskVol',
-            'nWeightedAvgBidPrice',
-            'nWeightedAvgAskPrice',
-            'nHighLimited',
-            'nLowLimited']
+    conflatable = True
+    record_base = TickRecord
+    dict_base = TickDict
+
+    int64_fields = (
+        'nPreClose',
+        'nOpen',
+        'nHigh',
+        'nLow',
+        'nMatch',
+        'nAskPrice_0',
+        'nAskPrice_1',
+        'nAskPrice_2',
+        'nAskPrice_3',
+        'nAskPrice_4',
+        'nAskPrice_5',
+        'nAskPrice_6',
+        'nAskPrice_7',
+        'nAskPrice_8',
+        'nAskPrice_9',
+        'nAskVol_0',
+        'nAskVol_1',
+        'nAskVol_2',
+        'nAskVol_3',
+        'nAskVol_4',
+        'nAskVol_5',
+        'nAskVol_6',
+        'nAskVol_7',
+        'nAskVol_8',
+        'nAskVol_9',
+        'nBidPrice_0',
+        'nBidPrice_1',
+        'nBidPrice_2',
+        'nBidPrice_3',
+        'nBidPrice_4',
+        'nBidPrice_5',
+        'nBidPrice_6',
+        'nBidPrice_7',
+        'nBidPrice_8',
+        'nBidPrice_9',
+        'nBidVol_0',
+        'nBidVol_1',
+        'nBidVol_2',
+        'nBidVol_3',
+        'nBidVol_4',
+        'nBidVol_5',
+        'nBidVol_6',
+        'nBidVol_7',
+        'nBidVol_8',
+        'nBidVol_9',
+        'iVolume',
+        'iTurnover',
+        'nTotalBidVol',
+        'nTotalAskVol',
+        'nWeightedAvgBidPrice',
+        'nWeightedAvgAskPrice',
+        'nHighLimited',
+        'nLowLimited')
+
+    price_fields = (
+        'nAskPrice_0', 'nAskPrice_1', 'nAskPrice_2',
+        'nAskPrice_3', 'nAskPrice_4', 'nAskPrice_5',
+        'nAskPrice_6', 'nAskPrice_7', 'nAskPrice_8',
+        'nAskPrice_9', 'nBidPrice_0', 'nBidPrice_1',
+        'nBidPrice_2', 'nBidPrice_3', 'nBidPrice_4',
+        'nBidPrice_5', 'nBidPrice_6', 'nBidPrice_7',
+        'nBidPrice_8', 'nBidPrice_9', 'nHigh',
+        'nHighLimited', 'nLow', 'nLowLimited',
+        'nMatch', 'nOpen', 'nPreClose',
+        'nWeightedAvgAskPrice', 'nWeightedAvgBidPrice')
 
     @classmethod
-    def standardize(cls, data):
-        price_fields = [
-            'nAskPrice_0', 'nAskPrice_1', 'nAskPrice_2',
-            'nAskPrice_3', 'nAskPrice_4', 'nAskPrice_5',
-            'nAskPrice_6', 'nAskPrice_7', 'nAskPrice_8',
-            'nAskPrice_9', 'nBidPrice_0', 'nBidPrice_1',
-            'nBidPrice_2', 'nBidPrice_3', 'nBidPrice_4',
-            'nBidPrice_5', 'nBidPrice_6', 'nBidPrice_7',
-            'nBidPrice_8', 'nBidPrice_9', 'nHigh',
-            'nHighLimited', 'nLow', 'nLowLimited',
-            'nMatch', 'nOpen', 'nPreClose',
-            'nWeightedAvgAskPrice', 'nWeightedAvgBidPrice']
-        
-        for field in cls.get_int64_fields():
-            data[field] = int(data[field])
-
-        for field in price_fields:
-            data[field] = data[field] / 10000
-        return data
+    def get_book(cls, data):
+        """
+        标准化后快照行情的盘口视图
+
+        `TickRecord`与`TickDict`返回其缓存的`book`, 普通dict每次重新生成
+        """
+        if isinstance(data, (TickRecord, TickDict)):
+            return data.book
+        return OrderBook.from_snapshot(data)
 
 
 class OrderFeed(MarketFeed):
@@ -144,20 +432,8 @@ class OrderFeed(MarketFeed):
     """
     name = 'order_feed'
 
-    @classmethod
-    def get_int64_fields(cls):
-        return ['nPrice']
-
-    @classmethod
-    def standardize(cls, data):
-        price_fields = ['nPrice']
-
-        for field in cls.get_int64_fields():
-            data[field] = int(data[field])
-
-        for field in price_fields:
-            data[field] = data[field] / 10000
-        return data
+    int64_fields = ('nPrice',)
+    price_fields = ('nPrice',)
 
 
 class QueueFeed(MarketFeed):
@@ -166,20 +442,8 @@ class QueueFeed(MarketFeed):
     """
     name = 'queue_feed'
 
-    @classmethod
-    def get_int64_fields(cls):
-        return ['nPrice']
-
-    @classmethod
-    def standardize(cls, data):
-        price_fields = ['nPrice']
-
-        for field in cls.get_int64_fields():
-            data[field] = int(data[field])
-
-        for field in price_fields:
-            data[field] = data[field] / 10000
-        return data
+    int64_fields = ('nPrice',)
+    price_fields = ('nPrice',)
 
 
 class OptionsFeed(MarketFeed):
@@ -188,17 +452,9 @@ class OptionsFeed(MarketFeed):
     """
     name = 'options_feed'
 
-    @classmethod
-    def get_int64_fields(cls):
-        return [
-            'openInterest',
-            'preOpenInterest']
-
-    @classmethod
-    def standardize(cls, data):
-        for field in cls.get_int64_fields():
-            data[field] = int(data[field])
-        return data
+    int64_fields = (
+        'openInterest',
+        'preOpenInterest')
 
 
 class FuturesFeed(MarketFeed):
@@ -207,17 +463,9 @@ class FuturesFeed(MarketFeed):
     """
     name = 'ctp_feed'
 
-    @classmethod
-    def get_int64_fields(cls):
-        return [
-            'openInterest',
-            'preOpenInterest']
-    
-    @classmethod
-    def standardize(cls, data):
-        for field in cls.get_int64_fields():
-            data[field] = int(data[field])
-        return data
+    int64_fields = (
+        'openInterest',
+        'preOpenInterest')
 
 
 FEED_TYPE_NAME_MAPPING = {
@@ -230,3 +478,86 @@ FEED_TYPE_NAME_MAPPING = {
     'ctp_feed': FuturesFeed
 }
 
+CONFLATABLE_FEEDS = frozenset(
+    name for name, feed_type in FEED_TYPE_NAME_MAPPING.items()
+    if feed_type.conflatable)
+
+
+class _RecordPlan:
+    """
+    某类行情在特定字段组合下的解码计划
+    """
+
+    __slots__ = ('record_cls', 'plain', 'ints', 'prices')
+
+    def __init__(self, feed_type, fields):
+        self.record_cls = type(
+            f'{feed_type.__name__}Record',
+            (feed_type.record_base,),
+            {'__slots__': fields,
+             '_fields': fields,
+             '_field_set': frozenset(fields)})
+
+        def setter(field):
+            return getattr(self.record_cls, field).__set__
+
+        conv = dict(feed_type.get_plan())
+        self.plain = tuple((setter(f), f) for f in fields if f not in conv)
+        self.ints = tuple((setter(f), f) for f in fields
+                          if f in conv and conv[f] is None)
+        self.prices = tuple((setter(f), f, conv[f]) for f in fields
+                            if conv.get(f) is not None)
+
+    def build(self, data):
+        record = object.__new__(self.record_cls)
+        for set_, field in self.plain:
+            set_(record, data[field])
+        for set_, field in self.ints:
+            set_(record, int(data[field]))
+        for set_, field, scale in self.prices:
+            set_(record, int(data[field]) / scale)
+        return record
+
+
+class QuoteDecoder:
+    """
+    行情消息解码
+
+    使用orjson(如已安装)解析, 并按预先生成的字段计划一次完成类型与
+    价格转换, 输出`QuoteRecord`, 省去attrdict的递归拷贝
+    """
+
+    def __init__(self):
+        # (api_id, fields) -> _RecordPlan
+        self._plans = {}
+
+    @staticmethod
+    def _is_valid_fields(feed_type, fields):
+        reserved = set(dir(feed_type.record_base))
+        return all(f.isidentifier() and not f.startswith('_') and
+                   f not in reserved for f in fields)
+
+    def get_plan(self, api_id, fields):
+        key = (api_id, fields)
+        plan = self._plans.get(key)
+        if plan is None and key not in self._plans:
+            feed_type = FEED_TYPE_NAME_MAPPING[api_id]
+            if self._is_valid_fields(feed_type, fields):
+                plan = _RecordPlan(feed_type, fields)
+            self._plans[key] = plan
+        return plan
+
+    def decode(self, raw):
+        msg = loads(raw)
+        data = msg.pop('content')
+        api_id = msg['api_id']
+
+        mail = attrdict(msg)
+        plan = self.get_plan(api_id, tuple(data))
+        if plan is None:
+            # 字段名无法作为属性时退回原有的attrdict格式
+            feed_type = FEED_TYPE_NAME_MAPPING[api_id]
+            mail['content'] = feed_type.standardize(feed_type.dict_base(data))
+        else:
+            mail['content'] = plan.build(data)
+        return mail
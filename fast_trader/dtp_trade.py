@@ -3,12 +3,14 @@
 import os
 import time
 import datetime
+import math
+import heapq
+import itertools
 
 import threading
 import logging
 import zmq
 
-import queue
 from queue import Queue
 import functools
 from collections import OrderedDict
@@ -18,7 +20,9 @@ import json
 from fast_trader.dtp import constants
 from fast_trader.dtp.constants import dtp_type
 
-from fast_trader.id_pool import _id_pool
+from fast_trader.id_pool import _id_pool, OwnershipIndex, open_cursor
+from fast_trader.mail_queue import ConflatingQueue, RingQueue, get_many
+from fast_trader.metrics import LatencyHistogram
 from fast_trader.settings import settings, setup_logging
 from fast_trader.utils import attrdict
 from fast_trader import zmq_context
@@ -231,14 +235,26 @@ def rename_capital(kw):
 
 
 class TimerTask:
+    """
+    定时任务
+
+    schedule为`datetime.datetime`时在该时刻执行一次,
+    为`datetime.timedelta`时按固定频率重复执行
+
+    到期时间以`time.monotonic()`计, 在创建任务时由本地时间换算得到
+    """
 
     def __init__(self, schedule, some_callable, args=None, kw=None):
 
         _valid_schedule_types = (datetime.timedelta, datetime.datetime)
         if isinstance(schedule, datetime.timedelta):
             self.type = 'interval'
+            self.interval = schedule.total_seconds()
+            if self.interval <= 0:
+                raise ValueError(f'Invalid interval: {schedule}')
         elif isinstance(schedule, datetime.datetime):
             self.type = 'once'
+            self.interval = None
         else:
             raise TypeError(f'`schedule` has to be one of'
                             f'{_valid_schedule_types}), got {type(schedule)}')
@@ -248,77 +264,241 @@ class TimerTask:
         self.args = args or ()
         self.kw = kw or {}
 
-        self._last_time = self.now
+        self.deadline = self.first_deadline(time.monotonic())
         self._finished = False
 
     @property
     def now(self):
         return datetime.datetime.now()
 
+    def first_deadline(self, now):
+        if self.type == 'interval':
+            return now + self.interval
+        delta = self.schedule - datetime.datetime.now()
+        return now + delta.total_seconds()
+
     def is_finished(self):
         return self._finished
 
+    def cancel(self):
+        self._finished = True
+
     def time_to_run(self):
         if self._finished:
             return False
+        return time.monotonic() >= self.deadline
 
-        now = datetime.datetime.now()
-        if self.type == 'interval':
-            target_time = self._last_time + self.schedule
-        else:
-            target_time = self.schedule
-
-        if now >= target_time:
-            return True
-
-        return False
-
-    def execute(self):
+    def execute(self, now=None):
         try:
             self.callable(*self.args, **self.kw)
         finally:
             if self.type == 'once':
                 self._finished = True
             else:
-                # FIXME: should interval task be exed exactly same times
-                # as all intervals elapsed
-                self._last_time = self.now
+                # 按固定频率对齐到期时间, 不随执行耗时漂移;
+                # 错过的周期合并为一次执行
+                if now is None:
+                    now = time.monotonic()
+                self.deadline += self.interval
+                if self.deadline <= now:
+                    missed = math.floor((now - self.deadline) / self.interval)
+                    self.deadline += (missed + 1) * self.interval
 
 
 class Timer:
+    """
+    基于最小堆的定时任务调度
 
-    def __init__(self):
-        self.tasks = []
+    每次执行到期任务的开销为O(log n), 未到期时click()仅比较堆顶
+    """
+
+    def __init__(self, notify=None):
+        # (deadline, seq, task)
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._cancelled = 0
+        # 添加任务后的通知回调, 用于唤醒阻塞等待中的dispatcher
+        self._notify = notify
+
+    @property
+    def tasks(self):
+        return [task for _, _, task in self._heap if not task.is_finished()]
+
+    def _push(self, task):
+        heapq.heappush(self._heap, (task.deadline, next(self._seq), task))
 
     def click(self):
+        heap, lock = self._heap, self._lock
+        now = time.monotonic()
 
-        for task in self.tasks:
-            if task.time_to_run():
-                task.execute()
+        while True:
+            with lock:
+                if not heap or heap[0][0] > now:
+                    return
+                _, _, task = heapq.heappop(heap)
+                if task.is_finished():
+                    self._discard()
+                    continue
+
+            try:
+                task.execute(now)
+            finally:
+                if not task.is_finished():
+                    with lock:
+                        self._push(task)
+
+    def time_to_next(self):
+        """
+        距下一个任务执行的秒数，无待执行任务时返回None
+        """
+        heap = self._heap
+        with self._lock:
+            while heap and heap[0][2].is_finished():
+                heapq.heappop(heap)
+                self._discard()
+            if not heap:
+                return None
+            deadline = heap[0][0]
+        return deadline - time.monotonic()
+
+    def _discard(self):
+        """
+        已取消的任务出堆, 调用时需持有锁
+        """
+        if self._cancelled:
+            self._cancelled -= 1
 
     def add_task(self, task):
-        self.tasks.append(task)
+        with self._lock:
+            self._push(task)
+        if self._notify is not None:
+            self._notify()
 
     def remove_task(self, task):
-        raise NotImplementedError
+        """
+        取消任务, 堆中已取消的任务过多时重建堆
+        """
+        with self._lock:
+            if task.is_finished():
+                return
+            task.cancel()
+            self._cancelled += 1
+            if self._cancelled > len(self._heap) // 2:
+                # 原地重建, click()等持有的引用保持有效
+                self._heap[:] = [e for e in self._heap
+                                 if not e[2].is_finished()]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
 
 
 class Dispatcher:
+    """
+    消息分发
+
+    mode:
+        poll: 轮询各队列, 空闲时sleep(0.0001)
+        event: 阻塞等待唤醒, 每次唤醒处理完所有就绪消息,
+            无消息时仅在定时任务到期时唤醒
+
+    market_batch_size:
+        每次唤醒最多连续处理的行情条数, 处理完一批后会先检查柜台回报
+        与定时任务, 积压时吞吐量随批次大小而非循环次数增长
+
+    conflate_market:
+        是否合并未处理的快照行情, 见`ConflatingQueue`
+
+    market_queue:
+        行情队列类型, queue: `queue.Queue`(或`ConflatingQueue`);
+        ring: 无锁环形队列`RingQueue`, 容量与溢出策略由
+        `ring_capacity`, `ring_policy`指定
+
+    prioritized:
+        柜台回报优先, 每处理`max_market_batch`条行情即检查一次回报队列,
+        回报不会排在行情积压之后
+
+    track_latency:
+        按队列(rsp/market)统计消息入队至分发的延迟直方图
+    """
+
+    MODES = ('poll', 'event')
+
+    # 每次唤醒最多处理的行情条数
+    # poll模式默认与原逻辑一致, 每轮只取一条
+    DEFAULT_MARKET_BATCH_SIZE = {'poll': 1, 'event': 256}
+
+    def __init__(self, mode=None, market_batch_size=None,
+                 conflate_market=None, prioritized=None,
+                 max_market_batch=None, track_latency=None,
+                 market_queue=None, ring_capacity=None, ring_policy=None,
+                 **kw):
+
+        conf = settings.get('dispatcher') or {}
+
+        self.mode = mode or conf.get('mode', 'poll')
+        if self.mode not in self.MODES:
+            raise ValueError(f'Invalid dispatcher mode: {self.mode}')
+
+        self.market_batch_size = (
+            market_batch_size or conf.get('market_batch_size') or
+            self.DEFAULT_MARKET_BATCH_SIZE[self.mode])
 
-    def __init__(self, **kw):
+        if conflate_market is None:
+            conflate_market = conf.get('conflate_market', False)
+        self.conflate_market = conflate_market
+
+        if prioritized is None:
+            prioritized = conf.get('prioritized', False)
+        self.prioritized = prioritized
+        self.max_market_batch = (
+            max_market_batch or conf.get('max_market_batch') or 32)
+
+        if track_latency is None:
+            track_latency = conf.get('track_latency', False)
+        self.track_latency = track_latency
+        self.latency_histograms = {
+            'rsp': LatencyHistogram('rsp'),
+            'market': LatencyHistogram('market'),
+        }
 
         self._handlers = {}
 
         self._req_queue = Queue()
         self._rsp_queue = Queue()
-        self._market_queue = Queue()
+        self.market_queue_type = market_queue or conf.get(
+            'market_queue', 'queue')
+        if self.market_queue_type == 'ring':
+            self._market_queue = RingQueue(
+                capacity=ring_capacity or conf.get('ring_capacity', 65536),
+                policy=ring_policy or conf.get('ring_policy', 'block'))
+            self._get_market = self._market_queue.get_many
+        elif self.market_queue_type == 'queue':
+            if conflate_market:
+                self._market_queue = ConflatingQueue()
+            else:
+                self._market_queue = Queue()
+            self._get_market = functools.partial(
+                get_many, self._market_queue)
+        else:
+            raise ValueError(
+                f'Invalid market queue type: {self.market_queue_type}')
+
+        # rsp/market消息入队时触发, 事件驱动模式下唤醒分发线程
+        self._wakeup = threading.Event()
 
         self.logger = logging.getLogger('dispatcher')
 
         self._rsp_processor = None
         self._req_processor = None
 
-        self.timer = Timer()
+        self.timer = Timer(notify=self._notify)
+
+        # 行情处理统计
+        self._market_drained = 0
+        self._market_batches = 0
+        self._max_market_batch = 0
+        self._stats_time = time.perf_counter()
+        self._stats_drained = 0
 
         self._running = False
         self._service_suspended = False
@@ -341,6 +521,17 @@ class Dispatcher:
         self._req_processor.join()
         self._rsp_processor.join()
 
+    def stop(self):
+        self._running = False
+        # 唤醒阻塞中的处理线程
+        self._req_queue.put({'handler_id': '_stop_req'})
+        self._wakeup.set()
+
+    def _notify(self):
+        # 事件已置位时不再重复set, 避免每条消息都竞争锁
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
     def process_req(self):
 
         while self._running:
@@ -349,29 +540,144 @@ class Dispatcher:
             self.dispatch(mail)
 
     def process_rsp(self):
+        if self.mode == 'event':
+            self._process_rsp_event()
+        else:
+            self._process_rsp_poll()
 
-        # TODO: poll queues or zmq socks
-        while self._running:
+    def _drain_rsp(self, limit=None):
+        """
+        处理就绪的柜台回报, `limit`为None时处理全部
+        """
+        rsp_queue = self._rsp_queue
+        n = rsp_queue._qsize()
+        if not n:
+            return 0
+
+        hist = self.latency_histograms['rsp'] if self.track_latency else None
+        mails = get_many(rsp_queue, n if limit is None else min(n, limit))
+        for mail in mails:
+            if hist is not None and 'enqueue_time' in mail:
+                hist.record(time.perf_counter() - mail['enqueue_time'])
             try:
-                mail = self._rsp_queue.get(block=False)
                 self.logger.info(mail)
                 self.dispatch(mail)
-            except queue.Empty:
-                pass
             except Exception as e:
                 self.logger.error(str(e), exc_info=True)
+        return len(mails)
 
+    def _drain_market(self, limit):
+        """
+        一次性取出至多`limit`条行情并依次分发
+        """
+        hist = (self.latency_histograms['market']
+                if self.track_latency else None)
+        mails = self._get_market(limit)
+        for mail in mails:
+            if hist is not None and 'enqueue_time' in mail:
+                hist.record(time.perf_counter() - mail['enqueue_time'])
             try:
-                mail = self._market_queue.get(block=False)
                 self.dispatch(mail)
-            except queue.Empty:
-                time.sleep(0.0001)
             except Exception as e:
                 self.logger.error(str(e), exc_info=True)
 
+        n = len(mails)
+        if n:
+            self._market_drained += n
+            self._market_batches += 1
+            if n > self._max_market_batch:
+                self._max_market_batch = n
+        return n
+
+    def _drain_lanes(self):
+        """
+        先处理柜台回报, 再处理至多`market_batch_size`条行情
+
+        prioritized模式下, 每处理`max_market_batch`条行情重新检查回报队列
+        """
+        self._drain_rsp()
+        if not self.prioritized:
+            return self._drain_market(self.market_batch_size)
+
+        drained, remaining = 0, self.market_batch_size
+        chunk = self.max_market_batch
+        while remaining > 0:
+            n = self._drain_market(min(chunk, remaining))
+            if not n:
+                break
+            drained += n
+            remaining -= n
+            self._drain_rsp()
+        return drained
+
+    def _process_rsp_event(self):
+        wakeup, timer = self._wakeup, self.timer
+        batch_size = self.market_batch_size
+
+        while self._running:
+            drained = self._drain_lanes()
+
+            delay = timer.time_to_next()
+            if delay is not None and delay <= 0:
+                try:
+                    timer.click()
+                except Exception as e:
+                    self.logger.error(str(e), exc_info=True)
+                continue
+
+            # 行情仍有积压, 不等待直接处理下一批
+            if drained == batch_size:
+                continue
+
+            # 先clear再drain, 保证等待期间入队的消息不会被遗漏
+            wakeup.wait(delay)
+            wakeup.clear()
+
+    def _process_rsp_poll(self):
+        batch_size = self.market_batch_size
+
+        while self._running:
+            if self.prioritized:
+                if not self._drain_lanes():
+                    time.sleep(0.0001)
+                self.timer.click()
+                continue
+
+            # 每轮处理一条回报
+            self._drain_rsp(1)
+
+            if not self._drain_market(batch_size):
+                time.sleep(0.0001)
+
             # signal timer event
             self.timer.click()
 
+    def get_stats(self):
+        """
+        队列积压与行情处理速率
+
+        drain_rate为自上次调用以来每秒处理的行情条数
+        """
+        now = time.perf_counter()
+        drained = self._market_drained
+        elapsed = now - self._stats_time
+        rate = (drained - self._stats_drained) / elapsed if elapsed > 0 else 0.
+        self._stats_time, self._stats_drained = now, drained
+
+        return {
+            'rsp_depth': self._rsp_queue.qsize(),
+            'market_depth': self._market_queue.qsize(),
+            'market_drained': drained,
+            'market_batches': self._market_batches,
+            'max_market_batch': self._max_market_batch,
+            'drain_rate': rate,
+            'conflated': getattr(self._market_queue, 'conflated', 0),
+            'market_overflows': getattr(self._market_queue, 'overflows', 0),
+            'market_dropped': getattr(self._market_queue, 'dropped', 0),
+            'latency': {lane: hist.to_dict()
+                        for lane, hist in self.latency_histograms.items()},
+        }
+
     def bind(self, handler_id, handler, override=False):
         if not override and handler_id in self._handlers:
             if handler == self._handlers[handler_id]:
@@ -401,12 +707,17 @@ class Dispatcher:
         if mail.get('sync'):
             return self.dispatch(mail)
 
+        if self.track_latency:
+            mail['enqueue_time'] = time.perf_counter()
+
         if handler_id.endswith('_req'):
             self._req_queue.put(mail)
         elif handler_id[0].isalpha():
             self._market_queue.put(mail)
+            self._notify()
         elif handler_id.endswith('_rsp'):
             self._rsp_queue.put(mail)
+            self._notify()
         else:
             raise Exception('Invalid message: {}'.format(mail))
 
@@ -541,6 +852,13 @@ class Trader:
 
         self._strategies = []
         self._strategy_dict = OrderedDict()
+        # 回报 -> 策略
+        self._owners = OwnershipIndex()
+        # strategy_id -> IDCursor
+        self._order_id_cursors = {}
+        # request_id: 实例前缀 + 递增序号, 代替逐个生成uuid
+        self._request_id_prefix = uuid.uuid1().hex[:20] + '-'
+        self._request_id_seq = itertools.count(1)
 
         self.__api_bound = False
         
@@ -552,8 +870,7 @@ class Trader:
         def wrapper(*args, **kw):
             args_ = args[1:]
             logger = args[0].logger
-            logger.info(
-                f'{func.__name__}<args={args_}, kwargs={kw}')
+            logger.info('%s<args=%s, kwargs=%s', func.__name__, args_, kw)
             return func(*args, **kw)
         return wrapper
 
@@ -609,46 +926,51 @@ class Trader:
         计算初始编号
         """
         strategy_id = strategy.strategy_id
-        id_range = _id_pool.get_strategy_range_per_trader(
-            strategy_id, self.trader_id)
+        cursor = open_cursor(strategy_id, self.trader_id)
 
-        strategy._id_range = id_range
         strategy._id_whole_range = _id_pool.get_strategy_whole_range(
             strategy_id)
 
-        initial_id = id_range[0]
         self.logger.debug('初始请求编号 策略={} {}'.format(
-            strategy_id, initial_id))
+            strategy_id, cursor.current))
 
-        setattr(self, '_order_id_{}'.format(strategy_id), initial_id)
-        setattr(self, '_request_id_{}'.format(strategy_id), initial_id)
+        self._order_id_cursors[strategy_id] = cursor
 
     def generate_request_id(self, number=1):
         """
         请求id，保证当日不重复
         """
-        request_id = str(uuid.uuid1())
-        return request_id
+        return self._request_id_prefix + str(next(self._request_id_seq))
 
     def generate_order_id(self, number):
         """
         用户报单编号，保证当日不重复
         """
-        name = '{}_{}'.format('_order_id', number)
-
-        order_id = getattr(self, name)
-        setattr(self, name, order_id + 1)
-        return str(order_id)
+        return str(self._order_id_cursors[number].next_id())
 
     def add_strategy(self, strategy):
         self._strategies.append(strategy)
         self._strategy_dict[strategy.strategy_id] = strategy
+        self._owners.add_strategy(strategy)
         self._generate_initial_id(strategy)
 
     def remove_strategy(self, strategy):
         # TODO: keep one only
         self._strategies.remove(strategy)
         self._strategy_dict.pop(strategy.strategy_id)
+        self._owners.remove_strategy(strategy)
+
+    def register_request(self, request_id, strategy):
+        """
+        登记请求归属, 用于确定撤单响应等无`order_original_id`消息的策略
+        """
+        self._owners.register_request(request_id, strategy)
+
+    def get_owner(self, obj):
+        """
+        响应数据所属的策略, 无法确定时返回None
+        """
+        return self._owners.get_owner(obj)
     
     def set_account_no(self, account_no):
         self._account_no = account_no
@@ -669,11 +991,15 @@ class Trader:
         elif api_id == constants.LOGOUT_ACCOUNT_RESPONSE:
             self.on_logout(mail)
         else:
-            for ea in self._strategies:
-                if ea.started and ea._check_owner(mail['content']):
-                    getattr(
-                        ea, 
-                        constants.RSP_API_NAMES[api_id])(mail['content'])
+            ea = self._owners.get_owner(mail['content'])
+            if ea is not None and ea.started:
+                handler = getattr(ea, constants.RSP_API_NAMES[api_id])
+                # 启用mailbox的策略在其自身线程中处理回报
+                mailbox = ea._mailbox
+                if mailbox is None:
+                    handler(mail['content'])
+                else:
+                    mailbox.put(handler, mail['content'])
 
     @property
     def account_no(self):
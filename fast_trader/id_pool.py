@@ -2,6 +2,12 @@
 import datetime
 import math
 import functools
+import os
+import sqlite3
+import threading
+import collections
+
+import numpy as np
 
 from fast_trader.settings import settings
 
@@ -75,6 +81,46 @@ class _IDPool:
 
         self.strategy_ranges = {i: v for i, v in enumerate(strategy_ranges)}
         self.sys_reserve = sys_reserve
+        # 各策略id段等长且连续, 可直接由id计算所属策略
+        self._strategy_range_start = strategy_ranges[0].start
+        self._strategy_range_len = len(strategy_ranges[0])
+
+    def owner_of(self, order_id):
+        """
+        order_id所在id段对应的strategy_id, 不属于任何策略时返回None
+        """
+        strategy_id = (order_id - self._strategy_range_start) \
+            // self._strategy_range_len
+        rng = self.strategy_ranges.get(strategy_id)
+        if rng is not None and order_id in rng:
+            return strategy_id
+        return None
+
+    def owners_of(self, order_ids):
+        """
+        批量计算order_id所属的strategy_id
+
+        Parameters
+        ----------
+        order_ids: iterable
+            int或数字字符串
+
+        Returns
+        ----------
+        numpy.ndarray[int64], 不属于任何策略(或无法解析)的位置为-1
+        """
+        try:
+            ids = np.asarray(order_ids, dtype=np.int64)
+        except (TypeError, ValueError):
+            ids = np.fromiter(
+                (int(i) if str(i).isdigit() else -1 for i in order_ids),
+                dtype=np.int64)
+
+        start = self._strategy_range_start
+        stop = start + self._strategy_range_len * len(self.strategy_ranges)
+        owners = (ids - start) // self._strategy_range_len
+        owners[(ids < start) | (ids >= stop)] = -1
+        return owners
 
     def get_trader_ranges_and_reserves(self, strategy_id):
         strategy_range = self.strategy_ranges[strategy_id]
@@ -118,6 +164,219 @@ class _IDPool:
     def get_sys_reserve(self):
         return self.sys_reserve
 
+
+class IDCursorStore:
+    """
+    持久化各(策略, trader, 交易日)已预留的order_id上界
+
+    每次预留一段编号只写入一次, 重启后从上次预留的上界继续分配,
+    已预留但未使用的编号不再复用
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS id_cursor ("
+                "strategy_id INTEGER, trader_id INTEGER, trading_day TEXT, "
+                "reserved INTEGER, "
+                "PRIMARY KEY (strategy_id, trader_id, trading_day))")
+
+    def load(self, strategy_id, trader_id, trading_day):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT reserved FROM id_cursor WHERE strategy_id=? "
+                "AND trader_id=? AND trading_day=?",
+                (strategy_id, trader_id, trading_day)).fetchone()
+        return None if row is None else row[0]
+
+    def save(self, strategy_id, trader_id, trading_day, reserved):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO id_cursor VALUES (?, ?, ?, ?)",
+                (strategy_id, trader_id, trading_day, reserved))
+
+    def close(self):
+        self._conn.close()
+
+
+class IDCursor:
+    """
+    单个(策略, trader)的order_id分配器
+
+    按`block_size`预留编号段, 段内分配只做整数递增;
+    可在多个线程中同时使用
+    """
+
+    __slots__ = ('store', 'key', 'block_size', '_stop', '_next', '_limit',
+                 '_lock')
+
+    def __init__(self, id_range, store=None, key=None, block_size=1000):
+        self.store = store
+        self.key = key
+        self.block_size = block_size
+        self._stop = id_range.stop
+        self._lock = threading.Lock()
+
+        start = id_range[0]
+        if store is not None:
+            reserved = store.load(*key)
+            if reserved is not None:
+                start = max(start, reserved)
+
+        self._next = start
+        self._limit = start
+
+    def _reserve(self):
+        if self._next >= self._stop:
+            raise RuntimeError(f'order_id已用尽: {self.key}')
+        self._limit = min(self._next + self.block_size, self._stop)
+        if self.store is not None:
+            self.store.save(*self.key, self._limit)
+
+    def next_id(self):
+        with self._lock:
+            order_id = self._next
+            if order_id >= self._limit:
+                self._reserve()
+            self._next = order_id + 1
+        return order_id
+
+    @property
+    def current(self):
+        """
+        下一个将分配的order_id
+        """
+        return self._next
+
+
+_cursor_store = None
+_cursor_store_lock = threading.Lock()
+
+
+def get_cursor_store():
+    """
+    按配置`_IDPool.cursor_db`打开游标存储, 未配置时返回None
+    """
+    global _cursor_store
+    db_path = settings['_IDPool'].get('cursor_db')
+    if not db_path:
+        return None
+    with _cursor_store_lock:
+        if _cursor_store is None or _cursor_store.db_path != db_path:
+            os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+            _cursor_store = IDCursorStore(db_path)
+    return _cursor_store
+
+
+def open_cursor(strategy_id, trader_id, trading_day=None):
+    """
+    创建(策略, trader)当日的order_id分配器
+
+    启用`_IDPool.cursor_db`时从持久化的游标继续分配;
+    否则沿用按当前时间跳过已过去部分id段的方式
+    """
+    conf = settings['_IDPool']
+    store = get_cursor_store()
+    if store is None:
+        return IDCursor(_id_pool.get_strategy_range_per_trader(
+            strategy_id, trader_id))
+
+    if trading_day is None:
+        trading_day = datetime.date.today().strftime('%Y%m%d')
+    if (strategy_id, trader_id) not in _id_pool.trader_ranges:
+        _id_pool.get_trader_ranges_and_reserves(strategy_id)
+    return IDCursor(
+        _id_pool.trader_ranges[strategy_id, trader_id],
+        store=store,
+        key=(strategy_id, trader_id, trading_day),
+        block_size=conf.get('block_size', 1000))
+
+
+class OwnershipIndex:
+    """
+    柜台回报 -> 所属策略
+
+    依次按order_original_id所在的id段, order_exchange_id, request_id
+    查找, 均为O(1)。order_exchange_id在首次收到同时带有
+    order_original_id的回报时记录; request_id在生成时登记。
+    两者只保留当日记录, 且各自最多保留`max_entries`条, 超出时淘汰最早的
+    """
+
+    def __init__(self, id_pool=None, max_entries=200000):
+        self.id_pool = id_pool or _id_pool
+        self.max_entries = max_entries
+
+        # strategy_id -> strategy
+        self._strategies = {}
+        self._exchange_ids = collections.OrderedDict()
+        self._request_ids = collections.OrderedDict()
+        self._day = datetime.date.today()
+
+    def add_strategy(self, strategy):
+        self._strategies[strategy.strategy_id] = strategy
+
+    def remove_strategy(self, strategy):
+        if self._strategies.get(strategy.strategy_id) is strategy:
+            self._strategies.pop(strategy.strategy_id)
+
+    def _remember(self, mapping, key, strategy):
+        today = datetime.date.today()
+        if today != self._day:
+            self._exchange_ids.clear()
+            self._request_ids.clear()
+            self._day = today
+        mapping[key] = strategy
+        if len(mapping) > self.max_entries:
+            mapping.popitem(last=False)
+
+    def register_request(self, request_id, strategy):
+        self._remember(self._request_ids, request_id, strategy)
+
+    def register_exchange_id(self, exchange_id, strategy):
+        self._remember(self._exchange_ids, exchange_id, strategy)
+
+    def _by_order_id(self, order_id):
+        try:
+            strategy_id = self.id_pool.owner_of(int(order_id))
+        except (TypeError, ValueError):
+            return None
+        return self._strategies.get(strategy_id)
+
+    def get_owner(self, obj):
+        """
+        回报数据所属的策略, 无法确定时返回None
+        """
+        if 'order_original_id' in obj:
+            return self._by_order_id(obj['order_original_id'])
+
+        body = obj.get('body')
+        if body is None:
+            return None
+
+        if 'order_original_id' in body:
+            owner = self._by_order_id(body['order_original_id'])
+            exchange_id = body.get('order_exchange_id')
+            if owner is not None and exchange_id and \
+                    exchange_id not in self._exchange_ids:
+                self.register_exchange_id(exchange_id, owner)
+            return owner
+
+        if 'order_exchange_id' in body:
+            # cancel response has 'order_exchange_id'
+            # but no 'order_original_id'
+            owner = self._exchange_ids.get(body['order_exchange_id'])
+            if owner is not None:
+                return owner
+
+        header = obj.get('header')
+        if header is not None:
+            return self._request_ids.get(header.get('request_id'))
+        return None
+
+
 _id_pool = _IDPool(
     max_strategies=settings['_IDPool']['max_strategies'],
     max_traders_per_strategy=settings['_IDPool']['max_traders_per_strategy']
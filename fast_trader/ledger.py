@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import os
+import json
 import time
+import queue
+import sqlite3
 import datetime
 import enum
 import collections
 import contextlib
 import copy
+import functools
+import threading
+import numpy as np
 import pandas as pd
 import logging
 
@@ -117,6 +124,107 @@ class AccountView:
         return r
 
 
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+class ViewHistory:
+    """
+    单个代码的账户概要历史, 按列存储于可扩容的numpy数组
+
+    Parameters
+    ----------
+    interval: float
+        采样间隔(秒), 同一间隔内只保留最新一条; 为0时仅合并相同时间的记录
+    max_rows: int
+        最多保留的条数, 超出时丢弃最早的一半; 为None时不限制
+    """
+
+    FIELDS = AccountView.__slots__
+
+    def __init__(self, capacity=64, interval=0, max_rows=None):
+        self.interval = int(interval * 1e6)
+        self.max_rows = max_rows
+        if max_rows:
+            capacity = min(capacity, max_rows)
+
+        self._time = np.empty(capacity, dtype=np.int64)
+        self._values = np.empty((len(self.FIELDS), capacity),
+                                dtype=np.float64)
+        self._size = 0
+        self._last_bucket = None
+        self._last_localtime = None
+        self._last_ts = None
+
+    def __len__(self):
+        return self._size
+
+    def _make_room(self):
+        size = self._size
+        capacity = len(self._time)
+        if self.max_rows and size >= self.max_rows:
+            drop = size // 2
+            self._time[:size - drop] = self._time[drop:size]
+            self._values[:, :size - drop] = self._values[:, drop:size]
+            self._size = size - drop
+            return
+
+        capacity *= 2
+        if self.max_rows:
+            capacity = min(capacity, self.max_rows)
+        time_ = np.empty(capacity, dtype=np.int64)
+        time_[:size] = self._time[:size]
+        values = np.empty((len(self.FIELDS), capacity), dtype=np.float64)
+        values[:, :size] = self._values[:, :size]
+        self._time, self._values = time_, values
+
+    def append(self, localtime, view):
+        if localtime == self._last_localtime:
+            ts = self._last_ts
+        else:
+            ts = (datetime.datetime.fromisoformat(localtime) - _EPOCH) \
+                // _MICROSECOND
+            self._last_localtime, self._last_ts = localtime, ts
+        bucket = ts // self.interval if self.interval else ts
+
+        if bucket == self._last_bucket:
+            i = self._size - 1
+        else:
+            if self._size == len(self._time):
+                self._make_room()
+            i = self._size
+            self._size += 1
+            self._last_bucket = bucket
+
+        self._time[i] = ts
+        values = self._values
+        values[0, i] = view.cash
+        values[1, i] = view.freeze
+        values[2, i] = view.security_value
+        values[3, i] = view.costs
+
+    @property
+    def time(self):
+        """
+        datetime64[us]
+        """
+        return self._time[:self._size].view('datetime64[us]')
+
+    def __getattr__(self, name):
+        # cash, freeze, security_value, costs 均为无拷贝的切片
+        try:
+            i = self.FIELDS.index(name)
+        except ValueError:
+            raise AttributeError(name)
+        return self._values[i, :self._size]
+
+    def to_dataframe(self):
+        n = self._size
+        return pd.DataFrame(
+            {f: self._values[i, :n] for i, f in enumerate(self.FIELDS)},
+            index=pd.DatetimeIndex(self.time))
+
+
 def ledger_record_to_dict(record):
     dct = record.__dict__
     dct.pop('_sa_instance_state')
@@ -125,7 +233,7 @@ def ledger_record_to_dict(record):
 
 class HoldingPosition(DateAttrMixin):
     __slots__ = ('code', 'quantity', 'yd_quantity',
-                 'price', 'localtime')
+                 'price', 'localtime', 'cost_basis', 'realized')
 
     def __init__(self, **kw):
         self.code = ''
@@ -137,6 +245,10 @@ class HoldingPosition(DateAttrMixin):
         self.price = 0.
         # 最新更新时间
         self.localtime = '1970-01-01T00:00:00.000000'
+        # 持仓成本(移动加权平均), 与`PnLEngine`的计算一致
+        self.cost_basis = 0.
+        # 已实现盈亏(不含交易费用)
+        self.realized = 0.
 
         for k, v in kw.items():
             setattr(self, k, v)
@@ -168,43 +280,394 @@ class LedgerStore:
         doc.pop('_sa_instance_state')
         self._store.write(doc)
 
+    def save_many(self, records):
+        docs = []
+        for record in records:
+            doc = record.__dict__
+            doc.pop('_sa_instance_state', None)
+            docs.append(doc)
+        self._store.write_many(docs)
+
     def load(self, query=None):
         if query is None:
             query = {}
         return self._store.read(query)
 
+    @property
+    def name(self):
+        return self._store.table_name
+
+    def _assure_meta(self, conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS journal_meta "
+                     "(name TEXT PRIMARY KEY, seq INTEGER)")
+
+    def load_journal_seq(self):
+        """
+        已提交的最大日志序号
+        """
+        conn = self._store._conn
+        with conn:
+            self._assure_meta(conn)
+            row = conn.execute("SELECT seq FROM journal_meta WHERE name=?",
+                               (self.name,)).fetchone()
+        return 0 if row is None else row['seq']
+
+    def commit_journal(self, docs, seq, checkpoint=None):
+        """
+        单个事务中写入记录并更新已提交的日志序号
+        """
+        fields = self._store.fields
+        statement = "INSERT INTO {} ({}) VALUES ({})".format(
+            self.name, ','.join(fields), ','.join(['?'] * len(fields)))
+        rows = [tuple(doc.get(f) for f in fields) for doc in docs]
+
+        conn = self._store._conn
+        with conn:
+            self._assure_meta(conn)
+            conn.executemany(statement, rows)
+            conn.execute("INSERT OR REPLACE INTO journal_meta VALUES (?, ?)",
+                         (self.name, seq))
+            if checkpoint is not None:
+                self._write_checkpoint(conn, checkpoint)
+
+    def count(self):
+        conn = self._store._conn
+        with conn:
+            row = conn.execute(
+                f"SELECT COUNT(*) AS n FROM {self.name}").fetchone()
+        return row['n']
+
+    def load_tail(self, offset):
+        """
+        按写入顺序跳过前`offset`条后的全部记录
+        """
+        conn = self._store._conn
+        with conn:
+            return conn.execute(
+                "SELECT {} FROM {} ORDER BY ID LIMIT -1 OFFSET ?".format(
+                    ','.join(self._store.fields), self.name),
+                (offset,)).fetchall()
+
+    def _write_checkpoint(self, conn, checkpoint):
+        conn.execute("CREATE TABLE IF NOT EXISTS ledger_checkpoint "
+                     "(name TEXT, rows INTEGER, localtime TEXT, "
+                     "payload TEXT)")
+        conn.execute("INSERT INTO ledger_checkpoint VALUES (?, ?, ?, ?)",
+                     (self.name, checkpoint['rows'], checkpoint['localtime'],
+                      json.dumps(checkpoint['payload'])))
+
+    def save_checkpoint(self, checkpoint):
+        conn = self._store._conn
+        with conn:
+            self._write_checkpoint(conn, checkpoint)
+
+    def load_checkpoint(self):
+        """
+        最新的检查点, 无则返回None
+        """
+        conn = self._store._conn
+        try:
+            with conn:
+                row = conn.execute(
+                    "SELECT rows, localtime, payload FROM ledger_checkpoint "
+                    "WHERE name=? ORDER BY rows DESC, rowid DESC LIMIT 1",
+                    (self.name,)).fetchone()
+        except sqlite3.OperationalError:
+            # 尚未写入过检查点
+            return None
+        if row is None:
+            return None
+        row['payload'] = json.loads(row['payload'])
+        return row
+
+
+class LedgerJournal:
+    """
+    流水后台写入(write-behind)
+
+    调用线程只将记录追加到日志文件(不fsync, 进程崩溃后仍可恢复),
+    再放入内存队列; 后台线程每`flush_interval`秒或每`flush_size`条
+    在一个事务中批量提交至sqlite, 同时记录已提交的日志序号。
+    提交失败的批次每`retry_interval`秒重试, 且总在之后的记录之前提交,
+    已提交序号不会越过未提交的记录。
+    启动时回放日志中序号大于已提交序号的部分
+
+    日志在`path`与`path + '.1'`两个文件间轮换: 每次提交成功后, 若日志
+    已全部提交则清空当前文件, 否则之后的记录改写入另一文件, 待原文件中
+    的记录全部提交后再清空, 日志大小不随运行时间增长
+    """
+
+    def __init__(self, store, path, flush_interval=0.05, flush_size=500,
+                 retry_interval=1.):
+        self.store = store
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.retry_interval = retry_interval
+
+        self.committed = 0
+        self.commits = 0
+        self.failures = 0
+
+        # 提交失败待重试的批次
+        self._failed = []
+
+        self._queue = queue.Queue()
+        self._cond = threading.Condition()
+        self._paths = (path, path + '.1')
+        # 当前写入的文件与另一文件
+        self._fd = None
+        self._spare_fd = None
+        # 另一文件中最后一条记录的序号, 0表示该文件已清空
+        self._retired = 0
+        # 写入日志与轮换、清空文件互斥
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._thread = None
+
+        self.logger = logging.getLogger('ledger')
+
+    def recover(self):
+        """
+        回放日志中未提交至sqlite的记录, 返回回放条数
+        """
+        committed = self.store.load_journal_seq()
+        pending = []
+        for path in self._paths:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        seq, doc = json.loads(line)
+                    except ValueError:
+                        # 崩溃时写入了一半的行
+                        self.logger.warning(f'忽略不完整的流水日志: {line!r}')
+                        continue
+                    if seq > committed:
+                        pending.append((seq, doc))
+
+        if pending:
+            pending.sort(key=lambda item: item[0])
+            committed = pending[-1][0]
+            self.store.commit_journal([doc for _, doc in pending], committed)
+            self.logger.warning(
+                f'{self.store.name} 回放流水日志 {len(pending)} 条')
+
+        self._seq = self.committed = committed
+        # 日志均已提交, 重新开始
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND
+        self._fd, self._spare_fd = (os.open(p, flags) for p in self._paths)
+        self._retired = 0
+        return len(pending)
+
+    def start(self):
+        if self._fd is None:
+            self.recover()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=f'journal_{self.store.name}')
+        self._thread.start()
+
+    def put_many(self, docs):
+        if self._fd is None:
+            # 已关闭, 直接写入
+            self._seq += len(docs)
+            self.store.commit_journal(docs, self._seq)
+            return
+
+        if not docs:
+            return
+        with self._lock:
+            lines = []
+            for doc in docs:
+                self._seq += 1
+                lines.append(json.dumps([self._seq, doc]) + '\n')
+            os.write(self._fd, ''.join(lines).encode('utf-8'))
+            self._queue.put((self._seq, docs, None))
+
+    def put_checkpoint(self, checkpoint):
+        """
+        检查点经由写入队列, 与其之前的记录在同一事务中提交
+        """
+        if self._fd is None:
+            self.store.save_checkpoint(checkpoint)
+        else:
+            self._queue.put((self._seq, [], checkpoint))
+
+    def _run(self):
+        q = self._queue
+        while True:
+            try:
+                item = q.get(
+                    timeout=self.retry_interval if self._failed else None)
+            except queue.Empty:
+                self._commit([])
+                continue
+            if item is None:
+                if self._failed:
+                    self._commit([])
+                break
+
+            deadline = time.monotonic() + self.flush_interval
+            items = [item]
+            size = len(item[1])
+            stop = False
+            while size < self.flush_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = q.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                items.append(item)
+                size += len(item[1])
+
+            self._commit(items)
+            if stop:
+                break
+
+    def _commit(self, items):
+        # 之前失败的批次先于新记录提交, 以免已提交序号越过它们
+        items = self._failed + items
+        self._failed = []
+        docs = [doc for _, batch, _ in items for doc in batch]
+        seq = items[-1][0]
+        checkpoints = [c for _, _, c in items if c is not None]
+        try:
+            self.store.commit_journal(
+                docs, seq, checkpoints[-1] if checkpoints else None)
+        except Exception:
+            # 留待重试; 若未能提交即退出, 日志中的记录在重启时回放
+            self.logger.error(f'{self.store.name} 流水提交失败',
+                              exc_info=True)
+            self._failed = items
+            with self._cond:
+                self.failures += 1
+                self._cond.notify_all()
+            return
+        with self._cond:
+            self.committed = seq
+            self.commits += 1
+            self._cond.notify_all()
+        self._rotate(seq)
+
+    def _rotate(self, committed):
+        """
+        清空已全部提交的日志文件
+        """
+        with self._lock:
+            if self._fd is None:
+                return
+            if self._retired and committed >= self._retired:
+                os.ftruncate(self._spare_fd, 0)
+                self._retired = 0
+            if committed == self._seq:
+                os.ftruncate(self._fd, 0)
+            elif not self._retired:
+                # 当前文件中仍有未提交的记录, 之后的记录写入另一文件
+                self._fd, self._spare_fd = self._spare_fd, self._fd
+                self._retired = self._seq
+
+    def flush(self, timeout=None):
+        """
+        等待已写入的记录全部提交, 期间提交失败时返回False
+        """
+        target = self._seq
+        with self._cond:
+            failures = self.failures
+            self._cond.wait_for(
+                lambda: (self.committed >= target or
+                         self.failures > failures), timeout)
+            return self.committed >= target
+
+    def stop(self, wait=True):
+        if self._thread is not None:
+            self._queue.put(None)
+            if wait:
+                self._thread.join()
+            self._thread = None
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                os.close(self._spare_fd)
+                self._fd = self._spare_fd = None
+
 
 class Accountant:
 
     # TODO: memoize
 
-    def __init__(self, name, restore_history=True):
+    def __init__(self, name, restore_history=True, write_behind=None):
         self.name = name
         self.should_restore_history = restore_history
 
         ddict = collections.defaultdict
         self._positions = ddict(HoldingPosition)
 
-        # self._general_account_view = AccountView()
+        # 各代码账户概要的合计, 随各代码的变动增量更新
+        self._general_account_view = AccountView()
         self._account_view_per_child = ddict(AccountView)
-        # TODO: history records as namedtuple
-        self._account_views_per_child = ddict(dict)
+        conf = settings.get('ledger', {})
+        self._history_per_child = ddict(functools.partial(
+            ViewHistory,
+            interval=conf.get('history_interval', 0),
+            max_rows=conf.get('history_max_rows')))
 
         self._unhandled = 0
 
         self._store = LedgerStore(name=name)
 
-        self._records = self._load_history()
-
         self.logger = logging.getLogger('ledger')
 
+        if write_behind is None:
+            write_behind = conf.get('write_behind')
+        if write_behind:
+            path = os.path.join(
+                os.path.dirname(settings['sqlite_ledger']),
+                f'{name}.journal')
+            self._journal = LedgerJournal(
+                self._store, path,
+                flush_interval=conf.get('flush_interval', 0.05),
+                flush_size=conf.get('flush_size', 500),
+                retry_interval=conf.get('retry_interval', 1.))
+            self._journal.start()
+        else:
+            self._journal = None
+
+        # 每写入checkpoint_every条记录及每个交易日保存一次检查点,
+        # 启动时从最新检查点恢复, 只回放其后的记录
+        self.checkpoint_every = conf.get('checkpoint_every', 0)
+        self._since_checkpoint = 0
+        self._checkpoint_day = None
+        # 已写入数据表的记录数
+        self._persisted = self._store.count() if self.checkpoint_every else 0
+
+        # 流水的列存储, 见get_pnl_engine
+        self._columns = None
+        # 从检查点恢复时检查点之前的盈亏状态, (localtime, {code: state})
+        self._opening = None
+        # 最后一条流水(含估值记录)的时间
+        self._last_localtime = ''
+        self._records = self._load_history()
+
     @contextlib.contextmanager
     def _get_view(self, record):
-        c, t = record.code, record.localtime
+        c = record.code
         view = self._account_view_per_child[c]
+        cash, freeze = view.cash, view.freeze
+        security_value, costs = view.security_value, view.costs
         yield view
+        gview = self._general_account_view
+        gview.cash += view.cash - cash
+        gview.freeze += view.freeze - freeze
+        gview.security_value += view.security_value - security_value
+        gview.costs += view.costs - costs
         # take snapshot
-        self._account_views_per_child[c][t] = copy.copy(view)
+        self._history_per_child[c].append(record.localtime, view)
 
     def _load_history(self):
         """
@@ -212,41 +675,155 @@ class Accountant:
         """
         if not self.should_restore_history:
             return []
-        # TODO: allow loading from recent records
-        docs = self._store.load()
+
+        checkpoint = None
+        if self.checkpoint_every:
+            checkpoint = self._store.load_checkpoint()
+
+        if checkpoint is None:
+            docs = self._store.load()
+        else:
+            self._apply_checkpoint(checkpoint)
+            docs = self._store.load_tail(checkpoint['rows'])
+            self.logger.info(
+                f'{self.name} 从检查点恢复({checkpoint["localtime"]}), '
+                f'回放{len(docs)}条记录')
+        return self._replay(docs)
+
+    def _replay(self, docs):
         records = list(map(StockLedgerRecord.from_msg, docs))
         for event in records:
             self.handle_event(event)
+        if records:
+            self._last_localtime = records[-1].localtime
         return records
 
-    def save(self, record):
-        # TODO: save in background
-        # Do not save EVALUATION record
-        if record.subject == LedgerSubject.EVALUATION:
+    def _make_checkpoint(self):
+        positions = {
+            code: [pos.quantity, pos.yd_quantity, pos.price, pos.localtime]
+            for code, pos in self._positions.items()}
+        views = {
+            code: [view.cash, view.freeze, view.security_value, view.costs]
+            for code, view in self._account_view_per_child.items()}
+        # 盈亏曲线的期初状态, 字段见`fast_trader.pnl.OPENING_FIELDS`
+        pnl = {}
+        for code, view in self._account_view_per_child.items():
+            pos = self._positions.get(code) or HoldingPosition()
+            pnl[code] = {
+                'cash': view.cash, 'freeze': view.freeze,
+                'costs': view.costs, 'position': pos.quantity,
+                'price': pos.price, 'cost_basis': pos.cost_basis,
+                'realized': pos.realized,
+                'holding_value': view.security_value}
+        return {'rows': self._persisted, 'localtime': self._last_localtime,
+                'payload': {'positions': positions, 'views': views,
+                            'pnl': pnl}}
+
+    def _apply_checkpoint(self, checkpoint):
+        payload = checkpoint['payload']
+        for code, values in payload['positions'].items():
+            pos = self._positions[code]
+            pos.code = code
+            pos.quantity, pos.yd_quantity, pos.price, pos.localtime = values
+        for code, values in payload['views'].items():
+            view = self._account_view_per_child[code]
+            view.cash, view.freeze, view.security_value, view.costs = values
+        self._general_account_view = self._sum_account_views()
+
+        pnl = payload['pnl']
+        for code, state in pnl.items():
+            pos = self._positions.get(code)
+            if pos is not None:
+                pos.cost_basis = state['cost_basis']
+                pos.realized = state['realized']
+        self._last_localtime = checkpoint['localtime']
+        if checkpoint['localtime']:
+            self._opening = (checkpoint['localtime'], pnl)
+
+    def checkpoint(self):
+        """
+        保存持仓与各代码账户概要的检查点
+        """
+        checkpoint = self._make_checkpoint()
+        if self._journal is None:
+            self._store.save_checkpoint(checkpoint)
+        else:
+            self._journal.put_checkpoint(checkpoint)
+        self._since_checkpoint = 0
+
+    def save_many(self, records):
+        records = [r for r in records
+                   if r.subject != LedgerSubject.EVALUATION]
+        if not records:
             return
-        self._store.save(record)
+        if self._journal is None:
+            self._store.save_many(records)
+        else:
+            fields = self._store._store.fields
+            self._journal.put_many(
+                [{f: r.__dict__.get(f) for f in fields} for r in records])
+        self._persisted += len(records)
+
+        if self.checkpoint_every:
+            self._since_checkpoint += len(records)
+            day = records[-1].date
+            if self._checkpoint_day is None:
+                self._checkpoint_day = day
+            if self._since_checkpoint >= self.checkpoint_every or \
+                    day != self._checkpoint_day:
+                self._checkpoint_day = day
+                self.checkpoint()
+
+    def flush(self, timeout=None):
+        """
+        等待后台写入完成
+        """
+        if self._journal is not None:
+            return self._journal.flush(timeout)
+        return True
+
+    def close(self):
+        if self.checkpoint_every and self._since_checkpoint:
+            self.checkpoint()
+        if self._journal is not None:
+            self._journal.stop()
 
     def put_event(self, event):
-        if (not self._records) or event.localtime >=\
-                self._records[-1].localtime:
-            self._records.append(event)
+        self.put_events([event])
 
-            self.save(event)
-            self.handle_event(event)
-            self._unhandled += 1
-        else:
-            # FIXME:
-            try:
-                raise RuntimeError('Got outdated ledger record')
-            except:
-                self.logger.error('Got outdated ledger record', exc_info=True)
-            # # allow insertion of missing events
-            # length = len(self._records)
-            # for i in range(length):
-            #     if i == length - 2 or\
-            #             event.localtime >= self._records[-i-2].localtime:
-            #        self._records.insert(-i-1, event)
-            #        break
+    def put_events(self, events):
+        """
+        批量写入流水
+
+        依次更新账户视图, 再在单个事务中保存全部记录
+        """
+        accepted = []
+        for event in events:
+            if event.localtime >= self._last_localtime:
+                self._last_localtime = event.localtime
+                # 估值记录不保留, 最新价格已在持仓与账户视图中
+                if event.subject != LedgerSubject.EVALUATION:
+                    self._records.append(event)
+
+                self.handle_event(event)
+                self._unhandled += 1
+                accepted.append(event)
+            else:
+                # FIXME:
+                try:
+                    raise RuntimeError('Got outdated ledger record')
+                except:
+                    self.logger.error('Got outdated ledger record',
+                                      exc_info=True)
+                # # allow insertion of missing events
+                # length = len(self._records)
+                # for i in range(length):
+                #     if i == length - 2 or\
+                #             event.localtime >= self._records[-i-2].localtime:
+                #        self._records.insert(-i-1, event)
+                #        break
+
+        self.save_many(accepted)
 
     def handle_event(self, event):
         # TODO: incremental calc
@@ -266,55 +843,46 @@ class Accountant:
         elif event.subject == LedgerSubject.CAPITAL:
             self.on_capital_change(event)
 
-    def get_cash_by_dataframe(self):
-        records = list(map(lambda o: o.__dict__, self._records))
-        df = pd.DataFrame(records)
-        df = df.drop('_sa_instance_state', axis=1)
-        cash_df = df[df.category == LedgerCategory.CASH]
-        cash_ss = cash_df.groupby('localtime').apply(
-            lambda x: (x.quantity * x.price).sum()
-        ).cumsum()
+    def get_pnl_engine(self):
+        """
+        基于当前流水的盈亏计算, 见`fast_trader.pnl.PnLEngine`
 
-        if not isinstance(cash_ss.index, pd.DatetimeIndex):
-            cash_ss.index = pd.to_datetime(cash_ss.index)
+        估值记录不保留, 持仓按成交价格(及期初价格)估值;
+        从检查点恢复时, 检查点之前的状态作为各代码的期初行
+        """
+        from fast_trader.pnl import LedgerColumns, PnLEngine
 
-        return cash_ss
+        if self._columns is None:
+            self._columns = LedgerColumns()
+            if self._opening is not None:
+                self._columns.add_opening(*self._opening)
+        # 流水只追加, 增量转换为列存储
+        self._columns.extend(self._records[self._columns.records:])
+        return PnLEngine(self._columns)
 
-    def get_holding_value_by_dataframe(self):
-        records = list(map(lambda o: o.__dict__, self._records))
-        df = pd.DataFrame(records)
-        df = df.drop('_sa_instance_state', axis=1)
-        holding_df = df[df.category == LedgerCategory.SECURITY]\
-            .set_index('localtime')
-        common_index = holding_df.index.unique()
-        # TODO: multiple trades might occur at the same time,
-        # thus resulting in duplicated index
-        holding_value_by_code = holding_df.groupby('code').apply(
-            lambda x: (x.quantity.cumsum() * x.price)
-                # .groupby(x.index).last()  # drop duplicates by index
-                .reindex(common_index)
-                .fillna(method='ffill')
-        )
-        holding_ss = holding_value_by_code.sum()
+    def get_pnl(self, code=None, freq=None):
+        """
+        盈亏曲线, 参数见`PnLEngine.curves`
+        """
+        return self.get_pnl_engine().curves(code=code, freq=freq)
 
-        if not isinstance(holding_ss.index, pd.DatetimeIndex):
-            holding_ss.index = pd.to_datetime(holding_ss.index)
+    def get_cash_by_dataframe(self):
+        return self.get_pnl()['cash']
 
-        return holding_ss
+    def get_holding_value_by_dataframe(self):
+        return self.get_pnl()['holding_value']
 
     def get_profit_by_dataframe(self):
-        cash_ss = self.get_cash_by_dataframe()
-        holding_ss = self.get_holding_value_by_dataframe()
-        co_index = cash_ss.index.union(holding_ss.index)
-
-        profit = cash_ss.reindex(co_index, method='ffill').fillna(0.)\
-            + holding_ss.reindex(co_index, method='ffill').fillna(0.)
-        return profit
+        pnl = self.get_pnl()
+        return pnl['cash'] + pnl['holding_value']
 
     def get_account_view_by_code(self, code):
         return self._account_view_per_child[code]
 
     def get_general_account_view(self):
+        return copy.copy(self._general_account_view)
+
+    def _sum_account_views(self):
         gview = AccountView()
         for view in self._account_view_per_child.values():
             gview.cash += view.cash
@@ -323,20 +891,34 @@ class Accountant:
             gview.freeze += view.freeze
         return gview
 
+    def check_consistency(self, tolerance=1e-6):
+        """
+        校验增量维护的账户合计与逐代码求和是否一致
+        """
+        expected = self._sum_account_views()
+        actual = self._general_account_view
+        for field in AccountView.__slots__:
+            a, b = getattr(actual, field), getattr(expected, field)
+            if abs(a - b) > tolerance * max(1., abs(b)):
+                self.logger.error(
+                    f'{self.name} 账户合计不一致 {field}: {a} != {b}')
+                return False
+        return True
+
     def get_account_history_stats_by_code(self, code, as_dataframe=True):
 
-        views = self._account_views_per_child[code]
+        history = self._history_per_child.get(code)
+        if history is None:
+            history = self._history_per_child.default_factory()
         if as_dataframe:
-            docs = {k: v.to_dict() for k, v in views.items()}
-            df = pd.DataFrame(docs).T
-            return df
-        return views
+            return history.to_dataframe()
+        return history
 
     def get_general_account_history_stats(self):
 
         dataframes = []
         common_index = None
-        for code in self._account_views_per_child:
+        for code in self._history_per_child:
             stats = self.get_account_history_stats_by_code(code)
             dataframes.append(stats)
             if common_index is None:
@@ -352,6 +934,22 @@ class Accountant:
         ret = sum(dataframes)
         return ret
 
+    def is_holding(self, code):
+        pos = self._positions.get(code)
+        return pos is not None and pos.quantity != 0
+
+    def mark_to_market(self, code, price):
+        """
+        按最新价就地更新持仓价格与市值, 不生成流水记录与历史快照
+        """
+        pos = self._positions.get(code)
+        if pos is None or not pos.quantity:
+            return
+        increment = (price - pos.price) * pos.quantity
+        self._account_view_per_child[code].security_value += increment
+        self._general_account_view.security_value += increment
+        pos.price = price
+
     def on_evaluation(self, event):
         """
         Re-evalute account according to latest market price
@@ -400,8 +998,21 @@ class Accountant:
 
                 view.security_value += eval_inc + pos_inc
 
+                # 买入计入成本, 卖出按剩余比例结转成本并确认盈亏
+                quantity = pos.quantity + event.quantity
+                cost_basis = pos.cost_basis
+                if event.quantity > 0:
+                    cost_basis += pos_inc
+                elif event.quantity < 0 and pos.quantity > 0:
+                    cost_basis *= quantity / pos.quantity
+                if quantity <= 0:
+                    cost_basis = 0.
+                if event.quantity < 0:
+                    pos.realized += -pos_inc - (pos.cost_basis - cost_basis)
+                pos.cost_basis = cost_basis
+
                 pos.price = event.price
-                pos.quantity += event.quantity
+                pos.quantity = quantity
 
             elif event.category == LedgerCategory.FREEZE:
 
@@ -437,16 +1048,125 @@ class Accountant:
             view.costs += -value
 
 
+def _batched(func):
+    """
+    方法内产生的流水合并为一批写入
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kw):
+        with self.batch():
+            return func(self, *args, **kw)
+    return wrapper
+
+
+def verify_checkpoint(name, tolerance=1e-6):
+    """
+    校验检查点: 分别从头回放全部记录, 以及从最新检查点恢复并回放其后的记录,
+    比较两者各代码的持仓(含持仓成本与已实现盈亏)与账户概要
+
+    估值记录不写入数据表, 检查点中的持仓价格可能是更新的估值价格,
+    因此持仓价格不做比较, 证券市值比较扣除`持仓数量*价格`后的部分
+
+    Returns
+    ----------
+    list of (code, field, 全量回放结果, 检查点恢复结果), 一致时为空
+    """
+    full = Accountant(name, restore_history=False, write_behind=False)
+    full._replay(full._store.load())
+
+    restored = Accountant(name, restore_history=False, write_behind=False)
+    checkpoint = restored._store.load_checkpoint()
+    if checkpoint is not None:
+        restored._apply_checkpoint(checkpoint)
+        restored._replay(restored._store.load_tail(checkpoint['rows']))
+    else:
+        restored._replay(restored._store.load())
+
+    def view_values(acc, code):
+        view = acc._account_view_per_child.get(code) or AccountView()
+        pos = acc._positions.get(code) or HoldingPosition()
+        return {'cash': view.cash, 'freeze': view.freeze,
+                'costs': view.costs,
+                'security_value': view.security_value -
+                pos.quantity * pos.price,
+                'quantity': pos.quantity,
+                'yd_quantity': pos.yd_quantity,
+                'cost_basis': pos.cost_basis,
+                'realized': pos.realized}
+
+    diffs = []
+    codes = set(full._account_view_per_child) | \
+        set(restored._account_view_per_child)
+    for code in sorted(codes):
+        a = view_values(full, code)
+        b = view_values(restored, code)
+        for field in a:
+            if abs(a[field] - b[field]) > tolerance * max(1., abs(a[field])):
+                diffs.append((code, field, a[field], b[field]))
+    return diffs
+
+
 class LedgerWriter:
 
     def __init__(self, name, restore_history=True):
         self.name = name
         self.accountant = Accountant(name, restore_history=restore_history)
+        self._local = threading.local()
+
+        conf = settings.get('ledger', {})
+        self.mark_to_market = conf.get('mark_to_market', False)
+        self.evaluation_interval = conf.get('evaluation_interval', 60)
+        # code -> 下一次生成估值记录的时间
+        self._next_evaluation = {}
 
     @property
     def localtime(self):
         return datetime.datetime.now()
 
+    def close(self):
+        self.accountant.close()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        期间写入的流水先暂存, 退出时一次性更新账户视图,
+        并在单个事务中保存(可嵌套, 由最外层提交)
+        """
+        if getattr(self._local, 'pending', None) is not None:
+            yield
+            return
+
+        self._local.pending = pending = []
+        try:
+            yield
+        finally:
+            self._local.pending = None
+            self.accountant.put_events(pending)
+
+    def _put_event(self, record):
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            self.accountant.put_event(record)
+        else:
+            pending.append(record)
+
+    def write_order_records(self, orders):
+        """
+        批量委托相关流水, 见`write_order_record`
+        """
+        with self.batch():
+            for order in orders:
+                self.write_order_record(order)
+
+    def write_trade_records(self, trades):
+        """
+        批量成交相关流水, 见`write_trade_record`
+        """
+        with self.batch():
+            for trade in trades:
+                self.write_trade_record(trade)
+
+    @_batched
     def write_order_record(self, order):
         """
         委托相关流水
@@ -473,7 +1193,7 @@ class LedgerWriter:
                 record.quantity = frozen_value
                 record.price = 1.
                 record.localtime = localtime
-                self.accountant.put_event(record)
+                self._put_event(record)
 
                 record = StockLedgerRecord()
                 record.subject = LedgerSubject.TRANSACTION
@@ -482,7 +1202,7 @@ class LedgerWriter:
                 record.quantity = -frozen_value
                 record.price = 1.
                 record.localtime = localtime
-                self.accountant.put_event(record)
+                self._put_event(record)
 
         # 委托本地提交后，仅冻结了买入委托占用资金
         # 委托确认后，还须冻结交易费用
@@ -506,7 +1226,7 @@ class LedgerWriter:
             record.quantity = cost_freeze
             record.price = 1.
             record.localtime = localtime
-            self.accountant.put_event(record)
+            self._put_event(record)
 
             record = StockLedgerRecord()
             record.subject = LedgerSubject.TRANSACTION
@@ -515,7 +1235,7 @@ class LedgerWriter:
             record.quantity = -cost_freeze
             record.price = 1.
             record.localtime = localtime
-            self.accountant.put_event(record)
+            self._put_event(record)
 
         # 委托撤销后（包含部成部撤），释放资金
         elif order.status == dtp_type.ORDER_STATUS_CANCELLED:
@@ -529,7 +1249,7 @@ class LedgerWriter:
             record.quantity = order.freeze_amount
             record.price = 1.
             record.localtime = localtime
-            self.accountant.put_event(record)
+            self._put_event(record)
 
             record = StockLedgerRecord()
             record.subject = LedgerSubject.TRANSACTION
@@ -538,7 +1258,7 @@ class LedgerWriter:
             record.quantity = -order.freeze_amount
             record.price = 1.
             record.localtime = localtime
-            self.accountant.put_event(record)
+            self._put_event(record)
 
         # 废单，释放资金
         elif order.status == dtp_type.ORDER_STATUS_FAILED:
@@ -556,7 +1276,7 @@ class LedgerWriter:
                 record.quantity = -unfreeze
                 record.price = 1.
                 record.localtime = localtime
-                self.accountant.put_event(record)
+                self._put_event(record)
 
                 record = StockLedgerRecord()
                 record.subject = LedgerSubject.TRANSACTION
@@ -565,8 +1285,9 @@ class LedgerWriter:
                 record.quantity = unfreeze
                 record.price = 1.
                 record.localtime = localtime
-                self.accountant.put_event(record)
+                self._put_event(record)
 
+    @_batched
     def write_trade_record(self, trade):
         """
         成交相关流水
@@ -594,7 +1315,7 @@ class LedgerWriter:
         record.quantity = -unfreeze
         record.price = 1.
         record.localtime = localtime
-        self.accountant.put_event(record)
+        self._put_event(record)
 
         # 持仓金额变动
         record = StockLedgerRecord()
@@ -604,7 +1325,7 @@ class LedgerWriter:
         record.quantity = trade.fill_quantity * _sign
         record.price = trade.fill_price
         record.localtime = localtime
-        self.accountant.put_event(record)
+        self._put_event(record)
 
         # 卖出成交，持仓价值 -> 可用余额
         if trade.order_side == dtp_type.ORDER_SIDE_SELL:
@@ -616,7 +1337,7 @@ class LedgerWriter:
             record.quantity = transfer_value
             record.price = 1.
             record.localtime = localtime
-            self.accountant.put_event(record)
+            self._put_event(record)
 
         # 交易费用变动
         record = StockLedgerRecord()
@@ -626,7 +1347,7 @@ class LedgerWriter:
         record.quantity = -cur_cost
         record.price = 1.
         record.localtime = localtime
-        self.accountant.put_event(record)
+        self._put_event(record)
 
         # 可用资金变动 <- 解冻资金 - 持仓市值增值 - 交易费用
         # 成交价可能会优于委托价
@@ -639,7 +1360,7 @@ class LedgerWriter:
         record.price = 1.
         record.localtime = localtime
         record.comment = 'overpayment&cost'
-        self.accountant.put_event(record)
+        self._put_event(record)
 
     def write_non_trading_activity_record(self, event):
         """
@@ -663,6 +1384,16 @@ class LedgerWriter:
         else:
             raise RuntimeError(f'Invalid quote data: {message}')
 
+        if self.mark_to_market:
+            # 只估值持仓代码, 两次采样之间就地更新
+            if not self.accountant.is_holding(code):
+                return
+            now = time.monotonic()
+            if now < self._next_evaluation.get(code, 0.):
+                self.accountant.mark_to_market(code, price)
+                return
+            self._next_evaluation[code] = now + self.evaluation_interval
+
         localtime = self.localtime.strftime('%Y-%m-%dT%H:%M:%S.%f')
 
         record = StockLedgerRecord()
@@ -672,7 +1403,7 @@ class LedgerWriter:
         record.quantity = 0.
         record.price = price
         record.localtime = localtime
-        self.accountant.put_event(record)
+        self._put_event(record)
 
     def write_capital_change_record(self, value):
         """
@@ -687,4 +1418,21 @@ class LedgerWriter:
         record.quantity = value
         record.price = 1.
         record.localtime = localtime
-        self.accountant.put_event(record)
+        self._put_event(record)
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='校验流水检查点')
+    parser.add_argument('names', nargs='+',
+                        help='流水表名, 如ledger_<账户>_<策略id>')
+    args = parser.parse_args()
+
+    for name in args.names:
+        diffs = verify_checkpoint(name)
+        if not diffs:
+            print(f'{name}: OK')
+        for code, field, expected, actual in diffs:
+            print(f'{name}: {code} {field} 全量回放={expected} 检查点={actual}')
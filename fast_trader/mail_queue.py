@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+import logging
+import threading
+import collections
+
+from fast_trader.dtp_quote import CONFLATABLE_FEEDS
+from fast_trader.metrics import LatencyHistogram
+
+
+def get_many(q, limit):
+    """
+    在一次加锁内从`queue.Queue`中取出至多`limit`个元素
+    """
+    with q.mutex:
+        n = min(limit, q._qsize())
+        items = [q._get() for _ in range(n)]
+        if n:
+            q.not_full.notify(n)
+    return items
+
+
+class ConflatingQueue(queue.Queue):
+    """
+    按(api_id, szCode)合并的行情队列
+
+    快照类行情(tick_feed, index_feed)在未被处理前, 同一代码的新快照
+    会原位替换旧快照, 保持其在队列中的位置; 逐笔类行情照常先进先出,
+    不做任何丢弃。积压时队列长度上限为已订阅代码数加逐笔行情条数。
+    """
+
+    def __init__(self, maxsize=0, feeds=CONFLATABLE_FEEDS):
+        self.feeds = feeds
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        # 元素为待合并快照的key(tuple), 或不可合并的mail本身
+        self.queue = collections.deque()
+        self._latest = {}
+        # 被合并(丢弃)的快照条数
+        self.conflated = 0
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def conflation_key(self, mail):
+        api_id = mail.get('api_id')
+        if api_id in self.feeds:
+            return (api_id, mail['content']['szCode'])
+        return None
+
+    def _put(self, mail):
+        key = self.conflation_key(mail)
+        if key is None:
+            self.queue.append(mail)
+        elif key in self._latest:
+            self._latest[key] = mail
+            self.conflated += 1
+        else:
+            self._latest[key] = mail
+            self.queue.append(key)
+
+    def _get(self):
+        item = self.queue.popleft()
+        if type(item) is tuple:
+            return self._latest.pop(item)
+        return item
+
+
+class RingQueue:
+    """
+    单生产者单消费者环形队列
+
+    预分配定长槽位循环使用, 入队与批量出队均不加锁, 仅依赖GIL保证
+    单条字节码的原子性: 生产者只写`_tail`, 消费者只写`_head`,
+    槽位先写入再推进序号。只能由一个线程put, 一个线程get_many。
+
+    policy: 队列满时的处理方式
+        block: 生产者等待消费者腾出空间
+        drop_oldest: 覆盖最旧的消息, 由消费者检测被覆盖的区间并跳过
+        conflate: 超出部分进入溢出区, 快照行情按(api_id, szCode)
+            只保留最新一条, 逐笔行情不丢弃
+    """
+
+    POLICIES = ('block', 'drop_oldest', 'conflate')
+
+    def __init__(self, capacity=65536, policy='block',
+                 feeds=CONFLATABLE_FEEDS):
+        if policy not in self.POLICIES:
+            raise ValueError(f'Invalid overflow policy: {policy}')
+        # 容量取2的幂, 以位与代替取模
+        capacity = 1 << max(capacity - 1, 1).bit_length()
+
+        self.capacity = capacity
+        self.policy = policy
+        self.feeds = feeds
+
+        self._buf = [None] * capacity
+        self._mask = capacity - 1
+        # 下一个待读/待写的序号, 只增不减
+        self._head = 0
+        self._tail = 0
+
+        # block
+        self._not_full = threading.Event()
+        self._waiting = False
+        # conflate: 溢出区结构同ConflatingQueue, 仅溢出时加锁
+        self._overflow = collections.deque()
+        self._latest = {}
+        self._overflow_lock = threading.Lock()
+
+        # 队列满的次数
+        self.overflows = 0
+        # drop_oldest模式下被覆盖的消息条数
+        self.dropped = 0
+        # conflate模式下被合并的快照条数
+        self.conflated = 0
+
+    def qsize(self):
+        return self._tail - self._head + len(self._overflow)
+
+    _qsize = qsize
+
+    def empty(self):
+        return not self.qsize()
+
+    def put(self, item):
+        tail = self._tail
+        if self._overflow or tail - self._head >= self.capacity:
+            if self.policy == 'conflate':
+                self._put_overflow(item)
+                return
+            if self.policy == 'block':
+                self._wait_not_full(tail)
+            else:
+                self.overflows += 1
+        self._buf[tail & self._mask] = item
+        self._tail = tail + 1
+
+    def _wait_not_full(self, tail):
+        self.overflows += 1
+        while tail - self._head >= self.capacity:
+            self._not_full.clear()
+            self._waiting = True
+            # 再次检查, 避免消费者在置位_waiting前已腾出空间
+            if tail - self._head < self.capacity:
+                break
+            self._not_full.wait(0.001)
+        self._waiting = False
+
+    def _put_overflow(self, item):
+        api_id = item.get('api_id')
+        key = (api_id, item['content']['szCode']) \
+            if api_id in self.feeds else None
+        with self._overflow_lock:
+            if not self._overflow:
+                self.overflows += 1
+            if key is None:
+                self._overflow.append(item)
+            elif key in self._latest:
+                self._latest[key] = item
+                self.conflated += 1
+            else:
+                self._latest[key] = item
+                self._overflow.append(key)
+
+    def _get_overflow(self, limit):
+        """
+        取出溢出区中的消息; 若环形队列中仍有消息则返回None
+
+        生产者只在溢出区为空时写入环形队列, 持锁且溢出区非空时
+        环形队列中的消息均早于溢出区, 须先取出
+        """
+        items = []
+        with self._overflow_lock:
+            if self._tail != self._head:
+                return None
+            overflow, latest = self._overflow, self._latest
+            while overflow and len(items) < limit:
+                item = overflow.popleft()
+                if type(item) is tuple:
+                    item = latest.pop(item)
+                items.append(item)
+        return items
+
+    def get_many(self, limit):
+        """
+        取出至多`limit`条消息, 无消息时返回空列表
+        """
+        head = self._head
+        n = min(limit, self._tail - head)
+        if n <= 0:
+            if not self._overflow:
+                return []
+            items = self._get_overflow(limit)
+            if items is not None:
+                return items
+            # 检查之后生产者写满了环形队列并开始溢出
+            n = min(limit, self._tail - head)
+
+        buf, mask = self._buf, self._mask
+        items = [buf[i & mask] for i in range(head, head + n)]
+
+        if self.policy == 'drop_oldest':
+            # 读取期间可能被生产者覆盖, 丢弃序号已落后capacity的部分
+            # 槽位不清空, 避免误删生产者刚写入的消息
+            lapped = self._tail - self.capacity - head
+            if lapped > 0:
+                skipped = min(lapped, n)
+                items = items[skipped:]
+                self.dropped += lapped
+                head += lapped
+                n = max(n - lapped, 0)
+            self._head = head + n
+            return items
+
+        for i in range(head, head + n):
+            buf[i & mask] = None
+        self._head = head + n
+        if self._waiting:
+            self._not_full.set()
+        return items
+
+    def get_nowait(self):
+        items = self.get_many(1)
+        if not items:
+            raise queue.Empty
+        return items[0]
+
+
+class StrategyMailbox:
+    """
+    策略专属的消息队列与处理线程
+
+    分发线程只负责将回调放入各策略的mailbox, 由mailbox线程依次执行,
+    同一策略的消息顺序不变, 某个策略的回调阻塞(如同步查询柜台)时
+    不影响其他策略
+    """
+
+    _STOP = object()
+
+    def __init__(self, name=''):
+        self.name = name
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        # 已发出退出消息, 等待处理线程处理完积压消息
+        self._stopping = False
+        self.logger = logging.getLogger('dispatcher')
+
+        # 回调执行耗时
+        self.handler_time = LatencyHistogram(f'{name}.handler')
+        self.processed = 0
+        self.errors = 0
+        # 积压深度的最大值
+        self.max_depth = 0
+
+    def start(self):
+        """
+        启动处理线程
+
+        上一个处理线程尚未退出时不能重新启动, 否则两个线程将同时
+        消费同一队列
+        """
+        thread = self._thread
+        if thread is not None:
+            if not self._stopping:
+                return
+            if thread.is_alive():
+                raise RuntimeError(
+                    f'mailbox {self.name} 的处理线程尚未退出')
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name=f'mailbox-{self.name}', daemon=True)
+        self._thread.start()
+
+    def stop(self, wait=False):
+        """
+        处理完已入队的消息后退出
+        """
+        if self._thread is None:
+            return
+        if not self._stopping:
+            self._stopping = True
+            self._queue.put((self._STOP, ()))
+        if wait:
+            self.join()
+
+    def join(self, timeout=None):
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    @property
+    def running(self):
+        return self._thread is not None and not self._stopping
+
+    def put(self, func, *args):
+        q = self._queue
+        q.put((func, args))
+        depth = q.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        get = self._queue.get
+        hist = self.handler_time
+        perf_counter = time.perf_counter
+        while True:
+            func, args = get()
+            if func is self._STOP:
+                break
+            t0 = perf_counter()
+            try:
+                func(*args)
+            except Exception as e:
+                self.errors += 1
+                self.logger.error(str(e), exc_info=True)
+            hist.record(perf_counter() - t0)
+            self.processed += 1
+
+    def get_stats(self):
+        return {
+            'depth': self.qsize(),
+            'max_depth': self.max_depth,
+            'processed': self.processed,
+            'errors': self.errors,
+            'handler_time': self.handler_time.to_dict(),
+        }
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+
+class LatencyHistogram:
+    """
+    延迟直方图
+
+    以微秒计, 每个2的幂次区间再等分为8个桶, 相对误差不超过12.5%,
+    记录开销为常数; 分位数返回所在桶的上界, 即保守估计
+    """
+
+    __slots__ = ('name', 'buckets', 'count', 'total', 'max')
+
+    SUB_BUCKETS = 8
+    # 覆盖至2^32us(约71分钟)
+    NUM_BUCKETS = SUB_BUCKETS * 30
+
+    def __init__(self, name=''):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    @classmethod
+    def _index(cls, us):
+        v = int(us)
+        if v < cls.SUB_BUCKETS:
+            return v
+        e = v.bit_length() - 4
+        idx = cls.SUB_BUCKETS * (e + 1) + (v >> e) - cls.SUB_BUCKETS
+        return min(idx, cls.NUM_BUCKETS - 1)
+
+    @classmethod
+    def _upper_bound(cls, idx):
+        if idx < cls.SUB_BUCKETS:
+            return float(idx + 1)
+        e = idx // cls.SUB_BUCKETS - 1
+        m = idx % cls.SUB_BUCKETS + cls.SUB_BUCKETS
+        return float((m + 1) << e)
+
+    def record(self, secs):
+        us = secs * 1e6
+        if us < 0:
+            us = 0.
+        self.buckets[self._index(us)] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, q):
+        """
+        第q(0~100)分位数的上界, 单位us
+        """
+        if not self.count:
+            return 0.
+        target = self.count * q / 100
+        cum = 0
+        for idx, n in enumerate(self.buckets):
+            cum += n
+            if n and cum >= target:
+                return min(self._upper_bound(idx), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean_us': self.mean,
+            'p50_us': self.percentile(50),
+            'p99_us': self.percentile(99),
+            'p999_us': self.percentile(99.9),
+            'max_us': self.max,
+        }
+
+    def __repr__(self):
+        d = self.to_dict()
+        return (f'<LatencyHistogram {self.name} n={d["count"]} '
+                f'p50={d["p50_us"]:.0f}us p99={d["p99_us"]:.0f}us '
+                f'max={d["max_us"]:.0f}us>')
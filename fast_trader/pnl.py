@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+基于列存储流水的向量化盈亏计算
+
+所有曲线均由累计和得到, 按代码分组的状态通过分组起点偏移计算,
+多代码合计由各代码状态的逐条增量累加得到, 重采样使用searchsorted做as-of对齐
+
+从检查点恢复时, 检查点之前的各代码状态作为期初行加入,
+见`LedgerColumns.add_opening`
+"""
+
+import numpy as np
+import pandas as pd
+
+from fast_trader.ledger import LedgerSubject, LedgerCategory
+
+
+# 期初行的subject, 不对应任何流水记录
+OPENING = 'opening'
+# 期初状态的字段, price为最新估值价格
+OPENING_FIELDS = ('cash', 'freeze', 'costs', 'position', 'price',
+                  'cost_basis', 'realized', 'holding_value')
+
+
+class LedgerColumns:
+    """
+    流水记录的列存储, 只追加
+    """
+
+    def __init__(self):
+        # 期初行的行号 -> 期初状态
+        self.opening = {}
+        self.time = np.empty(0, dtype='datetime64[us]')
+        self.code = np.empty(0, dtype=object)
+        self.subject = np.empty(0, dtype=object)
+        self.category = np.empty(0, dtype=object)
+        self.price = np.empty(0, dtype=np.float64)
+        self.quantity = np.empty(0, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.time)
+
+    def extend(self, records):
+        records = list(records)
+        if not records:
+            return
+
+        def column(attr, dtype):
+            return np.array([getattr(r, attr) for r in records], dtype=dtype)
+
+        self.time = np.concatenate(
+            [self.time, column('localtime', 'datetime64[us]')])
+        self.code = np.concatenate([self.code, column('code', object)])
+        self.subject = np.concatenate(
+            [self.subject, column('subject', object)])
+        self.category = np.concatenate(
+            [self.category, column('category', object)])
+        self.price = np.concatenate([self.price, column('price', np.float64)])
+        self.quantity = np.concatenate(
+            [self.quantity, column('quantity', np.float64)])
+
+    def add_opening(self, localtime, states):
+        """
+        每个代码加入一行期初状态, 须在该时间之后的流水之前加入
+
+        Parameters
+        ----------
+        localtime: str
+            期初时间
+        states: dict
+            code -> {field: value}, 字段见`OPENING_FIELDS`
+        """
+        n = len(self)
+        codes = list(states)
+        if not codes:
+            return
+        self.time = np.concatenate([self.time, np.full(
+            len(codes), np.datetime64(localtime, 'us'))])
+        self.code = np.concatenate([self.code, np.array(codes, dtype=object)])
+        self.subject = np.concatenate(
+            [self.subject, np.full(len(codes), OPENING, dtype=object)])
+        self.category = np.concatenate(
+            [self.category, np.full(len(codes), '', dtype=object)])
+        self.price = np.concatenate([self.price, np.array(
+            [states[c].get('price', 0.) for c in codes], dtype=np.float64)])
+        self.quantity = np.concatenate([self.quantity, np.zeros(len(codes))])
+        for i, code in enumerate(codes):
+            self.opening[n + i] = states[code]
+
+    @property
+    def records(self):
+        """
+        流水记录(不含期初行)的条数
+        """
+        return len(self) - len(self.opening)
+
+    @classmethod
+    def from_records(cls, records):
+        ret = cls()
+        ret.extend(records)
+        return ret
+
+
+def _group_cumsum(values, starts):
+    """
+    分组累计和, `starts`为每行所在分组的起始行号
+    """
+    cum = np.cumsum(values)
+    return cum - cum[starts] + values[starts]
+
+
+def _group_ffill_index(mask, starts):
+    """
+    组内向前填充: 每行对应的最近一个mask为True的行号, 无则为-1
+    """
+    idx = np.where(mask, np.arange(len(mask)), -1)
+    idx = np.maximum.accumulate(idx)
+    idx[idx < starts] = -1
+    return idx
+
+
+def _last_of_each(times):
+    """
+    有序时间序列中每个时间的最后一行
+    """
+    if not len(times):
+        return np.empty(0, dtype=np.intp)
+    is_last = np.empty(len(times), dtype=bool)
+    is_last[:-1] = times[1:] != times[:-1]
+    is_last[-1] = True
+    return np.flatnonzero(is_last)
+
+
+class PnLEngine:
+    """
+    盈亏与权益曲线
+
+    各列含义:
+        cash, freeze, costs: 与AccountView一致
+        position: 持仓数量
+        holding_value: 持仓市值(AccountView.security_value)
+        cost_basis: 持仓成本(移动加权平均)
+        realized: 已实现盈亏(不含交易费用)
+        unrealized: 浮动盈亏
+        equity: cash + freeze + holding_value
+
+    Parameters
+    ----------
+    columns: LedgerColumns
+        按时间排序的流水
+    """
+
+    FIELDS = ('cash', 'freeze', 'costs', 'position', 'holding_value',
+              'cost_basis', 'realized', 'unrealized', 'equity')
+    # 可按代码直接相加的字段(position不同代码之间无意义, 合计中不输出)
+    TOTAL_FIELDS = ('cash', 'freeze', 'costs', 'holding_value',
+                    'cost_basis', 'realized', 'unrealized', 'equity')
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.codes, code_ids = np.unique(
+            columns.code.astype(str), return_inverse=True)
+
+        # 按代码分组(组内保持时间顺序)
+        order = np.argsort(code_ids, kind='stable')
+        self._order = order
+        self._code_ids = code_ids[order]
+        self._time = columns.time[order].astype(np.int64)
+
+        n = len(order)
+        group_start = np.ones(n, dtype=bool)
+        group_start[1:] = self._code_ids[1:] != self._code_ids[:-1]
+        self._group_start = group_start
+        self._starts = np.maximum.accumulate(
+            np.where(group_start, np.arange(n), 0))
+        self._inverse = np.empty_like(order)
+        self._inverse[order] = np.arange(n)
+
+        self._state = self._compute(order)
+
+    def _opening(self, field):
+        """
+        按分组后顺序排列的期初值, 非期初行为0
+        """
+        values = np.zeros(len(self._order))
+        for row, state in self.columns.opening.items():
+            values[self._inverse[row]] = state.get(field, 0.)
+        return values
+
+    def _compute(self, order):
+        c = self.columns
+        subject = c.subject[order]
+        category = c.category[order]
+        price = c.price[order]
+        quantity = c.quantity[order]
+        amount = price * quantity
+        starts = self._starts
+
+        is_txn = subject == LedgerSubject.TRANSACTION
+        is_costs = subject == LedgerSubject.COSTS
+        is_dividend = subject == LedgerSubject.DIVIDEND
+        is_cash = category == LedgerCategory.CASH
+        is_security = category == LedgerCategory.SECURITY
+
+        cash_flow = np.where(
+            (is_txn & is_cash) | (is_dividend & is_cash) | is_costs |
+            (subject == LedgerSubject.CAPITAL), amount, 0.)
+        freeze_flow = np.where(
+            is_txn & (category == LedgerCategory.FREEZE), amount, 0.)
+        costs_flow = np.where(is_costs, -amount, 0.)
+
+        trade_qty = np.where(is_txn & is_security, quantity, 0.)
+        buy_amount = np.where(trade_qty > 0, trade_qty * price, 0.)
+        extra_value = np.where(is_dividend & is_security, amount, 0.)
+        realized_flow = np.zeros(len(order))
+
+        # 最新估值价格: 成交与估值记录
+        marked = is_security & (is_txn |
+                                (subject == LedgerSubject.EVALUATION))
+
+        is_opening = subject == OPENING
+        if is_opening.any():
+            # 期初行: 相当于按期初成本买入期初持仓, 其余状态直接计入
+            cash_flow += self._opening('cash')
+            freeze_flow += self._opening('freeze')
+            costs_flow += self._opening('costs')
+            open_position = self._opening('position')
+            trade_qty += open_position
+            buy_amount += self._opening('cost_basis')
+            extra_value += self._opening('holding_value') - \
+                open_position * np.where(is_opening, price, 0.)
+            realized_flow += self._opening('realized')
+            marked |= is_opening
+
+        position = _group_cumsum(trade_qty, starts)
+        prev_position = position - trade_qty
+
+        last = _group_ffill_index(marked, starts)
+        last_price = np.where(last >= 0, price[np.maximum(last, 0)], 0.)
+        stock_dividend = _group_cumsum(extra_value, starts)
+        holding_value = position * last_price + stock_dividend
+
+        cost_basis = self._cost_basis(
+            trade_qty, position, prev_position, buy_amount)
+        prev_cost = np.empty_like(cost_basis)
+        prev_cost[1:] = cost_basis[:-1]
+        prev_cost[self._group_start] = 0.
+
+        selling = trade_qty < 0
+        realized_flow += np.where(
+            selling, -trade_qty * price - (prev_cost - cost_basis), 0.)
+
+        cash = _group_cumsum(cash_flow, starts)
+        freeze = _group_cumsum(freeze_flow, starts)
+
+        return {
+            'cash': cash,
+            'freeze': freeze,
+            'costs': _group_cumsum(costs_flow, starts),
+            'position': position,
+            'holding_value': holding_value,
+            'cost_basis': cost_basis,
+            'realized': _group_cumsum(realized_flow, starts),
+            'unrealized': position * last_price - cost_basis,
+            'equity': cash + freeze + holding_value,
+            'price': last_price,
+        }
+
+    def _cost_basis(self, trade_qty, position, prev_position, buy_amount):
+        """
+        移动加权平均成本
+
+        cost_t = r_t * cost_{t-1} + b_t, 买入时r=1, b为买入金额;
+        卖出时r为剩余持仓比例, b=0。以持仓归零处为界分段,
+        段内 cost_t = P_t * sum(b_s / P_s), P为r的累乘(取对数累加)
+        """
+        n = len(trade_qty)
+        if not n:
+            return np.empty(0)
+
+        selling = (trade_qty < 0) & (prev_position > 0)
+        ratio = np.ones(n)
+        np.divide(position, prev_position, out=ratio, where=selling)
+        flat = position <= 0
+        # 清仓行之后重新开始, 清仓行本身成本为0
+        ratio[flat] = 1.
+
+        seg_start = self._group_start | (prev_position <= 0)
+        seg_starts = np.maximum.accumulate(
+            np.where(seg_start, np.arange(n), 0))
+
+        log_p = _group_cumsum(np.log(ratio), seg_starts)
+        p = np.exp(log_p)
+        cost = p * _group_cumsum(buy_amount / p, seg_starts)
+        cost[flat] = 0.
+        return cost
+
+    def _select(self, code):
+        k = np.searchsorted(self.codes, code)
+        if k == len(self.codes) or self.codes[k] != code:
+            raise KeyError(code)
+        lo = np.searchsorted(self._code_ids, k, side='left')
+        hi = np.searchsorted(self._code_ids, k, side='right')
+        return slice(lo, hi)
+
+    def _total(self):
+        """
+        多代码合计: 各代码状态的逐条增量按时间顺序累加
+        """
+        state = self._state
+        inverse = self._inverse
+
+        ret = {}
+        for field in self.TOTAL_FIELDS:
+            values = state[field]
+            delta = np.empty_like(values)
+            delta[1:] = values[1:] - values[:-1]
+            delta[self._group_start] = values[self._group_start]
+            ret[field] = np.cumsum(delta[inverse])
+        return self.columns.time.astype(np.int64), ret
+
+    def last_state(self):
+        """
+        各代码的最新状态, 可作为`LedgerColumns.add_opening`的期初状态
+        """
+        last = np.flatnonzero(np.append(self._group_start[1:], True)) \
+            if len(self._order) else np.empty(0, dtype=np.intp)
+        return {
+            str(self.codes[self._code_ids[i]]): {
+                f: float(self._state[f][i]) for f in OPENING_FIELDS}
+            for i in last}
+
+    def curves(self, code=None, freq=None):
+        """
+        盈亏曲线
+
+        Parameters
+        ----------
+        code: str
+            为None时返回所有代码合计
+        freq: str
+            pandas频率字符串, 如'1min', '1D'; 为None时每个流水时间一行
+            (相同时间只保留最后一行)
+
+        Returns
+        ----------
+        pandas.DataFrame, DatetimeIndex
+        """
+        if code is None:
+            times, values = self._total()
+            fields = self.TOTAL_FIELDS
+        else:
+            sl = self._select(code)
+            times = self._time[sl]
+            fields = self.FIELDS
+            values = {f: self._state[f][sl] for f in fields}
+
+        if freq is None:
+            idx = _last_of_each(times)
+            index = times[idx]
+        else:
+            if not len(times):
+                idx = np.empty(0, dtype=np.intp)
+                index = times
+            else:
+                grid = pd.date_range(
+                    pd.Timestamp(times[0], unit='us').floor(freq),
+                    pd.Timestamp(times[-1], unit='us'), freq=freq)
+                index = grid.values.astype('datetime64[us]').astype(np.int64)
+                # as-of: 每个时间点及之前的最后一行
+                idx = np.searchsorted(times, index, side='right') - 1
+
+        valid = idx >= 0
+        safe = np.maximum(idx, 0)
+        data = {f: np.where(valid, values[f][safe], 0.) for f in fields}
+        return pd.DataFrame(
+            data, index=pd.DatetimeIndex(index.astype('datetime64[us]')))
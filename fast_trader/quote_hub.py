@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+"""
+多进程部署时的行情转发
+
+行情进程运行`QuoteHub`: 接收dtp行情并解码一次, 以紧凑的二进制格式
+通过zmq XPUB发布; 各策略进程以`RemoteQuoteFeed`代替`QuoteFeed`
+订阅所需代码, 并各自持有`Trader`处理柜台回报。
+行情进程可直接以`python -m fast_trader.quote_hub`启动。
+
+消息为两帧: topic, payload
+
+- topic: `feed_name\\0code\\0`, 订阅全部代码时使用`feed_name\\0`作前缀,
+  由zmq在发布端完成过滤
+- payload: 2字节schema id + 数值字段(struct) + 以`\\0`分隔的字符串字段;
+  schema id为0时payload为json, 用于无法按schema编码的消息
+
+schema(字段名及类型)首次出现时在`SCHEMA_TOPIC`上公布, 新的订阅端
+接入时全部重新公布一次。策略进程的订阅变化经XPUB传递给`QuoteHub`,
+再由其向dtp订阅或退订。
+"""
+
+import json
+import struct
+import logging
+import operator
+import threading
+import collections
+
+import zmq
+
+from fast_trader.dtp_quote import (FEED_TYPE_NAME_MAPPING, QuoteDecoder,
+                                   QuoteRecord, _RecordPlan)
+from fast_trader.settings import settings
+from fast_trader.utils import attrdict
+from fast_trader import zmq_context
+
+
+SCHEMA_TOPIC = b'\x00schema'
+
+_HEADER = struct.Struct('<H')
+_FALLBACK = 0
+
+# 行情消息api_id -> 订阅时使用的feed名称
+_FEED_NAMES = {api_id: feed_type.name
+               for api_id, feed_type in FEED_TYPE_NAME_MAPPING.items()}
+
+
+def get_hub_address():
+    conf = settings.get('quote_hub') or {}
+    return conf.get('address', 'tcp://127.0.0.1:5599')
+
+
+def make_topic(feed_name, code=None):
+    if code is None:
+        return f'{feed_name}\x00'.encode()
+    return f'{feed_name}\x00{code}\x00'.encode()
+
+
+def parse_topic(topic):
+    feed_name, code = topic.decode().split('\x00')[:2]
+    return feed_name, code or None
+
+
+class _Schema:
+    """
+    某类行情在特定字段组合下的二进制编码格式
+    """
+
+    __slots__ = ('schema_id', 'api_id', 'header', 'fields', 'types',
+                 'struct', 'num_fields', 'str_fields',
+                 'get_nums', 'get_strs', 'record_cls', 'setters')
+
+    # 类型代码 -> struct格式, 's'为字符串
+    FORMATS = {'?': '?', 'q': 'q', 'd': 'd'}
+
+    def __init__(self, schema_id, api_id, header, fields, types):
+        self.schema_id = schema_id
+        self.api_id = api_id
+        self.header = header
+        self.fields = tuple(fields)
+        self.types = tuple(types)
+
+        self.num_fields = tuple(
+            f for f, t in zip(self.fields, self.types) if t != 's')
+        self.str_fields = tuple(
+            f for f, t in zip(self.fields, self.types) if t == 's')
+        self.struct = struct.Struct('<' + ''.join(
+            self.FORMATS[t] for t in self.types if t != 's'))
+
+        self.get_nums = self._getter(self.num_fields)
+        self.get_strs = self._getter(self.str_fields)
+
+        self.record_cls = None
+        self.setters = None
+
+    @staticmethod
+    def _getter(fields):
+        if not fields:
+            return lambda record: ()
+        if len(fields) == 1:
+            getter = operator.attrgetter(fields[0])
+            return lambda record: (getter(record),)
+        return operator.attrgetter(*fields)
+
+    @staticmethod
+    def infer_types(record):
+        """
+        字段类型代码, 存在无法编码的字段时返回None
+        """
+        types = []
+        for value in record.values():
+            tp = type(value)
+            if tp is bool:
+                types.append('?')
+            elif tp is int:
+                types.append('q')
+            elif tp is float:
+                types.append('d')
+            elif tp is str:
+                types.append('s')
+            else:
+                return None
+        return types
+
+    def to_json(self):
+        return json.dumps({
+            'schema_id': self.schema_id,
+            'api_id': self.api_id,
+            'header': self.header,
+            'fields': self.fields,
+            'types': self.types,
+        }).encode()
+
+    @classmethod
+    def from_json(cls, raw):
+        d = json.loads(raw)
+        schema = cls(d['schema_id'], d['api_id'], d['header'],
+                     d['fields'], d['types'])
+        schema.compile_decoder()
+        return schema
+
+    def compile_decoder(self):
+        feed_type = FEED_TYPE_NAME_MAPPING[self.api_id]
+        self.record_cls = _RecordPlan(feed_type, self.fields).record_cls
+        self.setters = tuple(
+            getattr(self.record_cls, f).__set__
+            for f in self.num_fields + self.str_fields)
+
+    def encode(self, record):
+        """
+        编码为payload, 字段值与schema不符时返回None
+        """
+        strs = self.get_strs(record)
+        try:
+            body = self.struct.pack(*self.get_nums(record))
+            if strs:
+                text = '\x00'.join(strs)
+                if text.count('\x00') != len(strs) - 1:
+                    return None
+                body += text.encode()
+        except (struct.error, TypeError):
+            return None
+        return _HEADER.pack(self.schema_id) + body
+
+    def decode(self, payload):
+        values = self.struct.unpack_from(payload, _HEADER.size)
+        if self.str_fields:
+            offset = _HEADER.size + self.struct.size
+            values += tuple(payload[offset:].decode().split('\x00'))
+        record = object.__new__(self.record_cls)
+        for set_, value in zip(self.setters, values):
+            set_(record, value)
+        mail = attrdict(self.header)
+        mail['content'] = record
+        return mail
+
+
+class QuoteHub:
+    """
+    行情转发
+
+    Parameters
+    ----------
+    quote_feed: QuoteFeed
+        dtp行情通道, 默认新建; 由`QuoteHub`负责启动与订阅
+    address: str
+        发布地址, 默认读取配置`quote_hub.address`;
+        Linux下建议使用`ipc://`
+    """
+
+    BATCH_SIZE = 256
+
+    def __init__(self, quote_feed=None, address=None):
+        if quote_feed is None:
+            from fast_trader.strategy import QuoteFeed
+            quote_feed = QuoteFeed()
+
+        self.quote_feed = quote_feed
+        self.address = address or get_hub_address()
+        self.logger = logging.getLogger('quote_hub')
+
+        self._decoder = QuoteDecoder()
+        # (api_id, fields) -> _Schema
+        self._schemas = {}
+        # 已向dtp订阅的topic
+        self._upstream = set()
+
+        self._running = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+        self.published = 0
+        self.fallback = 0
+
+    def start(self):
+        self._running = True
+        self.quote_feed.start(recv=False)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def get_stats(self):
+        return {
+            'published': self.published,
+            'fallback': self.fallback,
+            'schemas': len(self._schemas),
+            'topics': len(self._upstream),
+        }
+
+    def _get_schema(self, mail, record):
+        key = (mail['api_id'], record.keys())
+        if key in self._schemas:
+            return self._schemas[key], False
+
+        types = _Schema.infer_types(record)
+        if types is None:
+            schema = None
+        else:
+            header = {k: v for k, v in mail.items() if k != 'content'}
+            schema = _Schema(len(self._schemas) + 1, mail['api_id'],
+                             header, record.keys(), types)
+        self._schemas[key] = schema
+        return schema, schema is not None
+
+    def _encode(self, pub, mail):
+        record = mail['content']
+        payload = None
+        if isinstance(record, QuoteRecord):
+            schema, created = self._get_schema(mail, record)
+            if created:
+                pub.send_multipart([SCHEMA_TOPIC, schema.to_json()])
+            if schema is not None and \
+                    len(mail) == len(schema.header) + 1 and \
+                    all(mail[k] == v for k, v in schema.header.items()):
+                payload = schema.encode(record)
+
+        if payload is None:
+            self.fallback += 1
+            content = record.to_dict() if isinstance(record, QuoteRecord) \
+                else dict(record)
+            header = {k: v for k, v in mail.items() if k != 'content'}
+            payload = _HEADER.pack(_FALLBACK) + json.dumps(
+                {'header': header, 'content': content}).encode()
+        return payload
+
+    def _publish(self, pub, raw):
+        mail = self._decoder.decode(raw)
+        topic = make_topic(_FEED_NAMES[mail['api_id']],
+                           mail['content'].get('szCode'))
+        pub.send_multipart([topic, self._encode(pub, mail)])
+        self.published += 1
+
+    def _announce_schemas(self, pub):
+        for schema in self._schemas.values():
+            if schema is not None:
+                pub.send_multipart([SCHEMA_TOPIC, schema.to_json()])
+
+    def _on_subscription(self, pub, msg):
+        subscribe, topic = msg[0] == 1, msg[1:]
+        if topic == SCHEMA_TOPIC:
+            if subscribe:
+                self._announce_schemas(pub)
+            return
+
+        feed_name, code = parse_topic(topic)
+        if subscribe:
+            if topic in self._upstream:
+                return
+            self._upstream.add(topic)
+            if code is None:
+                self.quote_feed.subscribe_all(feed_name)
+            else:
+                self.quote_feed.subscribe(feed_name, [code])
+        else:
+            # 所有策略进程均已退订
+            self._upstream.discard(topic)
+            if code is not None:
+                self.quote_feed.unsubscribe(feed_name, [code])
+        self.logger.info(
+            f'{"subscribe" if subscribe else "unsubscribe"} '
+            f'{feed_name} {code or "*"}')
+
+    def _run(self):
+        ctx = zmq_context.manager.context
+
+        sub = ctx.socket(zmq.SUB)
+        port = self.quote_feed._get_bound_port()
+        sub.connect(f'tcp://127.0.0.1:{port}')
+        sub.subscribe('')
+
+        pub = ctx.socket(zmq.XPUB)
+        # 每个订阅请求都转发过来, 以便向新接入的策略进程公布schema;
+        # 退订仅在最后一个订阅者退订时转发
+        pub.setsockopt(zmq.XPUB_VERBOSE, 1)
+        pub.bind(self.address)
+
+        poller = zmq.Poller()
+        poller.register(sub, zmq.POLLIN)
+        poller.register(pub, zmq.POLLIN)
+
+        try:
+            while self._running:
+                events = dict(poller.poll(100))
+                if pub in events:
+                    while True:
+                        try:
+                            msg = pub.recv(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                        self._on_subscription(pub, msg)
+
+                if sub in events:
+                    # 限制单次处理条数, 行情密集时也能及时响应订阅请求
+                    for _ in range(self.BATCH_SIZE):
+                        try:
+                            raw = sub.recv(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                        try:
+                            self._publish(pub, raw)
+                        except Exception:
+                            self.logger.exception('转发行情失败')
+        finally:
+            sub.close(linger=0)
+            pub.close(linger=0)
+
+
+class RemoteQuoteFeed:
+    """
+    策略进程中的行情通道, 接口与`QuoteFeed`一致
+
+    订阅请求经内部inproc通道交由接收线程执行, zmq socket仅在接收
+    线程中使用
+    """
+
+    def __init__(self, address=None):
+        self.address = address or get_hub_address()
+        self.logger = logging.getLogger('quote_hub')
+        self._callbacks = collections.OrderedDict()
+        self._schemas = {}
+
+        ctx = zmq_context.manager.context
+        control_address = f'inproc://remote_quote_feed_{id(self)}'
+        self._control_in = ctx.socket(zmq.PULL)
+        self._control_in.bind(control_address)
+        self._control = ctx.socket(zmq.PUSH)
+        self._control.connect(control_address)
+        self._control_lock = threading.Lock()
+
+        self._quote_feed_thread = threading.Thread(
+            target=self._recv, daemon=True)
+
+        self.received = 0
+        # 因未收到schema而丢弃的消息
+        self.dropped = 0
+
+    def _send_control(self, op, topics):
+        with self._control_lock:
+            for topic in topics:
+                self._control.send_multipart([op, topic])
+
+    def subscribe(self, feed_name, codes):
+        self._send_control(
+            b'sub', [make_topic(feed_name, code) for code in codes])
+
+    def subscribe_all(self, feed_name):
+        self._send_control(b'sub', [make_topic(feed_name)])
+
+    def unsubscribe(self, feed_name, codes):
+        self._send_control(
+            b'unsub', [make_topic(feed_name, code) for code in codes])
+
+    def start(self, recv=True):
+        if recv:
+            self._quote_feed_thread.start()
+
+    def _decode(self, payload):
+        schema_id, = _HEADER.unpack_from(payload)
+        if schema_id == _FALLBACK:
+            d = json.loads(payload[_HEADER.size:])
+            mail = attrdict(d['header'])
+            feed_type = FEED_TYPE_NAME_MAPPING[mail['api_id']]
+            mail['content'] = feed_type.dict_base(d['content'])
+            return mail
+
+        schema = self._schemas.get(schema_id)
+        if schema is None:
+            self.dropped += 1
+            return None
+        return schema.decode(payload)
+
+    def _recv(self):
+        ctx = zmq_context.manager.context
+        sock = ctx.socket(zmq.SUB)
+        sock.connect(self.address)
+        sock.subscribe(SCHEMA_TOPIC)
+
+        control = self._control_in
+        poller = zmq.Poller()
+        poller.register(sock, zmq.POLLIN)
+        poller.register(control, zmq.POLLIN)
+
+        while True:
+            events = dict(poller.poll())
+
+            if control in events:
+                while True:
+                    try:
+                        op, topic = control.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    if op == b'sub':
+                        sock.subscribe(topic)
+                    else:
+                        sock.unsubscribe(topic)
+
+            if sock in events:
+                while True:
+                    try:
+                        topic, payload = sock.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+
+                    if topic == SCHEMA_TOPIC:
+                        schema = _Schema.from_json(payload)
+                        self._schemas[schema.schema_id] = schema
+                        continue
+
+                    mail = self._decode(payload)
+                    if mail is None:
+                        continue
+                    self.received += 1
+                    for cb in self._callbacks.values():
+                        cb(mail)
+
+    @property
+    def callbacks(self):
+        return self._callbacks
+
+    def add_callback(self, cb, name=None):
+        if name is None:
+            name = cb.__name__
+        self._callbacks[name] = cb
+
+    def remove_callback(self, cb_or_name):
+        if callable(cb_or_name):
+            name = cb_or_name.__name__
+        else:
+            name = cb_or_name
+        self._callbacks.pop(name)
+
+
+def main(argv=None):
+    """
+    独立运行行情转发进程, 订阅由各策略进程经`RemoteQuoteFeed`发起
+
+        python -m fast_trader.quote_hub [--address ADDRESS]
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description='运行行情转发进程')
+    parser.add_argument('--address',
+                        help='发布地址, 默认读取配置quote_hub.address')
+    parser.add_argument('--stats-interval', type=float, default=60.,
+                        help='输出转发统计的间隔(秒)')
+    args = parser.parse_args(argv)
+
+    hub = QuoteHub(address=args.address)
+    hub.start()
+    hub.logger.info(f'QuoteHub已启动, 发布地址: {hub.address}')
+    try:
+        while hub._thread.is_alive():
+            hub.join(args.stats_interval)
+            hub.logger.info(f'转发统计: {hub.get_stats()}')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        hub.stop()
+        hub.join()
+
+
+if __name__ == '__main__':
+    main()
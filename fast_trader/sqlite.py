@@ -150,7 +150,30 @@ class SqliteStore:
             _write()
 
     def write_many(self, docs):
-        list(map(self.write, docs))
+        """
+        在单个事务中写入多条记录, 各记录缺少的字段写入NULL
+        """
+        docs = list(docs)
+        if not docs:
+            return
+
+        fields = list(self.fields)
+        statement = "INSERT INTO {} ({}) VALUES ({})".format(
+            self.table_name,
+            ','.join(fields),
+            ','.join(['?'] * len(fields))
+        )
+        rows = [tuple(doc.get(f) for f in fields) for doc in docs]
+
+        def _write():
+            with self._conn:
+                self._conn.executemany(statement, rows)
+
+        try:
+            _write()
+        except sqlite3.OperationalError as e:
+            self.reset_connection(exc=e)
+            _write()
 
     def read(self, query=None, limit=None):
 
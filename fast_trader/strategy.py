@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
 import time
+import functools
+import itertools
 import datetime
 import threading
 import logging
@@ -9,7 +12,7 @@ import collections
 import zmq
 import sqlite3
 
-from fast_trader.dtp_quote import FEED_TYPE_NAME_MAPPING
+from fast_trader.dtp_quote import FEED_TYPE_NAME_MAPPING, QuoteDecoder
 
 from fast_trader.dtp_trade import DTP, Trader, Dispatcher, dtp_type
 from fast_trader.dtp_trade import (OrderResponse, TradeResponse,
@@ -19,12 +22,15 @@ from fast_trader.dtp_trade import (OrderResponse, TradeResponse,
                                    str2float)
 
 from fast_trader.models import StrategyStatus
+from fast_trader.id_pool import _id_pool
 
 from fast_trader.settings import settings, Session
 from fast_trader.utils import (Mail, timeit, attrdict,
                                as_wind_code, get_current_ts)
 
 from fast_trader.ledger import LedgerWriter
+from fast_trader.mail_queue import StrategyMailbox
+from fast_trader.quote_hub import RemoteQuoteFeed
 from fast_trader import zmq_context
 
 #import dtp_api
@@ -41,14 +47,15 @@ class Subscription:
     def __init__(self, name=''):
         self.name = name
         self.subscribed_all = False
-        self.subscribed_codes = []
+        self.subscribed_codes = set()
 
     def has_subscribed(self, code):
-        if self.subscribed_all:
-            return True
-        if code in self.subscribed_codes:
-            return True
-        return False
+        return self.subscribed_all or code in self.subscribed_codes
+
+
+# 行情消息api_id -> 订阅时使用的feed名称
+_FEED_NAMES = {api_id: feed_type.name
+               for api_id, feed_type in FEED_TYPE_NAME_MAPPING.items()}
 
 
 class QuoteFeed(dtp_api.QuoteFeed):
@@ -57,6 +64,8 @@ class QuoteFeed(dtp_api.QuoteFeed):
         dtp_api.QuoteFeed.__init__(self)
         self._callbacks = collections.OrderedDict()    
         self._quote_feed_thread = threading.Thread(target=self._recv)
+        # 已退订但底层接口仍在推送的代码, feed_name -> set(codes)
+        self._muted = collections.defaultdict(set)
     
     def _recv(self):
         ctx = zmq_context.manager.context
@@ -64,18 +73,77 @@ class QuoteFeed(dtp_api.QuoteFeed):
         port = self._get_bound_port()
         sock.connect(f'tcp://127.0.0.1:{port}')
         sock.subscribe('')
-        
+
+        callbacks = self._callbacks
+        make_mail = self._get_mail_maker()
+
         while True:
-            mail = attrdict(sock.recv_json())
-            # format
-            feed_type = FEED_TYPE_NAME_MAPPING[mail['api_id']]
-            mail['content'] = feed_type.standardize(mail['content'])
-            for cb in self._callbacks.values():
+            mail = make_mail(sock.recv())
+            if mail is None:
+                continue
+
+            for cb in callbacks.values():
                 cb(mail)
+
+    def _get_mail_maker(self):
+        """
+        行情消息解码函数, 已退订代码的行情返回None
+        """
+        muted = self._muted
+        decoder = QuoteDecoder() if settings.get('fast_quote_decode') \
+            else None
+
+        def make_mail(raw):
+            if decoder is not None:
+                mail = decoder.decode(raw)
+            else:
+                msg = json.loads(raw)
+                data = msg.pop('content')
+                mail = attrdict(msg)
+                # format
+                feed_type = FEED_TYPE_NAME_MAPPING[mail['api_id']]
+                mail['content'] = feed_type.standardize(
+                    feed_type.dict_base(data))
+
+            if muted and mail['content'].get('szCode') in \
+                    muted.get(_FEED_NAMES[mail['api_id']], ()):
+                return None
+            return mail
+
+        return make_mail
+
+    def subscribe(self, feed_name, codes):
+        muted = self._muted.get(feed_name)
+        if muted:
+            muted.difference_update(codes)
+        super().subscribe(feed_name, codes)
+
+    def subscribe_all(self, feed_name):
+        self._muted.pop(feed_name, None)
+        super().subscribe_all(feed_name)
+
+    def unsubscribe(self, feed_name, codes):
+        """
+        退订行情
+
+        底层接口不支持退订时, 在接收线程中丢弃这些代码的行情,
+        省去后续的格式转换与分发
+        """
+        native_unsubscribe = getattr(super(), 'unsubscribe', None)
+        if native_unsubscribe is not None:
+            native_unsubscribe(feed_name, codes)
+        else:
+            self._muted[feed_name].update(codes)
     
-    def start(self):
+    def start(self, recv=True):
+        """
+        启动行情通道
+
+        recv为False时不启动接收线程, 由调用方自行接收(见`QuoteHub`)
+        """
         super().start()
-        self._quote_feed_thread.start()
+        if recv:
+            self._quote_feed_thread.start()
 
     @property
     def callbacks(self):
@@ -102,14 +170,29 @@ class QuoteFeed(dtp_api.QuoteFeed):
 
 class Market:
 
-    def __init__(self, dispatcher):
+    def __init__(self, dispatcher, quote_feed=None):
 
         self.dispatcher = dispatcher
         self.datasources = {}
         self._strategies = []
         self._started = False
-        
-        self.quote_feed = QuoteFeed()
+
+        # 行情路由表, 订阅变化时更新
+        # feed_name -> {code: [strategies]}
+        self._code_subscribers = collections.defaultdict(
+            lambda: collections.defaultdict(list))
+        # feed_name -> [strategies], 订阅了全部代码的策略
+        self._all_subscribers = collections.defaultdict(list)
+        # feed_name -> ({code: (strategies)}, (all_subscribers))
+        self._routes = {}
+        # 策略添加顺序, 路由表中的策略按此排序
+        self._strategy_order = {}
+        self._order_counter = itertools.count()
+
+        # 多进程部署时为RemoteQuoteFeed, 见`fast_trader.quote_hub`
+        if quote_feed is None:
+            quote_feed = QuoteFeed()
+        self.quote_feed = quote_feed
 
     def start(self):
         if self._started:
@@ -129,28 +212,162 @@ class Market:
 
     def add_strategy(self, strategy):
         self._strategies.append(strategy)
+        self._strategy_order[id(strategy)] = next(self._order_counter)
 
     def remove_strategy(self, strategy):
         self._strategies.remove(strategy)
 
-    def subscribe(self, feed_type, codes):
-        
+        # 释放仅由该策略订阅的行情
+        for feed_name in list(self._routes):
+            released = self._unroute(feed_name, None, strategy)
+            if released:
+                self.quote_feed.unsubscribe(feed_name, released)
+
+        self._strategy_order.pop(id(strategy), None)
+
+    def _sorted(self, strategies):
+        """
+        按策略添加顺序排序, 未添加的策略排在最后
+        """
+        order = self._strategy_order
+        return tuple(sorted(
+            strategies, key=lambda s: order.get(id(s), float('inf'))))
+
+    def _rebuild_routes(self, feed_name):
+        """
+        合并逐代码订阅与全订阅, 按策略添加顺序生成路由表
+
+        仅在全订阅变化时调用, 逐代码订阅的变化见`_update_routes`
+        """
+        all_subs = self._all_subscribers[feed_name]
+        routes = {}
+        for code, subs in self._code_subscribers[feed_name].items():
+            merged = set(subs).union(all_subs)
+            if merged:
+                routes[code] = self._sorted(merged)
+
+        self._routes[feed_name] = (routes, self._sorted(all_subs))
+
+    def _update_routes(self, feed_name, codes):
+        """
+        只更新指定代码的路由
+        """
+        if feed_name not in self._routes:
+            self._rebuild_routes(feed_name)
+            return
+
+        routes, all_subs = self._routes[feed_name]
+        code_subscribers = self._code_subscribers[feed_name]
+        for code in codes:
+            subs = code_subscribers.get(code)
+            if subs:
+                routes[code] = self._sorted(set(subs).union(all_subs))
+            else:
+                # 回退至全订阅
+                routes.pop(code, None)
+
+    def _route(self, feed_name, codes, strategy):
+        if codes is None:
+            subscribers = self._all_subscribers[feed_name]
+            if strategy not in subscribers:
+                subscribers.append(strategy)
+                self._rebuild_routes(feed_name)
+        else:
+            code_subscribers = self._code_subscribers[feed_name]
+            changed = []
+            for code in codes:
+                subs = code_subscribers[code]
+                if strategy not in subs:
+                    subs.append(strategy)
+                    changed.append(code)
+            self._update_routes(feed_name, changed)
+
+    def _unroute(self, feed_name, codes, strategy):
+        """
+        移除策略的订阅, 返回已无任何策略订阅的代码
+        """
+        code_subscribers = self._code_subscribers[feed_name]
+        rebuild = False
+        if codes is None:
+            subscribers = self._all_subscribers[feed_name]
+            if strategy in subscribers:
+                subscribers.remove(strategy)
+                rebuild = True
+            codes = [code for code, subs in code_subscribers.items()
+                     if strategy in subs]
+
+        released = []
+        changed = []
+        for code in codes:
+            subs = code_subscribers.get(code)
+            if subs is None:
+                continue
+            if strategy in subs:
+                subs.remove(strategy)
+                changed.append(code)
+            if not subs:
+                code_subscribers.pop(code, None)
+                released.append(code)
+
+        if rebuild:
+            self._rebuild_routes(feed_name)
+        else:
+            self._update_routes(feed_name, changed)
+
+        if self._all_subscribers[feed_name]:
+            return []
+        return released
+
+    def subscribe(self, feed_type, codes, strategy=None):
+
+        if strategy is not None:
+            self._route(feed_type.name, codes, strategy)
+
         if codes is None:
             self.quote_feed.subscribe_all(feed_type.name)
         else:
             self.quote_feed.subscribe(feed_type.name, codes)
 
-    def subscribe_all(self, feed_type):
-        self.subscribe(feed_type, codes=None)
+    def subscribe_all(self, feed_type, strategy=None):
+        self.subscribe(feed_type, codes=None, strategy=strategy)
+
+    def unsubscribe(self, feed_type, codes, strategy=None):
+        """
+        退订行情
+
+        仅当没有其他策略订阅时, 才向底层行情接口退订该代码
+        codes为None时, 移除该策略对此类行情的全部订阅
+        (底层的全市场订阅不会被撤销, 只是不再分发给该策略)
+        """
+        if strategy is None:
+            released = codes or []
+        else:
+            released = self._unroute(feed_type.name, codes, strategy)
+
+        if released:
+            self.quote_feed.unsubscribe(feed_type.name, released)
+
+    def get_subscribers(self, feed_name, code):
+        """
+        订阅了该行情的策略
+        """
+        try:
+            routes, all_subs = self._routes[feed_name]
+        except KeyError:
+            return ()
+        return routes.get(code, all_subs)
 
     def on_quote_message(self, message):
         # TODO: 期货类FuturesFeed, OptionsFeed 字段名称不一致
         code = message['content']['szCode']
-        feed_name = message['api_id']
-        feed_type = FEED_TYPE_NAME_MAPPING[feed_name]
-        for ea in self._strategies:
-            if ea.started and ea.has_subscribed(feed_type, code):
-                ea.on_quote_message(message)
+        feed_name = _FEED_NAMES[message['api_id']]
+        for ea in self.get_subscribers(feed_name, code):
+            if ea.started:
+                mailbox = ea._mailbox
+                if mailbox is None:
+                    ea.on_quote_message(message)
+                else:
+                    mailbox.put(ea.on_quote_message, message)
 
 
 class _limitedattrdict(attrdict):
@@ -261,18 +478,36 @@ class StrategyMdSubMixin:
 
         if codes is None:
             sub.subscribed_all = True
-            self.market.subscribe_all(feed_type)
+            self.market.subscribe_all(feed_type, strategy=self)
         else:
             if isinstance(codes, str):
                 codes = [codes]
-            for c in codes:
-                if c not in sub.subscribed_codes:
-                    sub.subscribed_codes.append(c)
-            self.market.subscribe(feed_type, codes)
+            sub.subscribed_codes.update(codes)
+            self.market.subscribe(feed_type, codes, strategy=self)
 
     def subscribe_all(self, feed_type):
         self.subscribe(feed_type, codes=None)
 
+    def unsubscribe(self, feed_type, codes=None):
+        """
+        退订行情
+
+        codes为None时退订该类行情的全部订阅
+        """
+        feed_name = feed_type.name
+        sub = self._md_subscriptions.get(feed_name)
+        if sub is None:
+            return
+
+        if codes is None:
+            self._md_subscriptions.pop(feed_name)
+        else:
+            if isinstance(codes, str):
+                codes = [codes]
+            sub.subscribed_codes.difference_update(codes)
+
+        self.market.unsubscribe(feed_type, codes, strategy=self)
+
     def has_subscribed(self, feed_type, code):
         feed_name = feed_type.name
         if feed_name not in self._md_subscriptions:
@@ -283,6 +518,28 @@ class StrategyMdSubMixin:
         return ret
 
 
+class StrategyMailboxMixin:
+    """
+    策略专属mailbox, 启用后行情、柜台回报与定时任务的回调均在
+    mailbox线程中按顺序执行, 见`StrategyMailbox`
+    """
+
+    _mailbox = None
+
+    def enable_mailbox(self):
+        if self._mailbox is None:
+            self._mailbox = StrategyMailbox(
+                name=f'{self.get_strategy_name()}_{self.strategy_id}')
+
+    def get_mailbox_stats(self):
+        """
+        mailbox积压深度与回调耗时, 未启用时返回None
+        """
+        if self._mailbox is None:
+            return None
+        return self._mailbox.get_stats()
+
+
 class StrategyWatchMixin:
     """
     策略运行状态监控
@@ -318,31 +575,36 @@ class StrategyWatchMixin:
         session.commit()
         session.close()
 
+        self._start_heartbeat()
+
+    def _start_heartbeat(self):
         if not hasattr(self, '_heartbeat_thread'):
             self._heartbeat_thread = threading.Thread(
                 target=self._send_heartbeat)
             self._heartbeat_thread.start()
 
     def _send_heartbeat(self):
+        while self._started:
+            self._heartbeat_once()
+            time.sleep(0.5)
+
+    def _heartbeat_once(self):
         # FIXME: scoped session
         if not hasattr(self, '_session'):
             self._session = Session()
 
-        while self._started:
-            ts = get_current_ts()
-
-            try:
-                (self._session
-                    .query(StrategyStatus)
-                    .filter_by(strategy_id=self.strategy_id,
-                            account_no=self.account_no)
-                    .update({'last_heartbeat': ts}))
-            except sqlite3.OperationalError:
-                pass
+        ts = get_current_ts()
 
+        try:
+            (self._session
+                .query(StrategyStatus)
+                .filter_by(strategy_id=self.strategy_id,
+                        account_no=self.account_no)
+                .update({'last_heartbeat': ts}))
+        except sqlite3.OperationalError:
+            pass
 
-            self._session.commit()
-            time.sleep(0.5)
+        self._session.commit()
 
     def _check_strategy_status(self):
         """
@@ -367,7 +629,8 @@ class StrategyWatchMixin:
         session.close()
 
 
-class Strategy(StrategyWatchMixin, StrategyMdSubMixin):
+class Strategy(StrategyWatchMixin, StrategyMdSubMixin,
+               StrategyMailboxMixin):
 
     strategy_name = 'unnamed'
     # strategy_id = -1
@@ -397,13 +660,9 @@ class Strategy(StrategyWatchMixin, StrategyMdSubMixin):
         self._positions = {}
         self._orders = collections.defaultdict(attrdict)
         self._trades = collections.defaultdict(attrdict)
-        self._request_id_history = []
 
         self.subscribed_datasources = []
 
-        # order_exchange_id -> order_original_id
-        self._order_id_mapping = {}
-
     def _config_logger(self):
         # self.logger = logging.getLogger(
         #     f'strategy.<no={account_no};id={strategy_id};'
@@ -469,6 +728,9 @@ class Strategy(StrategyWatchMixin, StrategyMdSubMixin):
             # 启动行情订阅
             self.market.start()
 
+            if self._mailbox is not None:
+                self._mailbox.start()
+
             self._send_on_start_event()
 
             self._started = True
@@ -496,6 +758,12 @@ class Strategy(StrategyWatchMixin, StrategyMdSubMixin):
         self.trader.remove_strategy(self)
         self.market.remove_strategy(self)
         self._started = False
+        if self._mailbox is not None:
+            self._mailbox.stop()
+        ledger_writer = getattr(self, '_ledger_writer', None)
+        if ledger_writer is not None:
+            # 提交后台写入中的流水
+            ledger_writer.close()
 
     def _send_on_start_event(self):
         # 借用order_original_id标记该消息归属
@@ -571,40 +839,27 @@ class Strategy(StrategyWatchMixin, StrategyMdSubMixin):
     def generate_request_id(self):
         request_id = self.trader.generate_request_id(self.strategy_id)
         # 部分响应数据，如CANCEL RESPONSE无`order_original_id`,
-        # 需要记录request_id用来确定此类消息的策略归属
+        # 需要登记request_id用来确定此类消息的策略归属
         # 但在使用rest api接口时，无法指定request_id
-        self._request_id_history.append(request_id)
+        self.trader.register_request(request_id, self)
         return request_id
 
     def _check_owner(self, obj):
         """
         判断响应数据是否属于当前策略
         """
+        return self.trader.get_owner(obj) is self
 
-        id_range = self._id_whole_range
-
-        def _check_order_id(o):
-            _id = o['order_original_id']
-            if int(_id) in id_range:
-                return True
-            return False
-
-        if 'order_original_id' in obj:
-            return _check_order_id(obj)
-        elif 'body' in obj:
-            if 'order_original_id' in obj['body']:
-                return _check_order_id(obj['body'])
-            elif 'order_exchange_id' in obj['body']:
-                # cancel response has 'order_exchange_id'
-                # but no 'order_original_id'
-                exchange_id = obj['body']['order_exchange_id']
-                if exchange_id in self._order_id_mapping:
-                    return True
-
-            if obj['header']['request_id'] in self._request_id_history:
-                return True
-
-        return False
+    def _filter_owned(self, records):
+        """
+        批量筛选属于当前策略的查询结果(委托/成交)
+        """
+        if not records:
+            return records
+        owners = _id_pool.owners_of(
+            [r['order_original_id'] for r in records])
+        return list(itertools.compress(
+            records, owners == self.strategy_id))
 
     def get_account_orders(self):
         """
@@ -660,7 +915,7 @@ class Strategy(StrategyWatchMixin, StrategyMdSubMixin):
         查询报单
         """
         orders = self.get_account_orders()
-        orders = [order for order in orders if self._check_owner(order)]
+        orders = self._filter_owned(orders)
         return orders
 
     def get_open_orders(self):
@@ -670,7 +925,7 @@ class Strategy(StrategyWatchMixin, StrategyMdSubMixin):
         # TODO: 通过参数查询
         # TODO: 默认使用本地委托记录
         orders = self.get_account_open_orders()
-        orders = [order for order in orders if self._check_owner(order)]
+        orders = self._filter_owned(orders)
         return orders
 
     def get_trades(self):
@@ -678,7 +933,7 @@ class Strategy(StrategyWatchMixin, StrategyMdSubMixin):
         查询成交（同步）
         """
         trades = self.get_account_trades()
-        trades = [trade for trade in trades if self._check_owner(trade)]
+        trades = self._filter_owned(trades)
         return trades
 
     def get_orders_local(self):
@@ -897,9 +1152,6 @@ class Strategy(StrategyWatchMixin, StrategyMdSubMixin):
                 order.status == dtp_type.ORDER_STATUS_UNDEFINED:
             order['status'] = dtp_type.ORDER_STATUS_FAILED
 
-        self._order_id_mapping[order['order_exchange_id']] =\
-            order['order_original_id']
-
         self.logger.info(as_order_msg(order))
 
         # if msg.header.code == dtp_type.RESPONSE_CODE_OK:
@@ -1066,8 +1318,10 @@ class Strategy(StrategyWatchMixin, StrategyMdSubMixin):
 
         self.trader.place_batch_order(orders=orders)
 
-        for order in orders:
-            order = self._store_order(order)
+        # 全部委托的冻结流水在一个事务中写入
+        with self._ledger_writer.batch():
+            for order in orders:
+                order = self._store_order(order)
 
         return orders
 
@@ -1145,7 +1399,20 @@ class Strategy(StrategyWatchMixin, StrategyMdSubMixin):
         for order in orders:
             self.cancel_order(**order)
 
+    def _wrap_task(self, func, args, kw):
+        """
+        启用mailbox时, 定时任务到期后交由mailbox线程执行
+        """
+        if self._mailbox is None:
+            return func, args, kw
+        call = functools.partial(func, *(args or ()), **(kw or {}))
+        return functools.partial(self._mailbox.put, call), None, None
+
     def run_at_time(self, time, func, args=None, kw=None):
+        """
+        在指定时间执行一次, 返回的任务可通过`cancel_task`取消
+        """
+        func, args, kw = self._wrap_task(func, args, kw)
         task = TimerTask(
             schedule=time,
             some_callable=func,
@@ -1153,8 +1420,13 @@ class Strategy(StrategyWatchMixin, StrategyMdSubMixin):
             kw=kw)
 
         self.trader.dispatcher.timer.add_task(task)
+        return task
 
     def run_at_intervals(self, interval, func, args=None, kw=None):
+        """
+        按固定频率重复执行, 返回的任务可通过`cancel_task`取消
+        """
+        func, args, kw = self._wrap_task(func, args, kw)
         task = TimerTask(
             schedule=interval,
             some_callable=func,
@@ -1162,6 +1434,13 @@ class Strategy(StrategyWatchMixin, StrategyMdSubMixin):
             kw=kw)
 
         self.trader.dispatcher.timer.add_task(task)
+        return task
+
+    def cancel_task(self, task):
+        """
+        取消定时任务
+        """
+        self.trader.dispatcher.timer.remove_task(task)
 
 
 class StrategyFactory:
@@ -1184,7 +1463,12 @@ class StrategyFactory:
         self.dtp = DTP(self.dispatcher)
 
         # 行情通道
-        self.market = Market(self.dispatcher)
+        # 启用quote_hub时从行情进程接收已解码的行情, 不直连dtp行情
+        if (settings.get('quote_hub') or {}).get('enabled'):
+            quote_feed = RemoteQuoteFeed()
+        else:
+            quote_feed = None
+        self.market = Market(self.dispatcher, quote_feed=quote_feed)
 
         # trader与账号一一对应
         self.traders = {}
@@ -1195,6 +1479,9 @@ class StrategyFactory:
         strategy = strategy_cls(strategy_id, account_no)
         strategy.persistent = persistent
 
+        if (settings.get('dispatcher') or {}).get('strategy_workers'):
+            strategy.enable_mailbox()
+
         if account_no not in self.traders:
 
             trader = Trader(
@@ -1229,3 +1516,15 @@ class StrategyFactory:
     def remove_strategy(self, strategy):
         self.market.remove_strategy(strategy)
         strategy.trader.remove_strategy(strategy)
+
+    def get_mailbox_stats(self):
+        """
+        各策略mailbox的积压深度与回调耗时
+        """
+        strategies = {}
+        for trader in self.traders.values():
+            for strategy in trader._strategies:
+                strategies[strategy.strategy_id] = strategy
+        return {strategy_id: strategy.get_mailbox_stats()
+                for strategy_id, strategy in strategies.items()
+                if strategy._mailbox is not None}
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import datetime
+import threading
+import collections
+import unittest
+from unittest import mock
+
+from fast_trader.aio import (AsyncDispatcher, AsyncMailbox, AsyncStrategy)
+from fast_trader.dtp_trade import TimerTask
+from fast_trader.strategy import Strategy
+from fast_trader.utils import attrdict
+
+
+class FakeStrategy:
+    """
+    仅包含AsyncMailbox所需属性
+    """
+
+    def __init__(self, dispatcher):
+        self.trader = attrdict(dispatcher=dispatcher)
+        self._pending = collections.deque()
+        self._mailbox = None
+        self.logger = logging.getLogger('test')
+
+    _defer = AsyncStrategy._defer
+    _run_detached = AsyncStrategy._run_detached
+    _run_in_executor = AsyncStrategy._run_in_executor
+    aget_open_orders = AsyncStrategy.aget_open_orders
+    acancel_all = AsyncStrategy.acancel_all
+
+
+class TestAsyncRuntime(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = AsyncDispatcher()
+        self.loop = self.dispatcher.loop
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_loop(self, secs):
+        self.loop.run_until_complete(asyncio.sleep(secs))
+
+    def test_dispatch_and_timer(self):
+        received = []
+        self.dispatcher.bind('1_order_rsp', received.append)
+        self.dispatcher.put({'handler_id': '1_order_rsp', 'n': 1})
+        self.dispatcher.put({'handler_id': 'unbound_rsp'})
+
+        ticks = []
+        task = TimerTask(datetime.timedelta(seconds=0.01),
+                         lambda: ticks.append(1))
+        once = TimerTask(datetime.datetime.now(), lambda: ticks.append(0))
+        self.dispatcher.timer.add_task(task)
+        self.dispatcher.timer.add_task(once)
+
+        self.run_loop(0.055)
+        self.dispatcher.timer.remove_task(task)
+        n = len(ticks)
+        self.run_loop(0.03)
+
+        self.assertEqual(received, [{'handler_id': '1_order_rsp', 'n': 1}])
+        self.assertEqual(ticks.count(0), 1)
+        self.assertGreaterEqual(ticks.count(1), 3)
+        self.assertEqual(len(ticks), n)
+        self.assertEqual(self.dispatcher.timer.tasks, [])
+
+    def test_mailbox_awaits_deferred_hooks(self):
+        strategy = FakeStrategy(self.dispatcher)
+        mailbox = strategy._mailbox = AsyncMailbox(strategy, name='test')
+        events = []
+
+        async def on_trade(n):
+            events.append(('start', n))
+            await asyncio.sleep(0.01)
+            events.append(('end', n))
+
+        on_trade = strategy._defer(on_trade)
+
+        def _on_trade(n):
+            # 同步处理部分先执行, 用户回调排入pending
+            events.append(('sync', n))
+            on_trade(n)
+
+        mailbox.start()
+        for n in range(2):
+            mailbox.put(_on_trade, n)
+        self.run_loop(0.1)
+
+        self.assertEqual(events, [('sync', 0), ('start', 0), ('end', 0),
+                                  ('sync', 1), ('start', 1), ('end', 1)])
+        self.assertEqual(mailbox.get_stats()['processed'], 2)
+        mailbox.stop()
+        self.run_loop(0.01)
+
+    def test_hooks_outside_mailbox(self):
+        strategy = FakeStrategy(self.dispatcher)
+        strategy._mailbox = AsyncMailbox(strategy, name='test')
+        strategy._mailbox.start()
+        events = []
+
+        async def on_stop(source):
+            await asyncio.sleep(0)
+            events.append(source)
+
+        on_stop = strategy._defer(on_stop)
+
+        # 事件循环中、mailbox之外调用(如定时任务中停止策略)
+        self.loop.call_soon(on_stop, 'loop')
+        # 其他线程中调用
+        thread = threading.Thread(target=on_stop, args=('thread',))
+        self.loop.call_soon(thread.start)
+        self.run_loop(0.05)
+        thread.join()
+        self.assertEqual(sorted(events), ['loop', 'thread'])
+        self.assertFalse(strategy._pending)
+        strategy._mailbox.stop()
+        self.run_loop(0.01)
+
+        # 事件循环未运行时在当前线程执行完毕
+        on_stop('stopped')
+        self.assertEqual(events[-1], 'stopped')
+
+    def test_async_queries(self):
+        strategy = FakeStrategy(self.dispatcher)
+        threads, canceled = [], []
+
+        def get_open_orders(self):
+            threads.append(threading.current_thread())
+            return [{'order_exchange_id': '1'}, {'order_exchange_id': '2'}]
+
+        strategy.cancel_order = lambda **kw: canceled.append(kw)
+        # 同步查询接口不被覆盖
+        self.assertIs(AsyncStrategy.get_open_orders, Strategy.get_open_orders)
+        with mock.patch.object(Strategy, 'get_open_orders', get_open_orders):
+            self.loop.run_until_complete(strategy.acancel_all())
+
+        # 柜台查询在线程池中执行
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual([kw['order_exchange_id'] for kw in canceled],
+                         ['1', '2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import time
+import datetime
+import threading
+import unittest
+from unittest import mock
+
+from fast_trader.dtp_trade import Dispatcher, TimerTask
+
+
+def wait_for(predicate, timeout=2.):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+class DispatcherTestCase(unittest.TestCase):
+
+    def make_dispatcher(self, **kw):
+        dispatcher = Dispatcher(**kw)
+
+        def stop():
+            dispatcher.stop()
+            dispatcher.join()
+
+        self.addCleanup(stop)
+        return dispatcher
+
+
+class TestLatency(DispatcherTestCase):
+
+    def check_lanes(self, **kw):
+        dispatcher = self.make_dispatcher(track_latency=True, **kw)
+        received = []
+        dispatcher.bind('0_test_rsp', received.append)
+        dispatcher.bind('quote_feed', received.append)
+
+        for _ in range(5):
+            dispatcher.put({'handler_id': '0_test_rsp'})
+            dispatcher.put({'handler_id': 'quote_feed'})
+        self.assertTrue(wait_for(lambda: len(received) == 10))
+
+        latency = dispatcher.get_stats()['latency']
+        self.assertEqual(latency['rsp']['count'], 5)
+        self.assertEqual(latency['market']['count'], 5)
+
+    def test_poll(self):
+        self.check_lanes(mode='poll')
+
+    def test_poll_prioritized(self):
+        self.check_lanes(mode='poll', prioritized=True)
+
+    def test_event(self):
+        self.check_lanes(mode='event')
+
+
+class TestEventMode(DispatcherTestCase):
+
+    def test_deliver_without_sleep(self):
+        sleepers = []
+        real_sleep = time.sleep
+
+        def sleep(secs):
+            sleepers.append(threading.current_thread())
+            real_sleep(secs)
+
+        with mock.patch.object(time, 'sleep', sleep):
+            dispatcher = self.make_dispatcher(mode='event')
+            received = []
+            dispatcher.bind('0_test_rsp', received.append)
+            dispatcher.bind('quote_feed', received.append)
+
+            # 空闲一段时间后入队, 消息立即被分发
+            wait_for(lambda: False, timeout=0.02)
+            rsp = {'handler_id': '0_test_rsp'}
+            market = {'handler_id': 'quote_feed'}
+            dispatcher.put(rsp)
+            dispatcher.put(market)
+            self.assertTrue(wait_for(lambda: len(received) == 2))
+
+        self.assertEqual(received, [rsp, market])
+        # 分发线程从未sleep轮询
+        self.assertNotIn(dispatcher._rsp_processor, sleepers)
+
+    def test_timer_fires_while_idle(self):
+        dispatcher = self.make_dispatcher(mode='event')
+        fired = threading.Event()
+        # 加入定时任务时分发线程正阻塞等待(无超时)
+        time.sleep(0.02)
+        dispatcher.timer.add_task(TimerTask(
+            datetime.datetime.now() + datetime.timedelta(seconds=0.05),
+            fired.set))
+
+        start = time.monotonic()
+        self.assertTrue(fired.wait(2))
+        self.assertGreaterEqual(time.monotonic() - start, 0.03)
+
+    def test_stop_wakes_blocked_wait(self):
+        dispatcher = Dispatcher(mode='event')
+        processor = dispatcher._rsp_processor
+        time.sleep(0.02)
+        self.assertTrue(processor.is_alive())
+
+        dispatcher.stop()
+        processor.join(1)
+        self.assertFalse(processor.is_alive())
+        dispatcher.join()
+
+
+class TestBatchDrain(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = Dispatcher(mode='event', market_batch_size=3)
+        # 停止处理线程, 由测试直接调用drain
+        self.dispatcher.stop()
+        self.dispatcher.join()
+
+    def test_capped_fifo_batches(self):
+        dispatcher = self.dispatcher
+        received = []
+        dispatcher.bind('quote_feed', lambda m: received.append(m['n']))
+        for i in range(10):
+            dispatcher.put({'handler_id': 'quote_feed', 'n': i})
+
+        batches = []
+        while True:
+            n = dispatcher._drain_lanes()
+            if not n:
+                break
+            batches.append(n)
+
+        self.assertEqual(batches, [3, 3, 3, 1])
+        self.assertEqual(received, list(range(10)))
+        stats = dispatcher.get_stats()
+        self.assertEqual(stats['market_drained'], 10)
+        self.assertEqual(stats['market_batches'], 4)
+        self.assertEqual(stats['max_market_batch'], 3)
+        self.assertEqual(stats['market_depth'], 0)
+
+    def test_rsp_drained_first(self):
+        dispatcher = self.dispatcher
+        received = []
+        dispatcher.bind('quote_feed', lambda m: received.append(m['n']))
+        dispatcher.bind('0_test_rsp', lambda m: received.append(m['n']))
+        for i in range(4):
+            dispatcher.put({'handler_id': 'quote_feed', 'n': i})
+        for i in range(5):
+            dispatcher.put({'handler_id': '0_test_rsp', 'n': -i})
+
+        # 回报全部处理, 行情至多market_batch_size条
+        self.assertEqual(dispatcher._drain_lanes(), 3)
+        self.assertEqual(received, [0, -1, -2, -3, -4, 0, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
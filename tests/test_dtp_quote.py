@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import json
+import pickle
+import unittest
+
+from fast_trader.dtp_quote import (TickFeed, TradeFeed, QuoteDecoder,
+                                   OrderBook, TickDict)
+from fast_trader.utils import attrdict
+
+
+def raw_message(api_id, content):
+    return json.dumps({'api_id': api_id, 'handler_id': 'quote_feed',
+                       'content': content}).encode()
+
+
+class TestQuoteDecoder(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = QuoteDecoder()
+
+    def test_same_result_as_standardize(self):
+        content = {'szCode': '600000', 'nTime': 93000000}
+        for i, field in enumerate(TickFeed.int64_fields):
+            content[field] = str(123400 + i)
+
+        mail = self.decoder.decode(raw_message('tick_feed', content))
+        expected = TickFeed.standardize(attrdict(content))
+
+        self.assertEqual(mail.api_id, 'tick_feed')
+        self.assertEqual(mail['content'].to_dict(), dict(expected))
+        self.assertEqual(mail.content.nMatch, expected.nMatch)
+        self.assertEqual(mail['content']['szCode'], '600000')
+        self.assertIsInstance(mail.content.nAskVol_0, int)
+
+    def test_plan_reused(self):
+        raw = raw_message('trade_feed', {'szCode': '000001',
+                                         'nPrice': '105000',
+                                         'nTurnover': '210000'})
+        a = self.decoder.decode(raw).content
+        b = self.decoder.decode(raw).content
+        self.assertIs(type(a), type(b))
+        self.assertEqual(a.nPrice, 10.5)
+        self.assertEqual(b['nTurnover'], 210000)
+        self.assertEqual(TradeFeed.get_plan(),
+                         (('nPrice', 10000), ('nTurnover', None)))
+
+
+class TestBatchStandardize(unittest.TestCase):
+
+    def make_items(self):
+        return [{'szCode': '600000', 'nPrice': str(105000 + i),
+                 'nTurnover': str(1000 * i)} for i in range(3)]
+
+    def test_standardize_many(self):
+        items = self.make_items()
+        expected = [TradeFeed.standardize(dict(d)) for d in items]
+        self.assertEqual(TradeFeed.standardize_many(items), expected)
+
+    def test_to_columns(self):
+        cols = TradeFeed.to_columns(self.make_items())
+        self.assertEqual(cols['nPrice'].dtype.kind, 'f')
+        self.assertEqual(cols['nTurnover'].dtype.name, 'int64')
+        self.assertEqual(list(cols['nPrice']), [10.5, 10.5001, 10.5002])
+
+        items = TradeFeed.standardize_many(self.make_items())
+        arr = TradeFeed.to_structured_array(
+            items, fields=['nPrice', 'nTurnover'], standardized=True)
+        self.assertEqual(list(arr['nTurnover']), [0, 1000, 2000])
+        self.assertEqual(arr['nPrice'][0], 10.5)
+
+
+class TestOrderBook(unittest.TestCase):
+
+    def make_snapshot(self):
+        content = {'szCode': '600000'}
+        for field in TickFeed.int64_fields:
+            content[field] = '0'
+        for i in range(3):
+            content[f'nAskPrice_{i}'] = str(101000 + 1000 * i)
+            content[f'nBidPrice_{i}'] = str(100000 - 1000 * i)
+            content[f'nAskVol_{i}'] = str(100 * (i + 1))
+            content[f'nBidVol_{i}'] = str(300)
+        return content
+
+    def test_book_from_record(self):
+        raw = raw_message('tick_feed', self.make_snapshot())
+        record = QuoteDecoder().decode(raw).content
+        book = record.book
+
+        self.assertIs(record.book, book)
+        self.assertEqual(book.best_ask, 10.1)
+        self.assertEqual(book.best_bid, 10.)
+        self.assertAlmostEqual(book.mid, 10.05)
+        self.assertAlmostEqual(book.spread, 0.1)
+        self.assertAlmostEqual(book.microprice, (10. * 100 + 10.1 * 300) / 400)
+        self.assertEqual(list(book.ask_depth[:4]), [100, 300, 600, 600])
+        self.assertEqual(book.total_bid_vol, 900)
+        self.assertAlmostEqual(book.imbalance(2), (600 - 300) / 900)
+        self.assertNotIn('book', record.keys())
+
+    def test_book_from_dict(self):
+        data = TickFeed.standardize(attrdict(self.make_snapshot()))
+        book = TickFeed.get_book(data)
+        self.assertEqual(list(book.bid_prices[:3]), [10., 9.9, 9.8])
+        self.assertEqual(book.bid_prices[3], 0.)
+
+    def test_book_from_tick_dict(self):
+        data = TickFeed.standardize(TickFeed.dict_base(self.make_snapshot()))
+        self.assertIsInstance(data, TickDict)
+        book = data.book
+        self.assertIs(data.book, book)
+        self.assertIs(TickFeed.get_book(data), book)
+        self.assertEqual(book.best_bid, 10.)
+        self.assertNotIn('book', data)
+        self.assertRaises(AttributeError, setattr, data, 'book', None)
+
+        # 与attrdict一致, 可拷贝与序列化
+        self.assertIsInstance(data.copy(), TickDict)
+        self.assertEqual(json.loads(json.dumps(data)), dict(data))
+        restored = pickle.loads(pickle.dumps(data))
+        self.assertEqual(restored, data)
+        self.assertEqual(restored.book.best_ask, 10.1)
+
+    def test_one_sided_book(self):
+        book = OrderBook([10.] + [0.] * 9, [100] + [0] * 9,
+                         [0.] * 10, [0] * 10)
+        self.assertIsNone(book.mid)
+        self.assertIsNone(book.microprice)
+        self.assertEqual(book.imbalance(), -1.)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import os
+import types
+import tempfile
+import unittest
+
+from fast_trader.id_pool import (_IDPool, OwnershipIndex, IDCursor,
+                                 IDCursorStore)
+
+
+def make_strategy(strategy_id):
+    return types.SimpleNamespace(strategy_id=strategy_id)
+
+
+class TestOwnershipIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = _IDPool(max_strategies=10, max_traders_per_strategy=10)
+        self.index = OwnershipIndex(self.pool, max_entries=2)
+        self.strategies = [make_strategy(i) for i in range(3)]
+        for ea in self.strategies:
+            self.index.add_strategy(ea)
+
+    def test_owner_of(self):
+        for strategy_id, rng in self.pool.strategy_ranges.items():
+            self.assertEqual(self.pool.owner_of(rng[0]), strategy_id)
+            self.assertEqual(self.pool.owner_of(rng[-1]), strategy_id)
+        self.assertIsNone(self.pool.owner_of(self.pool.sys_reserve[0]))
+        self.assertIsNone(self.pool.owner_of(0))
+
+    def test_owners_of(self):
+        ranges = self.pool.strategy_ranges
+        ids = [ranges[0][0], ranges[3][-1], ranges[9][7],
+               self.pool.sys_reserve[0], 0]
+        self.assertEqual(self.pool.owners_of(ids).tolist(),
+                         [0, 3, 9, -1, -1])
+        self.assertEqual(
+            self.pool.owners_of([str(ranges[2][1]), '']).tolist(), [2, -1])
+        self.assertEqual(
+            self.pool.owners_of([str(i) for i in ids[:2]]).tolist(), [0, 3])
+
+    def test_order_original_id(self):
+        order_id = self.pool.strategy_ranges[1][5]
+        owner = self.index.get_owner({'order_original_id': str(order_id)})
+        self.assertIs(owner, self.strategies[1])
+        # 未注册的策略
+        order_id = self.pool.strategy_ranges[5][5]
+        self.assertIsNone(
+            self.index.get_owner({'order_original_id': str(order_id)}))
+
+    def test_exchange_id_and_request_id(self):
+        ea = self.strategies[2]
+        order_id = self.pool.strategy_ranges[2][0]
+        self.index.get_owner({
+            'header': {'request_id': 'r0'},
+            'body': {'order_original_id': str(order_id),
+                     'order_exchange_id': 'X1'}})
+
+        # 撤单响应只有order_exchange_id
+        cancel_rsp = {'header': {'request_id': 'r1'},
+                      'body': {'order_exchange_id': 'X1'}}
+        self.assertIs(self.index.get_owner(cancel_rsp), ea)
+
+        cancel_rsp = {'header': {'request_id': 'r2'},
+                      'body': {'order_exchange_id': 'X2'}}
+        self.assertIsNone(self.index.get_owner(cancel_rsp))
+        self.index.register_request('r2', self.strategies[0])
+        self.assertIs(self.index.get_owner(cancel_rsp), self.strategies[0])
+
+    def test_bounded(self):
+        for i in range(5):
+            self.index.register_request(f'r{i}', self.strategies[0])
+        self.assertEqual(list(self.index._request_ids), ['r3', 'r4'])
+
+    def test_remove_strategy(self):
+        order_id = self.pool.strategy_ranges[0][0]
+        self.index.remove_strategy(self.strategies[0])
+        self.assertIsNone(
+            self.index.get_owner({'order_original_id': str(order_id)}))
+
+
+class TestIDCursor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, 'id_cursor.db')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_resume_after_restart(self):
+        key = (3, 1, '20200102')
+        store = IDCursorStore(self.db_path)
+        cursor = IDCursor(range(100, 200), store, key, block_size=10)
+        ids = [cursor.next_id() for _ in range(12)]
+        self.assertEqual(ids, list(range(100, 112)))
+        # 每预留一段写入一次
+        self.assertEqual(store.load(*key), 120)
+        store.close()
+
+        store = IDCursorStore(self.db_path)
+        cursor = IDCursor(range(100, 200), store, key, block_size=10)
+        self.assertEqual(cursor.next_id(), 120)
+        # 其他交易日独立分配
+        other = IDCursor(range(100, 200), store, (3, 1, '20200103'))
+        self.assertEqual(other.next_id(), 100)
+        store.close()
+
+    def test_exhausted(self):
+        cursor = IDCursor(range(0, 3), block_size=2)
+        self.assertEqual([cursor.next_id() for _ in range(3)], [0, 1, 2])
+        self.assertRaises(RuntimeError, cursor.next_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+# ORDER_STATUS_SUBMITTED 定义于strategy模块
+from fast_trader.strategy import dtp_type
+from fast_trader.ledger import (LedgerWriter, LedgerCategory, LedgerStore,
+                                LedgerJournal, LedgerSubject,
+                                StockLedgerRecord, AccountView, ViewHistory,
+                                verify_checkpoint)
+from fast_trader.settings import settings
+from fast_trader.utils import attrdict
+
+
+def submitted_order(code, price, quantity):
+    return attrdict(code=code, price=price, quantity=quantity,
+                    order_side=dtp_type.ORDER_SIDE_BUY,
+                    status=dtp_type.ORDER_STATUS_SUBMITTED)
+
+
+class TestLedgerBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self._sqlite_ledger = settings['sqlite_ledger']
+        settings.set({'sqlite_ledger': os.path.join(self.tmp.name, 'l.db')})
+        self.writer = LedgerWriter('test_batch', restore_history=False)
+
+    def tearDown(self):
+        settings.set({'sqlite_ledger': self._sqlite_ledger})
+        self.tmp.cleanup()
+
+    def test_orders_in_one_transaction(self):
+        acc = self.writer.accountant
+        orders = [submitted_order('600000', 10., 100),
+                  submitted_order('000001', 20., 200)]
+
+        with mock.patch.object(acc._store._store, 'write_many',
+                               wraps=acc._store._store.write_many) as wm:
+            self.writer.write_order_records(orders)
+
+        self.assertEqual(wm.call_count, 1)
+        self.assertEqual(len(acc._records), 4)
+        self.assertEqual(len(acc._store.load()), 4)
+
+        view = acc.get_general_account_view()
+        self.assertEqual(view.freeze, 5000.)
+        self.assertEqual(view.cash, -5000.)
+        self.assertTrue(acc.check_consistency())
+
+    def test_general_view_incremental(self):
+        acc = self.writer.accountant
+        self.writer.write_capital_change_record(10000.)
+        self.writer.write_order_records(
+            [submitted_order(str(600000 + i), 10., 100) for i in range(5)])
+
+        view = acc.get_general_account_view()
+        self.assertEqual(view.cash, 5000.)
+        self.assertEqual(view.freeze, 5000.)
+        self.assertEqual(view.balance, 10000.)
+        self.assertTrue(acc.check_consistency())
+
+        acc._account_view_per_child['600000.SH'].cash += 1.
+        self.assertFalse(acc.check_consistency())
+
+    def test_nested_batch(self):
+        acc = self.writer.accountant
+        with self.writer.batch():
+            self.writer.write_order_record(submitted_order('600000', 1., 100))
+            # 退出最外层前不更新账户
+            self.assertEqual(len(acc._records), 0)
+        self.assertEqual(
+            [r.category for r in acc._records],
+            [LedgerCategory.FREEZE, LedgerCategory.CASH])
+
+
+def record(subject, category, code, quantity, price, sec):
+    ret = StockLedgerRecord()
+    ret.subject = subject
+    ret.category = category
+    ret.code = code
+    ret.quantity = quantity
+    ret.price = price
+    ret.localtime = f'2020-01-02T09:30:{sec:02d}.000000'
+    return ret
+
+
+def trade(code, quantity, price, sec):
+    return [
+        record(LedgerSubject.TRANSACTION, LedgerCategory.SECURITY,
+               code, quantity, price, sec),
+        record(LedgerSubject.TRANSACTION, LedgerCategory.CASH,
+               code, -quantity * price, 1., sec)]
+
+
+def tick(code, price):
+    return attrdict(api_id='tick_feed',
+                    content=attrdict(szWindCode=code, nMatch=price))
+
+
+class TestMarkToMarket(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self._sqlite_ledger = settings['sqlite_ledger']
+        self._ledger = settings.get('ledger')
+        settings.set({
+            'sqlite_ledger': os.path.join(self.tmp.name, 'l.db'),
+            'ledger': {'mark_to_market': True, 'evaluation_interval': 60}})
+        self.writer = LedgerWriter('test_mtm', restore_history=False)
+
+        record = StockLedgerRecord()
+        record.subject = LedgerSubject.TRANSACTION
+        record.category = LedgerCategory.SECURITY
+        record.code = '600000.SH'
+        record.quantity = 100
+        record.price = 10.
+        record.localtime = '2020-01-02T09:30:00.000000'
+        self.writer.accountant.put_event(record)
+
+    def tearDown(self):
+        settings.set({'sqlite_ledger': self._sqlite_ledger,
+                      'ledger': self._ledger})
+        self.tmp.cleanup()
+
+    def test_sampled_evaluation(self):
+        acc = self.writer.accountant
+        for price in (10.5, 11., 11.5):
+            self.writer.write_market_record(tick('600000.SH', price))
+        # 未持仓代码不处理
+        self.writer.write_market_record(tick('000001.SZ', 20.))
+
+        # 只采样一次估值记录, 且不保留在流水列表中
+        history = acc.get_account_history_stats_by_code(
+            '600000.SH', as_dataframe=False)
+        self.assertEqual(list(history.security_value), [1000., 1050.])
+        self.assertEqual([r.subject for r in acc._records],
+                         [LedgerSubject.TRANSACTION])
+        self.assertEqual(
+            acc.get_account_view_by_code('600000.SH').security_value, 1150.)
+        self.assertEqual(acc._positions['600000.SH'].price, 11.5)
+        self.assertNotIn('000001.SZ', acc._account_view_per_child)
+        self.assertEqual(acc.get_general_account_view().security_value, 1150.)
+        self.assertTrue(acc.check_consistency())
+
+
+class TestViewHistory(unittest.TestCase):
+
+    @staticmethod
+    def fill(history, seconds):
+        view = AccountView()
+        for sec in seconds:
+            view.cash = sec
+            history.append(f'2020-01-02T09:30:{sec:02d}.000000', view)
+
+    def test_grow_and_merge_same_time(self):
+        history = ViewHistory(capacity=2)
+        self.fill(history, [0, 1, 1, 2, 3])
+        self.assertEqual(history.cash.tolist(), [0., 1., 2., 3.])
+        self.assertEqual(str(history.time[1]), '2020-01-02T09:30:01.000000')
+        # 无拷贝
+        self.assertIs(history.cash.base, history._values)
+
+        df = history.to_dataframe()
+        self.assertEqual(list(df.columns), list(AccountView.__slots__))
+        self.assertEqual(df.index[-1].second, 3)
+
+    def test_interval_and_retention(self):
+        history = ViewHistory(interval=10)
+        self.fill(history, [0, 5, 9, 10, 25])
+        self.assertEqual(history.cash.tolist(), [9., 10., 25.])
+
+        history = ViewHistory(capacity=2, max_rows=4)
+        self.fill(history, range(6))
+        self.assertEqual(history.cash.tolist(), [2., 3., 4., 5.])
+
+
+class TestLedgerJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self._sqlite_ledger = settings['sqlite_ledger']
+        self._ledger = settings.get('ledger')
+        settings.set({
+            'sqlite_ledger': os.path.join(self.tmp.name, 'l.db'),
+            'ledger': {'write_behind': True, 'flush_interval': 0.01,
+                       'flush_size': 100}})
+
+    def tearDown(self):
+        settings.set({'sqlite_ledger': self._sqlite_ledger,
+                      'ledger': self._ledger})
+        self.tmp.cleanup()
+
+    def test_group_commit(self):
+        writer = LedgerWriter('test_journal', restore_history=False)
+        acc = writer.accountant
+        for i in range(20):
+            writer.write_order_record(submitted_order('600000', 1., 100))
+        # 账户视图同步更新
+        self.assertEqual(acc.get_general_account_view().freeze, 2000.)
+
+        self.assertTrue(acc.flush(timeout=5))
+        self.assertEqual(len(acc._store.load()), 40)
+        self.assertLess(acc._journal.commits, 20)
+        writer.close()
+
+        restored = LedgerWriter('test_journal').accountant
+        self.assertEqual(restored.get_general_account_view().freeze, 2000.)
+        restored.close()
+
+    def test_recover_journal_tail(self):
+        store = LedgerStore('test_recover')
+        path = os.path.join(self.tmp.name, 'test_recover.journal')
+        doc = {'subject': 'capital', 'category': 'cash', 'code': 'account',
+               'price': 1., 'quantity': 100.,
+               'localtime': '2020-01-02T09:30:00.000000', 'comment': None}
+
+        # 写入日志后未提交即退出
+        journal = LedgerJournal(store, path)
+        journal.recover()
+        journal.put_many([doc, dict(doc, quantity=200.)])
+        with open(path, 'a') as f:
+            f.write('[3, {"subj')
+
+        journal = LedgerJournal(store, path)
+        self.assertEqual(journal.recover(), 2)
+        self.assertEqual([d['quantity'] for d in store.load()], [100., 200.])
+        self.assertEqual(store.load_journal_seq(), 2)
+        # 已回放的记录不再重复写入
+        self.assertEqual(LedgerJournal(store, path).recover(), 0)
+        journal.stop()
+
+    def test_truncate_after_commit(self):
+        store = LedgerStore('test_truncate')
+        path = os.path.join(self.tmp.name, 'test_truncate.journal')
+        doc = {'subject': 'capital', 'category': 'cash', 'code': 'account',
+               'price': 1., 'quantity': 1.,
+               'localtime': '2020-01-02T09:30:00.000000', 'comment': None}
+
+        def sizes():
+            return [os.path.getsize(p) for p in (path, path + '.1')]
+
+        journal = LedgerJournal(store, path, flush_interval=0.01)
+        journal.start()
+        for i in range(3):
+            journal.put_many([dict(doc, quantity=float(i))])
+            self.assertTrue(journal.flush(timeout=5))
+            # 提交后日志清空
+            self.assertEqual(sizes(), [0, 0])
+        journal.stop()
+
+    def test_rotate_with_uncommitted(self):
+        store = LedgerStore('test_rotate')
+        path = os.path.join(self.tmp.name, 'test_rotate.journal')
+        doc = {'subject': 'capital', 'category': 'cash', 'code': 'account',
+               'price': 1., 'quantity': 1.,
+               'localtime': '2020-01-02T09:30:00.000000', 'comment': None}
+
+        journal = LedgerJournal(store, path)
+        journal.recover()
+        journal.put_many([dict(doc, quantity=1.)])
+        journal.put_many([dict(doc, quantity=2.), dict(doc, quantity=3.)])
+        # 只提交了第一批, 之后的记录写入另一文件
+        journal._commit([journal._queue.get()])
+        journal.put_many([dict(doc, quantity=4.)])
+        self.assertEqual(journal._retired, 3)
+        journal.stop()
+
+        # 未提交即退出, 从两个文件回放
+        self.assertEqual(LedgerJournal(store, path).recover(), 3)
+        self.assertEqual([d['quantity'] for d in store.load()],
+                         [1., 2., 3., 4.])
+
+        journal = LedgerJournal(store, path)
+        journal.recover()
+        journal.put_many([dict(doc, quantity=5.)])
+        journal.put_many([dict(doc, quantity=6.)])
+        journal._commit([journal._queue.get()])
+        journal._commit([journal._queue.get()])
+        # 另一文件中的记录已提交, 两个文件均清空
+        self.assertEqual(journal._retired, 0)
+        self.assertEqual(os.path.getsize(path), 0)
+        self.assertEqual(os.path.getsize(path + '.1'), 0)
+        journal.stop()
+
+    def test_retry_failed_commit(self):
+        store = LedgerStore('test_retry')
+        path = os.path.join(self.tmp.name, 'test_retry.journal')
+        doc = {'subject': 'capital', 'category': 'cash', 'code': 'account',
+               'price': 1., 'quantity': 1.,
+               'localtime': '2020-01-02T09:30:00.000000', 'comment': None}
+
+        journal = LedgerJournal(store, path, flush_interval=0.01,
+                                retry_interval=0.01)
+        commit_journal = store.commit_journal
+        calls = []
+
+        def fail_once(docs, seq, checkpoint=None):
+            calls.append(seq)
+            if len(calls) == 1:
+                raise sqlite3.OperationalError('database is locked')
+            return commit_journal(docs, seq, checkpoint)
+
+        with mock.patch.object(store, 'commit_journal', fail_once):
+            journal.start()
+            journal.put_many([doc])
+            self.assertFalse(journal.flush(timeout=5))
+            journal.put_many([dict(doc, quantity=2.)])
+            self.assertTrue(journal.flush(timeout=5))
+            journal.stop()
+
+        # 失败的批次先于之后的记录提交
+        self.assertEqual([d['quantity'] for d in store.load()], [1., 2.])
+        self.assertEqual(store.load_journal_seq(), 2)
+        self.assertEqual(LedgerJournal(store, path).recover(), 0)
+
+    def test_replay_uncommitted_on_stop(self):
+        store = LedgerStore('test_retry')
+        path = os.path.join(self.tmp.name, 'test_retry.journal')
+        doc = {'subject': 'capital', 'category': 'cash', 'code': 'account',
+               'price': 1., 'quantity': 1.,
+               'localtime': '2020-01-02T09:30:00.000000', 'comment': None}
+
+        journal = LedgerJournal(store, path, flush_interval=0.01)
+        with mock.patch.object(store, 'commit_journal',
+                               side_effect=sqlite3.OperationalError):
+            journal.start()
+            journal.put_many([doc])
+            self.assertFalse(journal.flush(timeout=5))
+            journal.stop()
+
+        # 未能提交即退出, 重启时回放
+        self.assertEqual(store.load_journal_seq(), 0)
+        self.assertEqual(LedgerJournal(store, path).recover(), 1)
+        self.assertEqual([d['quantity'] for d in store.load()], [1.])
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self._sqlite_ledger = settings['sqlite_ledger']
+        self._ledger = settings.get('ledger')
+
+    def tearDown(self):
+        settings.set({'sqlite_ledger': self._sqlite_ledger,
+                      'ledger': self._ledger})
+        self.tmp.cleanup()
+
+    def run_session(self, write_behind):
+        settings.set({
+            'sqlite_ledger': os.path.join(self.tmp.name, 'l.db'),
+            'ledger': {'checkpoint_every': 5, 'write_behind': write_behind,
+                       'flush_interval': 0.01}})
+
+        writer = LedgerWriter('test_ckpt')
+        writer.write_capital_change_record(10000.)
+        for i in range(4):
+            writer.write_order_record(submitted_order('600000', 10., 100))
+        writer.write_market_record(tick('600000.SH', 11.))
+        expected = writer.accountant.get_general_account_view().to_dict()
+        writer.close()
+
+        acc = LedgerWriter('test_ckpt').accountant
+        # 9条记录, 检查点在第9条(5条及关闭时)之后, 无需回放
+        self.assertEqual(len(acc._records), 0)
+        self.assertEqual(acc.get_general_account_view().to_dict(), expected)
+        self.assertTrue(acc.check_consistency())
+
+        self.assertEqual(verify_checkpoint('test_ckpt'), [])
+        acc.close()
+
+    def test_restore(self):
+        self.run_session(write_behind=False)
+
+        # 未关闭即退出: 从检查点恢复并回放其后的记录
+        LedgerWriter('test_ckpt').write_capital_change_record(100.)
+        acc = LedgerWriter('test_ckpt').accountant
+        self.assertEqual(len(acc._records), 1)
+        self.assertEqual(acc.get_account_view_by_code('account').cash,
+                         10100.)
+        self.assertEqual(verify_checkpoint('test_ckpt'), [])
+
+        # 篡改检查点后应能发现差异
+        acc._store.save_checkpoint({
+            'rows': 10, 'localtime': '',
+            'payload': {'positions': {}, 'pnl': {}, 'views': {
+                '600000.SH': [0., 0., 0., 0.]}}})
+        self.assertTrue(verify_checkpoint('test_ckpt'))
+
+    def test_restore_write_behind(self):
+        self.run_session(write_behind=True)
+
+    def test_pnl_after_restore(self):
+        settings.set({
+            'sqlite_ledger': os.path.join(self.tmp.name, 'l.db'),
+            'ledger': {'checkpoint_every': 5, 'write_behind': False}})
+
+        def last_pnl(acc):
+            return (acc.get_pnl().iloc[-1].to_dict(),
+                    acc.get_pnl('600000.SH').iloc[-1].to_dict())
+
+        acc = LedgerWriter('test_pnl_ckpt').accountant
+        events = [record(LedgerSubject.CAPITAL, LedgerCategory.CASH,
+                         'account', 10000., 1., 0)]
+        events += trade('600000.SH', 100, 10., 1)
+        events += trade('600000.SH', 100, 12., 2)
+        events += trade('000001.SZ', 200, 5., 2)
+        events += [record(LedgerSubject.COSTS, LedgerCategory.CASH,
+                          '600000.SH', -2., 1., 2)]
+        events += trade('600000.SH', -50, 14., 3)
+        acc.put_events(events)
+        # 检查点之后的记录, 未关闭即退出
+        acc.put_events(trade('600000.SH', -50, 9., 4))
+        expected = last_pnl(acc)
+        # 均价11, 卖出50@14与50@9
+        self.assertAlmostEqual(expected[1]['realized'], 150. - 100.)
+        self.assertAlmostEqual(expected[1]['cost_basis'], 1100.)
+        # 持仓中增量维护的成本与盈亏与盈亏曲线一致
+        pos = acc._positions['600000.SH']
+        self.assertAlmostEqual(pos.realized, 50.)
+        self.assertAlmostEqual(pos.cost_basis, 1100.)
+
+        for sec in (10, 20):
+            acc = LedgerWriter('test_pnl_ckpt').accountant
+            # 从检查点恢复, 只回放其后的一笔成交
+            self.assertEqual(len(acc._records), 2)
+            for got, want in zip(last_pnl(acc), expected):
+                self.assertEqual(set(got), set(want))
+                for field, value in want.items():
+                    self.assertAlmostEqual(got[field], value, msg=field)
+            self.assertEqual(verify_checkpoint('test_pnl_ckpt'), [])
+
+            # 恢复后保存的检查点继续包含期初状态
+            acc.put_events(trade('000001.SZ', -50, 6., sec) +
+                           trade('600000.SH', 10, 8., sec + 1) +
+                           trade('600000.SH', -10, 9., sec + 2))
+            acc.put_events(trade('000001.SZ', -10, 7., sec + 3))
+            expected = last_pnl(acc)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+import time
+import queue
+import threading
+import unittest
+
+from fast_trader.mail_queue import (ConflatingQueue, RingQueue,
+                                    StrategyMailbox, get_many)
+
+
+def quote(api_id, code, n):
+    return {'handler_id': 'quote_feed', 'api_id': api_id,
+            'content': {'szCode': code, 'n': n}}
+
+
+class TestGetMany(unittest.TestCase):
+
+    def test_fifo_and_limit(self):
+        q = queue.Queue()
+        for i in range(5):
+            q.put(i)
+        self.assertEqual(get_many(q, 3), [0, 1, 2])
+        self.assertEqual(get_many(q, 10), [3, 4])
+        self.assertEqual(get_many(q, 10), [])
+
+    def test_task_accounting(self):
+        q = queue.Queue()
+        for i in range(3):
+            q.put(i)
+        self.assertEqual(len(get_many(q, 3)), 3)
+        # 与get一致, 取出后仍需task_done
+        self.assertEqual(q.unfinished_tasks, 3)
+        for _ in range(3):
+            q.task_done()
+        q.join()
+        self.assertRaises(ValueError, q.task_done)
+
+    def test_wakes_blocked_producer(self):
+        q = queue.Queue(maxsize=2)
+        q.put(0)
+        q.put(1)
+        t = threading.Thread(target=lambda: (q.put(2), q.put(3)))
+        t.start()
+        time.sleep(0.02)
+        self.assertTrue(t.is_alive())
+
+        # 取出两条后, 等待not_full的生产者被唤醒
+        self.assertEqual(get_many(q, 2), [0, 1])
+        t.join(1)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(get_many(q, 10), [2, 3])
+
+
+class TestConflatingQueue(unittest.TestCase):
+
+    def test_snapshots_replaced_in_place(self):
+        q = ConflatingQueue()
+        q.put(quote('tick_feed', '600000', 1))
+        q.put(quote('tick_feed', '000001', 1))
+        q.put(quote('tick_feed', '600000', 2))
+
+        self.assertEqual(q.qsize(), 2)
+        self.assertEqual(q.conflated, 1)
+
+        first = q.get_nowait()
+        self.assertEqual(first['content']['szCode'], '600000')
+        self.assertEqual(first['content']['n'], 2)
+        self.assertEqual(q.get_nowait()['content']['szCode'], '000001')
+        self.assertRaises(queue.Empty, q.get_nowait)
+
+    def test_trade_feed_lossless(self):
+        q = ConflatingQueue()
+        for i in range(3):
+            q.put(quote('trade_feed', '600000', i))
+            q.put(quote('tick_feed', '600000', i))
+
+        mails = [q.get_nowait() for _ in range(q.qsize())]
+        trades = [m['content']['n'] for m in mails
+                  if m['api_id'] == 'trade_feed']
+        self.assertEqual(trades, [0, 1, 2])
+        self.assertEqual(len(mails), 4)
+        self.assertEqual(q.conflated, 2)
+
+    def test_new_snapshot_after_get(self):
+        q = ConflatingQueue()
+        q.put(quote('index_feed', '000300', 1))
+        q.get_nowait()
+        q.put(quote('index_feed', '000300', 2))
+        self.assertEqual(q.get_nowait()['content']['n'], 2)
+        self.assertEqual(q.conflated, 0)
+
+
+class TestRingQueue(unittest.TestCase):
+
+    def test_fifo_and_slot_reuse(self):
+        q = RingQueue(capacity=4)
+        for i in range(10):
+            q.put(i)
+            self.assertEqual(q.get_many(8), [i])
+        q.put(1)
+        q.put(2)
+        self.assertEqual(q.qsize(), 2)
+        self.assertEqual(q.get_many(1), [1])
+        self.assertEqual(q.get_nowait(), 2)
+        self.assertRaises(queue.Empty, q.get_nowait)
+        self.assertEqual(q.overflows, 0)
+
+    def test_drop_oldest(self):
+        q = RingQueue(capacity=4, policy='drop_oldest')
+        for i in range(10):
+            q.put(i)
+        self.assertEqual(q.get_many(10), [6, 7, 8, 9])
+        self.assertEqual(q.dropped, 6)
+        self.assertEqual(q.overflows, 6)
+        q.put(10)
+        self.assertEqual(q.get_many(10), [10])
+
+    def test_drop_oldest_full_without_loss(self):
+        q = RingQueue(capacity=4, policy='drop_oldest')
+        for i in range(4):
+            q.put(i)
+        self.assertEqual(q.get_many(10), [0, 1, 2, 3])
+        self.assertEqual(q.dropped, 0)
+        self.assertEqual(q.overflows, 0)
+
+        for i in range(4, 8):
+            q.put(i)
+        self.assertEqual(q.get_many(2), [4, 5])
+        self.assertEqual(q.get_many(10), [6, 7])
+        self.assertEqual(q.dropped, 0)
+
+    def test_conflate_overflow(self):
+        q = RingQueue(capacity=2, policy='conflate')
+        q.put(quote('tick_feed', '600000', 0))
+        q.put(quote('tick_feed', '600000', 1))
+        # 以下进入溢出区
+        q.put(quote('tick_feed', '600000', 2))
+        q.put(quote('trade_feed', '600000', 3))
+        q.put(quote('tick_feed', '600000', 4))
+
+        self.assertEqual(q.conflated, 1)
+        self.assertEqual(q.overflows, 1)
+        # 环形队列中的数据先于溢出区, 溢出区中的快照只保留最新
+        mails = q.get_many(10) + q.get_many(10)
+        self.assertEqual([m['content']['n'] for m in mails], [0, 1, 4, 3])
+        self.assertEqual(q.qsize(), 0)
+
+    def test_block_threaded(self):
+        q = RingQueue(capacity=8)
+        n = 10000
+
+        def produce():
+            for i in range(n):
+                q.put(i)
+
+        t = threading.Thread(target=produce)
+        t.start()
+        received = []
+        while len(received) < n:
+            items = q.get_many(3)
+            if not items:
+                time.sleep(0)
+            received.extend(items)
+        t.join()
+        self.assertEqual(received, list(range(n)))
+        self.assertGreater(q.overflows, 0)
+
+    def test_conflate_threaded_order(self):
+        # 逐笔行情不合并, 跨越环形队列与溢出区时仍须保持顺序
+        q = RingQueue(capacity=4, policy='conflate')
+        n = 100000
+
+        def produce():
+            for i in range(n):
+                q.put(quote('trade_feed', '600000', i))
+
+        t = threading.Thread(target=produce)
+        t.start()
+        received = []
+        # 消费者不休眠, 使其检查环形队列后、读取溢出区前可能被生产者打断
+        while len(received) < n:
+            received.extend(m['content']['n'] for m in q.get_many(5))
+        t.join()
+        self.assertEqual(received, list(range(n)))
+        self.assertGreater(q.overflows, 0)
+        self.assertEqual(q.conflated, 0)
+
+
+class TestStrategyMailbox(unittest.TestCase):
+
+    def test_ordered_and_isolated(self):
+        started, blocker = threading.Event(), threading.Event()
+        slow, fast = StrategyMailbox('slow'), StrategyMailbox('fast')
+        slow.start()
+        fast.start()
+
+        def block():
+            started.set()
+            blocker.wait()
+
+        received = []
+        slow.put(block)
+        for i in range(100):
+            slow.put(received.append, ('slow', i))
+            fast.put(received.append, ('fast', i))
+        fast.stop(wait=True)
+        # 确认slow已取出阻塞回调, 其余消息仍在队列中
+        self.assertTrue(started.wait(1))
+
+        # slow被阻塞时fast的消息已全部处理
+        self.assertEqual(received, [('fast', i) for i in range(100)])
+        self.assertEqual(slow.qsize(), 100)
+        self.assertGreaterEqual(slow.max_depth, 100)
+
+        blocker.set()
+        slow.stop(wait=True)
+        self.assertEqual([i for name, i in received if name == 'slow'],
+                         list(range(100)))
+        stats = slow.get_stats()
+        self.assertEqual(stats['processed'], 101)
+        self.assertEqual(stats['handler_time']['count'], 101)
+
+    def test_restart_after_stop(self):
+        started, blocker = threading.Event(), threading.Event()
+        mailbox = StrategyMailbox('restart')
+        mailbox.start()
+
+        def block():
+            started.set()
+            blocker.wait()
+
+        received = []
+        mailbox.put(block)
+        mailbox.put(received.append, 0)
+        self.assertTrue(started.wait(1))
+        mailbox.stop()
+        self.assertFalse(mailbox.running)
+        # 原处理线程尚未退出, 不能启动第二个线程消费同一队列
+        self.assertRaises(RuntimeError, mailbox.start)
+
+        blocker.set()
+        mailbox.join(1)
+        self.assertEqual(received, [0])
+        mailbox.start()
+        self.assertTrue(mailbox.running)
+        mailbox.put(received.append, 1)
+        mailbox.stop(wait=True)
+        self.assertEqual(received, [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
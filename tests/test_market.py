@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest import mock
+
+from fast_trader.dtp_quote import TickFeed, TradeFeed
+from fast_trader.strategy import (Market, QuoteFeed, StrategyMdSubMixin,
+                                  dtp_api)
+
+
+class FakeQuoteFeed:
+
+    def __init__(self):
+        self.calls = []
+
+    def subscribe(self, feed_name, codes):
+        self.calls.append(('subscribe', feed_name, list(codes)))
+
+    def subscribe_all(self, feed_name):
+        self.calls.append(('subscribe_all', feed_name))
+
+    def unsubscribe(self, feed_name, codes):
+        self.calls.append(('unsubscribe', feed_name, sorted(codes)))
+
+
+class FakeStrategy(StrategyMdSubMixin):
+
+    started = True
+    _mailbox = None
+
+    def __init__(self, market, name):
+        StrategyMdSubMixin.__init__(self)
+        self.market = market
+        self.name = name
+        self.received = []
+
+    def on_quote_message(self, message):
+        self.received.append(message['content']['szCode'])
+
+    def __repr__(self):
+        return self.name
+
+
+def tick(code):
+    return {'api_id': 'tick_feed', 'content': {'szCode': code}}
+
+
+class TestMarketRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.quote_feed = FakeQuoteFeed()
+        self.market = Market(dispatcher=None, quote_feed=self.quote_feed)
+        self.strategies = [FakeStrategy(self.market, f's{i}')
+                           for i in range(3)]
+        for ea in self.strategies:
+            self.market.add_strategy(ea)
+
+    def subscribers(self, code, feed_name=TickFeed.name):
+        return list(self.market.get_subscribers(feed_name, code))
+
+    def test_per_code_and_all_merged(self):
+        s0, s1, s2 = self.strategies
+        s0.subscribe(TickFeed, ['600000', '000001'])
+        s1.subscribe_all(TickFeed)
+        s2.subscribe(TickFeed, '000001')
+
+        self.assertEqual(self.subscribers('600000'), [s0, s1])
+        self.assertEqual(self.subscribers('000001'), [s0, s1, s2])
+        # 未逐代码订阅的代码只分发给全订阅策略
+        self.assertEqual(self.subscribers('600519'), [s1])
+        self.assertEqual(self.subscribers('600000', TradeFeed.name), [])
+
+        self.market.on_quote_message(tick('000001'))
+        self.market.on_quote_message(tick('600519'))
+        self.assertEqual(s0.received, ['000001'])
+        self.assertEqual(s1.received, ['000001', '600519'])
+        self.assertEqual(s2.received, ['000001'])
+
+    def test_subscription_order(self):
+        s0, s1, s2 = self.strategies
+        # 路由顺序与订阅顺序无关, 按策略添加顺序
+        s2.subscribe(TickFeed, '600000')
+        s0.subscribe(TickFeed, '600000')
+        s1.subscribe_all(TickFeed)
+        self.assertEqual(self.subscribers('600000'), [s0, s1, s2])
+
+        s1.unsubscribe(TickFeed)
+        self.assertEqual(self.subscribers('600000'), [s0, s2])
+        self.assertEqual(self.subscribers('600519'), [])
+
+        s0.unsubscribe(TickFeed, '600000')
+        self.assertEqual(self.subscribers('600000'), [s2])
+
+    def test_incremental_update(self):
+        s0, s1, _ = self.strategies
+        s1.subscribe_all(TickFeed)
+        routes, _ = self.market._routes[TickFeed.name]
+        for code in ['600000', '000001', '600519']:
+            s0.subscribe(TickFeed, code)
+        # 逐代码订阅就地更新路由表
+        self.assertIs(self.market._routes[TickFeed.name][0], routes)
+        self.assertEqual(sorted(routes), ['000001', '600000', '600519'])
+
+        s0.unsubscribe(TickFeed, '000001')
+        self.assertNotIn('000001', routes)
+        self.assertEqual(self.subscribers('000001'), [s1])
+        self.assertEqual(self.subscribers('600519'), [s0, s1])
+
+
+class TestUnsubscribe(unittest.TestCase):
+
+    def setUp(self):
+        self.quote_feed = FakeQuoteFeed()
+        self.market = Market(dispatcher=None, quote_feed=self.quote_feed)
+        self.s0 = FakeStrategy(self.market, 's0')
+        self.s1 = FakeStrategy(self.market, 's1')
+        self.market.add_strategy(self.s0)
+        self.market.add_strategy(self.s1)
+
+    def unsubscribed(self):
+        return [c for c in self.quote_feed.calls if c[0] == 'unsubscribe']
+
+    def test_release_unshared_codes(self):
+        self.s0.subscribe(TickFeed, ['600000', '000001', '600519'])
+        self.s1.subscribe(TickFeed, ['000001'])
+
+        self.s0.unsubscribe(TickFeed, ['600000', '000001'])
+        # 000001仍被s1订阅, 不向底层退订
+        self.assertEqual(self.unsubscribed(),
+                         [('unsubscribe', TickFeed.name, ['600000'])])
+        self.assertFalse(self.s0.has_subscribed(TickFeed, '000001'))
+        self.assertEqual(
+            list(self.market.get_subscribers(TickFeed.name, '000001')),
+            [self.s1])
+
+        # 存在全订阅策略时不退订
+        self.s1.subscribe_all(TickFeed)
+        self.s0.unsubscribe(TickFeed)
+        self.assertEqual(len(self.unsubscribed()), 1)
+        self.assertEqual(
+            list(self.market.get_subscribers(TickFeed.name, '600519')),
+            [self.s1])
+
+    def test_remove_strategy(self):
+        self.s0.subscribe(TickFeed, ['600000', '000001'])
+        self.s0.subscribe(TradeFeed, ['600000'])
+        self.s1.subscribe(TickFeed, ['000001'])
+
+        self.market.remove_strategy(self.s0)
+        self.assertEqual(sorted(self.unsubscribed()), [
+            ('unsubscribe', TickFeed.name, ['600000']),
+            ('unsubscribe', TradeFeed.name, ['600000'])])
+        self.assertEqual(
+            list(self.market.get_subscribers(TickFeed.name, '000001')),
+            [self.s1])
+        self.assertEqual(
+            list(self.market.get_subscribers(TickFeed.name, '600000')), [])
+
+
+@unittest.skipIf(hasattr(dtp_api.QuoteFeed, 'unsubscribe'),
+                 '底层接口支持退订')
+class TestQuoteFeedMuted(unittest.TestCase):
+
+    def setUp(self):
+        base = dtp_api.QuoteFeed
+        for name in ('subscribe', 'subscribe_all'):
+            patcher = mock.patch.object(base, name, create=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.feed = QuoteFeed()
+
+    def test_resubscribe_clears_muted(self):
+        feed = self.feed
+        feed.unsubscribe(TickFeed.name, ['600000', '000001'])
+        self.assertEqual(feed._muted[TickFeed.name], {'600000', '000001'})
+
+        feed.subscribe(TickFeed.name, ['600000'])
+        self.assertEqual(feed._muted[TickFeed.name], {'000001'})
+
+        # 全订阅后之前退订的代码也应恢复推送
+        feed.subscribe_all(TickFeed.name)
+        self.assertFalse(feed._muted.get(TickFeed.name))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from fast_trader.metrics import LatencyHistogram
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_percentile_upper_bound(self):
+        hist = LatencyHistogram('test')
+        for us in range(1, 1001):
+            hist.record(us / 1e6)
+
+        self.assertEqual(hist.count, 1000)
+        p50 = hist.percentile(50)
+        p99 = hist.percentile(99)
+        self.assertTrue(500 <= p50 <= 500 * 1.125)
+        self.assertTrue(990 <= p99 <= 1000)
+        self.assertEqual(hist.percentile(100), hist.max)
+
+    def test_empty(self):
+        hist = LatencyHistogram()
+        self.assertEqual(hist.percentile(99), 0.)
+        self.assertEqual(hist.to_dict()['count'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from fast_trader.ledger import StockLedgerRecord
+from fast_trader.pnl import LedgerColumns, PnLEngine
+
+
+def rec(subject, category, code, quantity, price, sec):
+    r = StockLedgerRecord()
+    r.subject = subject
+    r.category = category
+    r.code = code
+    r.quantity = quantity
+    r.price = price
+    r.localtime = f'2020-01-02T09:30:{sec:02d}.000000'
+    return r
+
+
+def trade(code, quantity, price, sec):
+    return [rec('transaction', 'security', code, quantity, price, sec),
+            rec('transaction', 'cash', code, -quantity * price, 1., sec)]
+
+
+class TestPnLEngine(unittest.TestCase):
+
+    def setUp(self):
+        records = [rec('capital', 'cash', 'account', 10000., 1., 0)]
+        records += trade('600000.SH', 100, 10., 1)
+        # 同一时间的两笔成交
+        records += trade('600000.SH', 100, 12., 2)
+        records += trade('000001.SZ', 200, 5., 2)
+        records += [rec('costs', 'cash', '600000.SH', -2., 1., 2)]
+        records += [rec('evaluation', 'security', '600000.SH', 0., 13., 3)]
+        records += trade('600000.SH', -50, 14., 4)
+        records += trade('600000.SH', -150, 9., 5)
+        self.records = records
+        self.engine = PnLEngine(LedgerColumns.from_records(records))
+
+    def test_per_code(self):
+        df = self.engine.curves('600000.SH')
+        self.assertEqual(len(df), 5)
+
+        row = df.iloc[1]
+        self.assertEqual(row.position, 200)
+        self.assertEqual(row.cost_basis, 2200.)
+        self.assertEqual(row.holding_value, 2400.)
+        self.assertEqual(row.costs, 2.)
+
+        # 估值后浮动盈亏
+        self.assertEqual(df.iloc[2].unrealized, 400.)
+        # 均价11, 卖出50@14
+        self.assertAlmostEqual(df.iloc[3].realized, 150.)
+        self.assertAlmostEqual(df.iloc[3].cost_basis, 1650.)
+        # 清仓
+        last = df.iloc[-1]
+        self.assertEqual(last.position, 0)
+        self.assertEqual(last.cost_basis, 0.)
+        self.assertAlmostEqual(last.realized, 150. - 300.)
+
+    def test_total_and_resample(self):
+        df = self.engine.curves()
+        self.assertEqual(len(df), 6)
+        # 09:30:02 两个代码的成交都已计入
+        row = df.iloc[2]
+        self.assertEqual(row.cash, 10000. - 1000. - 1200. - 1000. - 2.)
+        self.assertEqual(row.holding_value, 2400. + 1000.)
+        self.assertEqual(row.equity, row.cash + row.holding_value)
+
+        resampled = self.engine.curves(freq='2s')
+        self.assertEqual(list(resampled.index.second), [0, 2, 4])
+        self.assertEqual(resampled.iloc[1].equity, row.equity)
+
+    def test_opening(self):
+        # 以前段流水的最新状态为期初, 接续后段流水, 结果与全量计算一致
+        head, tail = self.records[:11], self.records[11:]
+        state = PnLEngine(LedgerColumns.from_records(head)).last_state()
+        self.assertEqual(state['600000.SH']['cost_basis'], 1650.)
+        self.assertEqual(state['600000.SH']['price'], 14.)
+
+        columns = LedgerColumns()
+        columns.add_opening(head[-1].localtime, state)
+        columns.extend(tail)
+        self.assertEqual(columns.records, len(tail))
+        engine = PnLEngine(columns)
+
+        for code in (None, '600000.SH', '000001.SZ', 'account'):
+            want = self.engine.curves(code).iloc[-1]
+            got = engine.curves(code).iloc[-1]
+            for field in want.index:
+                self.assertAlmostEqual(got[field], want[field], msg=field)
+        # 期初之后没有流水的代码也计入合计
+        self.assertEqual(len(engine.curves('000001.SZ')), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import unittest
+from unittest import mock
+
+import zmq
+
+from fast_trader.dtp_quote import TickFeed, QuoteDecoder
+from fast_trader.quote_hub import (QuoteHub, RemoteQuoteFeed, _Schema,
+                                   make_topic, parse_topic, main)
+from fast_trader import zmq_context
+
+
+def tick_message(code, price):
+    content = {'szCode': code, 'szWindCode': f'{code}.SH', 'nTime': 93000000}
+    for field in TickFeed.int64_fields:
+        content[field] = str(price)
+    return json.dumps({'api_id': 'tick_feed', 'api_type': 'rsp',
+                       'handler_id': 'quote_feed',
+                       'content': content}).encode()
+
+
+class FakeQuoteFeed:
+    """
+    以本地PUB模拟dtp行情通道
+    """
+
+    def __init__(self):
+        self.sock = zmq_context.manager.context.socket(zmq.PUB)
+        self.port = self.sock.bind_to_random_port('tcp://127.0.0.1')
+        self.subscribed = []
+        self.unsubscribed = []
+
+    def _get_bound_port(self):
+        return self.port
+
+    def start(self, recv=True):
+        pass
+
+    def subscribe(self, feed_name, codes):
+        self.subscribed.append((feed_name, tuple(codes)))
+
+    def subscribe_all(self, feed_name):
+        self.subscribed.append((feed_name, None))
+
+    def unsubscribe(self, feed_name, codes):
+        self.unsubscribed.append((feed_name, tuple(codes)))
+
+
+def wait_for(cond, timeout=5):
+    deadline = time.time() + timeout
+    while not cond():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestSchema(unittest.TestCase):
+
+    def test_round_trip(self):
+        mail = QuoteDecoder().decode(tick_message('600000', 105000))
+        record = mail['content']
+        header = {k: v for k, v in mail.items() if k != 'content'}
+        schema = _Schema(1, 'tick_feed', header, record.keys(),
+                         _Schema.infer_types(record))
+
+        remote = _Schema.from_json(schema.to_json())
+        decoded = remote.decode(schema.encode(record))
+
+        self.assertEqual(decoded['content'].to_dict(), record.to_dict())
+        self.assertEqual(decoded.handler_id, 'quote_feed')
+        self.assertEqual(decoded.content.book.mid, 10.5)
+
+    def test_topic(self):
+        self.assertEqual(parse_topic(make_topic('tick_feed', '600000')),
+                         ('tick_feed', '600000'))
+        self.assertEqual(parse_topic(make_topic('tick_feed')),
+                         ('tick_feed', None))
+        # 代码前缀不应匹配其他代码
+        self.assertFalse(make_topic('tick_feed', '600000').startswith(
+            make_topic('tick_feed', '60000')))
+
+
+class TestQuoteHub(unittest.TestCase):
+
+    def test_fan_out(self):
+        upstream = FakeQuoteFeed()
+        hub = QuoteHub(upstream, address='inproc://test_quote_hub')
+        hub.start()
+
+        received = []
+        feed = RemoteQuoteFeed('inproc://test_quote_hub')
+        feed.add_callback(received.append, 'received')
+        feed.subscribe('tick_feed', ['600000'])
+        feed.start()
+
+        self.assertTrue(wait_for(lambda: upstream.subscribed))
+        self.assertEqual(upstream.subscribed,
+                         [('tick_feed', ('600000',))])
+
+        def publish():
+            upstream.sock.send(tick_message('000001', 90000))
+            upstream.sock.send(tick_message('600000', 105000))
+            return len(received) >= 2
+
+        self.assertTrue(wait_for(publish))
+        mail = received[0]
+        self.assertEqual(mail.api_id, 'tick_feed')
+        self.assertEqual(mail.content.szCode, '600000')
+        self.assertEqual(mail.content.nMatch, 10.5)
+        self.assertTrue(all(m.content.szCode == '600000' for m in received))
+
+        feed.unsubscribe('tick_feed', ['600000'])
+        self.assertTrue(wait_for(lambda: upstream.unsubscribed))
+
+        hub.stop()
+        hub.join()
+
+
+class TestMain(unittest.TestCase):
+
+    def test_run_until_stopped(self):
+        hubs = []
+
+        class Hub(QuoteHub):
+
+            def __init__(self, address=None):
+                super().__init__(FakeQuoteFeed(), address)
+                hubs.append(self)
+
+            def join(self, timeout=None):
+                # 首次等待后即停止
+                self.stop()
+                super().join(timeout)
+
+        with mock.patch('fast_trader.quote_hub.QuoteHub', Hub):
+            main(['--address', 'tcp://127.0.0.1:*',
+                  '--stats-interval', '0.01'])
+
+        hub, = hubs
+        self.assertEqual(hub.address, 'tcp://127.0.0.1:*')
+        self.assertFalse(hub._thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import time
+import datetime
+import unittest
+
+from fast_trader.dtp_trade import Timer, TimerTask
+
+
+class TestTimer(unittest.TestCase):
+
+    def test_once_and_cancel(self):
+        timer = Timer()
+        hits = []
+        task = TimerTask(datetime.datetime.now(), hits.append, args=(1,))
+        cancelled = TimerTask(datetime.datetime.now(), hits.append, args=(2,))
+        timer.add_task(task)
+        timer.add_task(cancelled)
+        timer.remove_task(cancelled)
+
+        timer.click()
+        timer.click()
+        self.assertEqual(hits, [1])
+        self.assertIsNone(timer.time_to_next())
+
+    def test_fixed_rate_interval(self):
+        timer = Timer()
+        task = TimerTask(datetime.timedelta(seconds=0.01), lambda: None)
+        first_deadline = task.deadline
+        timer.add_task(task)
+
+        # 错过多个周期后只执行一次, 且到期时间仍对齐固定频率
+        time.sleep(0.035)
+        timer.click()
+        elapsed = task.deadline - first_deadline
+        self.assertAlmostEqual(elapsed / 0.01, round(elapsed / 0.01))
+        self.assertGreater(task.deadline, time.monotonic())
+        self.assertLessEqual(timer.time_to_next(), 0.01)
+
+    def test_cancelled_count(self):
+        timer = Timer()
+        now = datetime.datetime.now()
+        tasks = [TimerTask(now, lambda: None) for _ in range(4)]
+        for task in tasks:
+            timer.add_task(task)
+        later = TimerTask(now + datetime.timedelta(hours=1), lambda: None)
+        timer.add_task(later)
+
+        timer.remove_task(tasks[0])
+        timer.remove_task(tasks[1])
+        self.assertEqual(timer._cancelled, 2)
+        # 已取消的任务出堆后不再计入
+        timer.click()
+        self.assertEqual(timer._cancelled, 0)
+        self.assertEqual(timer.tasks, [later])
+
+        # 计数准确时, 只剩一个待执行任务即触发重建
+        timer.remove_task(later)
+        self.assertEqual(timer._heap, [])
+        self.assertEqual(timer._cancelled, 0)
+
+    def test_time_to_next_discards_cancelled(self):
+        timer = Timer()
+        soon = TimerTask(datetime.timedelta(seconds=1), lambda: None)
+        later = TimerTask(datetime.timedelta(seconds=2), lambda: None)
+        other = TimerTask(datetime.timedelta(seconds=3), lambda: None)
+        for task in (soon, later, other):
+            timer.add_task(task)
+
+        timer.remove_task(soon)
+        self.assertGreater(timer.time_to_next(), 1.)
+        self.assertEqual(timer._cancelled, 0)
+        self.assertEqual(len(timer._heap), 2)
+
+    def test_remove_during_click(self):
+        timer = Timer()
+        now = datetime.datetime.now()
+        hits = []
+        tasks = [TimerTask(now, hits.append, args=(i,)) for i in range(3)]
+
+        def remove_others():
+            timer.remove_task(tasks[1])
+            timer.remove_task(tasks[2])
+
+        # 回调中取消任务触发重建, 本次click仍能看到重建后的堆
+        timer.add_task(TimerTask(now - datetime.timedelta(seconds=1),
+                                 remove_others))
+        for task in tasks:
+            timer.add_task(task)
+        timer.click()
+        self.assertEqual(hits, [0])
+        self.assertEqual(timer._heap, [])
+
+
+if __name__ == '__main__':
+    unittest.main()